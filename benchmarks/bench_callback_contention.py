@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""Measure the dispatch of received messages to the callbacks of
+message_callback_add() while other threads register and remove callbacks
+and read the callback properties.
+
+Dispatcher threads hand messages to the client as its network loop does,
+as fast as they can. Writer threads add and remove topic specific
+callbacks, set on_message and read it back, at a given rate or as fast as
+they can. The message rate and the 99th percentile of the time spent
+dispatching a message are reported without writers, then with them.
+"""
+
+import argparse
+import random
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.enums import CallbackAPIVersion
+
+
+def on_message(client, userdata, message):
+    pass
+
+
+def dispatcher(client, messages, stop, results):
+    latencies = []
+    count = 0
+    while not stop.is_set():
+        for message in messages:
+            start = time.perf_counter()
+            client._handle_on_message(message)
+            latencies.append(time.perf_counter() - start)
+        count += len(messages)
+    results.append((count, latencies))
+
+
+def writer(client, filters, rate, stop, results, seed):
+    rng = random.Random(seed)
+    count = 0
+    next_time = time.perf_counter()
+    while not stop.is_set():
+        sub = rng.choice(filters)
+        client.message_callback_add(sub, on_message)
+        client.message_callback_remove(sub)
+        client.on_message = on_message
+        assert client.on_message is on_message
+        count += 1
+        if rate:
+            next_time += 1 / rate
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    results.append(count)
+
+
+def run(client, messages, filters, args, writers):
+    stop = threading.Event()
+    dispatched = []
+    written = []
+    threads = [
+        threading.Thread(target=dispatcher, args=(client, messages, stop, dispatched))
+        for _ in range(args.dispatchers)
+    ]
+    threads += [
+        threading.Thread(target=writer, args=(client, filters, args.rate, stop, written, seed))
+        for seed in range(writers)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    count = sum(count for count, _ in dispatched)
+    latencies = sorted(latency for _, thread_latencies in dispatched for latency in thread_latencies)
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(
+        f"{writers:>3} writers: {count / args.duration:>10.0f} messages/s,"
+        f" p99 {p99 * 1e6:>7.1f} us/message, {sum(written) / args.duration:>8.0f} registrations/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--callbacks", type=int, default=1000, help="number of topic specific callbacks")
+    parser.add_argument("--dispatchers", type=int, default=2, help="number of threads dispatching messages")
+    parser.add_argument("--writers", type=int, default=2, help="number of threads registering callbacks")
+    parser.add_argument(
+        "--rate", type=float, default=0, help="registrations per second of each writer, 0 for as fast as possible")
+    parser.add_argument("--duration", type=float, default=5.0, help="duration of each run, in seconds")
+    args = parser.parse_args()
+
+    client = mqtt.Client(CallbackAPIVersion.VERSION2)
+    client.on_message = on_message
+    for device in range(args.callbacks):
+        client.message_callback_add(f"fleet/device-{device}/+/status", on_message)
+    client.message_callback_add("fleet/+/alarm/#", on_message)
+
+    rng = random.Random(0)
+    messages = []
+    for _ in range(1000):
+        device = rng.randrange(args.callbacks * 2)
+        subtopic = rng.choice(["battery/status", "alarm/fire", "telemetry/temperature"])
+        messages.append(mqtt.MQTTMessage(topic=f"fleet/device-{device}/{subtopic}".encode()))
+    filters = [f"fleet/writer-{i}/+/status" for i in range(100)]
+
+    run(client, messages, filters, args, 0)
+    run(client, messages, filters, args, args.writers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""Measure the bytes saved by each payload codec against the CPU time spent
+compressing and decompressing.
+
+The payloads are JSON telemetry documents of increasing size, similar to
+those of a fleet of sensors. Payloads smaller than the threshold are sent
+uncompressed, as done by Client.compression_set() with MQTT v5.0. The
+bytes sent include the user property naming the codec of compressed
+payloads.
+"""
+
+import argparse
+import json
+import random
+import time
+
+import paho.mqtt.client as mqtt
+
+
+def telemetry(size, rng):
+    readings = []
+    document = {"device": "sensor-0042", "site": "plant-3", "readings": readings}
+    while len(json.dumps(document)) < size:
+        readings.append({
+            "ts": 1700000000 + len(readings),
+            "temperature": round(rng.uniform(18, 25), 2),
+            "humidity": round(rng.uniform(30, 60), 1),
+            "status": "ok",
+        })
+    return json.dumps(document).encode()
+
+
+def measure(codec, payloads, threshold, rounds):
+    raw = sum(len(payload) for payload in payloads) * rounds
+    # Identifier, then the length and value of the key and of the codec name
+    encoding = 1 + 2 + len(mqtt._CONTENT_ENCODING) + 2 + len(codec.name)
+    sent = 0
+    compress_time = decompress_time = 0.0
+    for _ in range(rounds):
+        for payload in payloads:
+            if len(payload) < threshold:
+                sent += len(payload)
+                continue
+            start = time.process_time()
+            compressed = codec.compress(payload)
+            compress_time += time.process_time() - start
+            if len(compressed) + encoding >= len(payload):
+                sent += len(payload)
+                continue
+            start = time.process_time()
+            codec.decompress(compressed, mqtt._DECOMPRESS_MAX_SIZE)
+            decompress_time += time.process_time() - start
+            sent += len(compressed) + encoding
+    return raw, sent, compress_time, decompress_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200, help="number of times each payload is compressed")
+    parser.add_argument("--threshold", type=int, default=256, help="smallest payload compressed, in bytes")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[64, 256, 1024, 4096, 16384],
+        help="sizes of the JSON payloads, in bytes",
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'codec':>6} {'size':>6} {'saved':>7} {'compress':>12} {'decompress':>12} {'saved/CPU':>14}")
+    for name, codec in mqtt._payload_codecs.items():
+        for size in args.sizes:
+            payloads = [telemetry(size, rng) for _ in range(10)]
+            raw, sent, compress_time, decompress_time = measure(codec, payloads, args.threshold, args.rounds)
+            messages = len(payloads) * args.rounds
+            cpu = compress_time + decompress_time
+            rate = f"{(raw - sent) / cpu / 1e6:>9.1f} MB/s" if cpu else f"{'-':>14}"
+            print(
+                f"{name:>6} {size:>6} {1 - sent / raw:>7.1%}"
+                f" {compress_time / messages * 1e6:>9.1f} us {decompress_time / messages * 1e6:>9.1f} us {rate}"
+            )
+
+
+if __name__ == "__main__":
+    main()
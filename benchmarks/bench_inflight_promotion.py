@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""Measure how fast PUBACKs are handled depending on the number of queued
+QoS 1 messages.
+
+Each PUBACK frees an inflight slot, which is given to the next queued
+message. The throughput should not depend on the queue depth.
+
+The client is connected to one end of a socketpair, the other end plays
+the broker: it acknowledges the messages in order and discards what the
+client sends.
+
+Message ids are 16 bit integers, so a client can't have more than 65535
+messages waiting for an acknowledgement.
+"""
+
+import argparse
+import socket
+import struct
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.enums import CallbackAPIVersion, _ConnectionState
+
+
+def discard(sock):
+    try:
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+
+
+def run(depth, acks, inflight):
+    client = mqtt.Client(CallbackAPIVersion.VERSION2)
+    client.max_inflight_messages_set(inflight)
+
+    broker, sock = socket.socketpair()
+    sock.setblocking(False)
+    client._sock = sock
+    client._state = _ConnectionState.MQTT_CS_CONNECTED
+    reader = threading.Thread(target=discard, args=(broker,), daemon=True)
+    reader.start()
+
+    for _ in range(depth):
+        client.publish("benchmark/topic", b"payload", qos=1)
+
+    start = time.perf_counter()
+    mid = 1
+    while mid <= acks:
+        batch = range(mid, min(mid + inflight, acks + 1))
+        broker.sendall(b"".join(struct.pack("!BBH", 0x40, 2, m) for m in batch))
+        # PUBACKs are handled in order, the batch is done once the last
+        # message is acknowledged.
+        while batch[-1] in client._out_messages:
+            client.loop_read()
+        mid = batch.stop
+    elapsed = time.perf_counter() - start
+
+    client._sock = None
+    sock.close()
+    reader.join()
+    broker.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--acks", type=int, default=20000, help="number of PUBACK handled")
+    parser.add_argument("--inflight", type=int, default=20, help="max_inflight_messages")
+    parser.add_argument(
+        "--depth", type=int, nargs="+", default=[25000, 45000, 65000],
+        help="number of messages published before the PUBACKs are received",
+    )
+    args = parser.parse_args()
+
+    for depth in args.depth:
+        elapsed = run(depth, min(args.acks, depth), args.inflight)
+        acks = min(args.acks, depth)
+        print(f"{depth:>6} queued: {acks / elapsed:>10.0f} PUBACK/s")
+
+
+if __name__ == "__main__":
+    main()
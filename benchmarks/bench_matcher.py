@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""Compare the memory used and the match latency of MQTTMatcher against a
+trie with one node and one dict per topic level, as MQTTMatcher used to be.
+
+The filters are those of a fleet of devices: each device has a few
+filters below fleet/<region>/<site>/<device>/, some with a "+" wildcard,
+and a few filters with wildcards cover whole regions. The matches are
+not cached, to measure the trie.
+
+MQTTMatcher.match_many() is then compared to iter_match() on batches of
+topics, such as those received together from a subset of the devices.
+"""
+
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from paho.mqtt.matcher import MQTTMatcher
+
+
+class DictTrie:
+    """A trie with one dict per topic level."""
+
+    class Node:
+        __slots__ = '_children', '_content'
+
+        def __init__(self):
+            self._children = {}
+            self._content = None
+
+    def __init__(self):
+        self._root = self.Node()
+
+    def __setitem__(self, key, value):
+        node = self._root
+        for sym in key.split('/'):
+            node = node._children.setdefault(sym, self.Node())
+        node._content = value
+
+    def iter_match(self, topic):
+        lst = topic.split('/')
+        normal = not topic.startswith('$')
+
+        def rec(node, i=0):
+            if i == len(lst):
+                if node._content is not None:
+                    yield node._content
+            else:
+                part = lst[i]
+                if part in node._children:
+                    yield from rec(node._children[part], i + 1)
+                if '+' in node._children and (normal or i > 0):
+                    yield from rec(node._children['+'], i + 1)
+            if '#' in node._children and (normal or i > 0):
+                content = node._children['#']._content
+                if content is not None:
+                    yield content
+        return rec(self._root)
+
+
+DEVICE_FILTERS = ("telemetry/temperature", "telemetry/humidity", "status", "+/alarm")
+
+
+def fleet_filters(count):
+    devices = count // len(DEVICE_FILTERS)
+    for device in range(devices):
+        # Filters are built from parts, like an application would.
+        prefix = "/".join(["fleet", f"region-{device % 16}", f"site-{device % 1000}", f"device-{device:08d}"])
+        for suffix in DEVICE_FILTERS:
+            yield f"{prefix}/{suffix}"
+    for region in range(16):
+        yield f"fleet/region-{region}/+/+/status"
+        yield f"fleet/region-{region}/#"
+
+
+def fleet_topic(device, rng):
+    suffix = rng.choice(["telemetry/temperature", "telemetry/humidity", "status", "battery/alarm"])
+    return f"fleet/region-{device % 16}/site-{device % 1000}/device-{device:08d}/{suffix}"
+
+
+def build(factory, count):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    matcher = factory()
+    for i, sub in enumerate(fleet_filters(count)):
+        matcher[sub] = i
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return matcher, memory, elapsed
+
+
+def match_latency(matcher, topics):
+    start = time.perf_counter()
+    for topic in topics:
+        for _ in matcher.iter_match(topic):
+            pass
+    return (time.perf_counter() - start) / len(topics)
+
+
+def match_many_latency(matcher, batches):
+    start = time.perf_counter()
+    for batch in batches:
+        matcher.match_many(batch)
+    return (time.perf_counter() - start) / sum(len(batch) for batch in batches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filters", type=int, default=1000000, help="number of topic filters")
+    parser.add_argument("--matches", type=int, default=100000, help="number of topics matched")
+    parser.add_argument("--batch", type=int, default=1000, help="number of topics matched by match_many()")
+    parser.add_argument(
+        "--batch-devices", type=int, default=100, help="number of devices sending the topics of a batch")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    devices = args.filters // len(DEVICE_FILTERS)
+    topics = [fleet_topic(rng.randrange(devices), rng) for _ in range(args.matches)]
+    batches = []
+    for _ in range(args.matches // args.batch):
+        senders = rng.sample(range(devices), args.batch_devices)
+        batches.append([fleet_topic(rng.choice(senders), rng) for _ in range(args.batch)])
+
+    for name, factory in (("dict trie", DictTrie), ("MQTTMatcher", lambda: MQTTMatcher(cache_size=0))):
+        matcher, memory, elapsed = build(factory, args.filters)
+        latency = match_latency(matcher, topics)
+        print(
+            f"{name:>12}: {memory / 2**20:>8.1f} MiB, {memory / args.filters:>6.0f} B/filter,"
+            f" built in {elapsed:>5.1f} s, {latency * 1e6:>6.2f} us/match"
+        )
+        if isinstance(matcher, MQTTMatcher):
+            latency = match_latency(matcher, [topic for batch in batches for topic in batch])
+            many_latency = match_many_latency(matcher, batches)
+            print(
+                f"{'batches':>12}: {latency * 1e6:>6.2f} us/match with iter_match(),"
+                f" {many_latency * 1e6:>6.2f} us/match with match_many()"
+            )
+        del matcher
+
+
+if __name__ == "__main__":
+    main()
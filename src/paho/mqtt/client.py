@@ -20,11 +20,15 @@ from __future__ import annotations
 
 import base64
 import collections
+import copy
 import errno
+import functools
 import hashlib
+import itertools
 import logging
 import os
 import platform
+import queue
 import select
 import socket
 import string
@@ -35,13 +39,25 @@ import urllib.parse
 import urllib.request
 import uuid
 import warnings
-from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, NamedTuple, Sequence, Tuple, Union, cast
+import zlib
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Sequence, Tuple, Union, cast
 
 from paho.mqtt.packettypes import PacketTypes
 
-from .enums import CallbackAPIVersion, ConnackCode, LogLevel, MessageState, MessageType, MQTTErrorCode, MQTTProtocolVersion, PahoClientMode, _ConnectionState
+from .enums import (
+    CallbackAPIVersion,
+    ConnackCode,
+    LogLevel,
+    MessageState,
+    MessageType,
+    MQTTErrorCode,
+    MQTTProtocolVersion,
+    PahoClientMode,
+    PublishPriority,
+    _ConnectionState,
+)
 from .matcher import MQTTMatcher
-from .properties import Properties
+from .properties import Properties, VariableByteIntegers
 from .reasoncodes import ReasonCode, ReasonCodes
 from .subscribeoptions import SubscribeOptions
 
@@ -52,9 +68,9 @@ except ImportError:
 
 if TYPE_CHECKING:
     try:
-        from typing import TypedDict  # type: ignore
+        from typing import NotRequired, Required, TypedDict  # type: ignore
     except ImportError:
-        from typing_extensions import TypedDict
+        from typing_extensions import NotRequired, Required, TypedDict
 
     try:
         from typing import Protocol  # type: ignore
@@ -64,26 +80,17 @@ if TYPE_CHECKING:
     class _InPacket(TypedDict):
         command: int
         have_remaining: int
-        remaining_count: list[int]
-        remaining_mult: int
         remaining_length: int
         packet: bytearray
         to_process: int
         pos: int
-
-
-    class _OutPacket(TypedDict):
-        command: int
-        mid: int
-        qos: int
-        pos: int
-        to_process: int
-        packet: bytes
-        info: MQTTMessageInfo | None
+        pooled: bool
 
     class SocketLike(Protocol):
         def recv(self, buffer_size: int) -> bytes:
             ...
+        def recv_into(self, buffer: memoryview, nbytes: int = 0) -> int:
+            ...
         def send(self, buffer: bytes) -> int:
             ...
         def close(self) -> None:
@@ -106,6 +113,21 @@ except ImportError:
     socks = None  # type: ignore[assignment]
 
 
+try:
+    import bz2
+except ImportError:
+    bz2 = None  # type: ignore[assignment]
+
+
+try:
+    import lzma
+except ImportError:
+    lzma = None  # type: ignore[assignment]
+
+
+# socket.sendmsg() isn't available on Windows.
+_HAVE_SENDMSG = hasattr(socket.socket, "sendmsg")
+
 try:
     # Use monotonic clock if available
     time_func = time.monotonic
@@ -209,6 +231,46 @@ MQTT_BRIDGE = PahoClientMode.MQTT_BRIDGE
 MQTT_CLEAN_START_FIRST_ONLY: CleanStartOption = 3
 
 sockpair_data = b"0"
+# Value written to an eventfd to wake up the network loop.
+_EVENTFD_INCREMENT = struct.pack("=Q", 1)
+
+# Default size of the reads done on the socket. A single read may contain
+# several packets, which are then all handled without further system calls.
+_RECEIVE_CHUNK_SIZE = 65536
+# Default number of large packet buffers kept for reuse.
+_RECEIVE_POOL_SIZE = 4
+# Limits of the number of packets and of the amount of data, from the first
+# packet not sent yet, written with a single call to the socket.
+_WRITE_BATCH_PACKETS = 512
+_WRITE_BATCH_SIZE = 65536
+# Lanes of the outgoing packets queue, written in this order. CONNECT and AUTH
+# come first, as no other packet may be sent before them, then acknowledgements
+# and PINGREQ/PINGRESP, and DISCONNECT last. Other packets go in the lane of the
+# published messages of normal priority.
+_LANE_CONNECT = 0
+_LANE_CONTROL = 1
+_LANE_NORMAL = 3
+_LANE_DISCONNECT = 5
+_LANES = 6
+_PACKET_LANES: dict[int, int] = {
+    MessageType.CONNECT: _LANE_CONNECT,
+    MessageType.AUTH: _LANE_CONNECT,
+    MessageType.PUBACK: _LANE_CONTROL,
+    MessageType.PUBREC: _LANE_CONTROL,
+    MessageType.PUBREL: _LANE_CONTROL,
+    MessageType.PUBCOMP: _LANE_CONTROL,
+    MessageType.PINGREQ: _LANE_CONTROL,
+    MessageType.PINGRESP: _LANE_CONTROL,
+    MessageType.DISCONNECT: _LANE_DISCONNECT,
+}
+_PUBLISH_LANES: dict[int, int] = {
+    PublishPriority.HIGH: 2,
+    PublishPriority.NORMAL: _LANE_NORMAL,
+    PublishPriority.LOW: 4,
+}
+# Round trip times, in seconds, below which acknowledgements are considered
+# immediate by the adaptive inflight window.
+_INFLIGHT_MIN_RTT = 0.001
 
 # Payload support all those type and will be converted to bytes:
 # * str are utf8 encoded
@@ -216,6 +278,28 @@ sockpair_data = b"0"
 # * None is converted to a zero-length payload (i.e. b"")
 PayloadType = Union[str, bytes, bytearray, int, float, None]
 
+if TYPE_CHECKING:
+    class PublishMessageDict(TypedDict, total=False):
+        topic: Required[str]
+        payload: NotRequired[PayloadType]
+        qos: NotRequired[int]
+        retain: NotRequired[bool]
+        properties: NotRequired[Properties | None]
+        priority: NotRequired[int]
+
+    PublishMessageTuple = Union[
+        Tuple[str],
+        Tuple[str, PayloadType],
+        Tuple[str, PayloadType, int],
+        Tuple[str, PayloadType, int, bool],
+        Tuple[str, PayloadType, int, bool, Union[Properties, None]],
+        Tuple[str, PayloadType, int, bool, Union[Properties, None], int],
+    ]
+
+# Default values of the items of a message given as a tuple to
+# Client.publish_many(): (topic, payload, qos, retain, properties, priority)
+_PUBLISH_DEFAULTS = (None, None, 0, False, None, PublishPriority.NORMAL)
+
 HTTPHeader = Dict[str, str]
 WebSocketHeaders = Union[Callable[[HTTPHeader], HTTPHeader], HTTPHeader]
 
@@ -252,6 +336,7 @@ CallbackOnConnect_v1_mqtt5 = Callable[["Client", Any, Dict[str, Any], ReasonCode
 CallbackOnConnect_v1 = Union[CallbackOnConnect_v1_mqtt5, CallbackOnConnect_v1_mqtt3]
 CallbackOnConnect_v2 = Callable[["Client", Any, ConnectFlags, ReasonCode, Union[Properties, None]], None]
 CallbackOnConnect = Union[CallbackOnConnect_v1, CallbackOnConnect_v2]
+CallbackOnBackpressure = Callable[["Client", Any, bool], None]
 CallbackOnConnectFail = Callable[["Client", Any], None]
 CallbackOnDisconnect_v1_mqtt3 = Callable[["Client", Any, MQTTErrorCode], None]
 CallbackOnDisconnect_v1_mqtt5 = Callable[["Client", Any, Union[ReasonCode, int, None], Union[Properties, None]], None]
@@ -420,6 +505,62 @@ def _base62(
     return ''.join(reversed(digits))
 
 
+class TopicFilter:
+    """A topic filter compiled once to check quickly whether topics match it.
+
+    This is useful when the same filters are checked against many topics,
+    for example to route messages::
+
+        sensors = TopicFilter("sensors/+/temperature")
+        if sensors.matches(message.topic):
+            ...
+
+    `topic_matches_sub()` keeps the last compiled filters.
+    """
+
+    __slots__ = "_dollar", "_fixed", "_levels", "_multi", "filter"
+
+    def __init__(self, sub: str):
+        self.filter = sub
+        """ The topic filter (str)."""
+        levels = sub.split('/')
+        # A trailing "#" matches any number of levels, including none.
+        self._multi = levels[-1] == '#'
+        if self._multi:
+            del levels[-1]
+        self._levels = len(levels)
+        # The levels to compare, None if the filter has no wildcard.
+        self._fixed: tuple[tuple[int, str], ...] | None = None
+        if self._multi or '+' in levels:
+            self._fixed = tuple((i, level) for i, level in enumerate(levels) if level != '+')
+        # Whether topics starting with "$" can match, they aren't matched
+        # by a wildcard on the first level.
+        self._dollar = not (self._multi and not levels) and not (levels and levels[0] == '+')
+
+    def __repr__(self) -> str:
+        return f"TopicFilter({self.filter!r})"
+
+    def matches(self, topic: str) -> bool:
+        """Return whether the topic matches the filter."""
+        fixed = self._fixed
+        if fixed is None:
+            return topic == self.filter
+        if not self._dollar and topic.startswith('$'):
+            return False
+        levels = topic.split('/')
+        if len(levels) != self._levels and (not self._multi or len(levels) < self._levels):
+            return False
+        for i, level in fixed:
+            if levels[i] != level:
+                return False
+        return True
+
+
+@functools.lru_cache(maxsize=1024)
+def _topic_filter(sub: str) -> TopicFilter:
+    return TopicFilter(sub)
+
+
 def topic_matches_sub(sub: str, topic: str) -> bool:
     """Check whether a topic matches a subscription.
 
@@ -427,14 +568,80 @@ def topic_matches_sub(sub: str, topic: str) -> bool:
 
     * Topic "foo/bar" would match the subscription "foo/#" or "+/bar"
     * Topic "non/matching" would not match the subscription "non/+/+"
+
+    The last 1024 subscriptions are kept compiled as `TopicFilter`.
     """
-    matcher = MQTTMatcher()
-    matcher[sub] = True
-    try:
-        next(matcher.iter_match(topic))
-        return True
-    except StopIteration:
-        return False
+    return _topic_filter(sub).matches(topic)
+
+
+class PayloadCodec(NamedTuple):
+    """A payload compression codec, see `register_payload_codec()`."""
+
+    name: str
+    """ The name of the codec, sent along with the compressed messages."""
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes | memoryview, int], bytes]
+
+
+# Name of the MQTT v5.0 user property of compressed messages, set to the name
+# of their codec.
+_CONTENT_ENCODING = "content-encoding"
+
+# Default maximum size of a decompressed payload, the largest an MQTT packet
+# may carry.
+_DECOMPRESS_MAX_SIZE = 268435455
+
+_payload_codecs: dict[str, PayloadCodec] = {}
+
+
+def register_payload_codec(
+    name: str,
+    compress: Callable[[bytes], bytes],
+    decompress: Callable[[bytes | memoryview, int], bytes],
+) -> PayloadCodec:
+    """Make a payload compression codec available to `Client.compression_set()`.
+
+    "zlib", and if Python was built with them "bz2" and "lzma", are
+    available by default.
+
+    :param str name: the name of the codec. Registering another codec with
+        the same name replaces it.
+    :param compress: a function returning its argument compressed.
+    :param decompress: a function returning its first argument, a
+        bytes-like object, decompressed. It must raise ValueError or OSError
+        if the data is invalid, or would decompress to more bytes than its
+        second argument, without decompressing more than that.
+    """
+    codec = PayloadCodec(name, compress, decompress)
+    _payload_codecs[name] = codec
+    return codec
+
+
+def _decompress_stream(decompressor: Any, data: bytes | memoryview, max_size: int) -> bytes:
+    """Decompress data with a zlib, bz2 or lzma decompressor object, which
+    stops at max_size bytes."""
+    # One more byte, to tell a payload of max_size bytes from a larger one
+    payload = decompressor.decompress(data, max_size + 1)
+    if len(payload) > max_size:
+        raise ValueError(f"decompressed payload larger than {max_size} bytes")
+    if not decompressor.eof:
+        raise ValueError("truncated compressed payload")
+    return payload
+
+
+register_payload_codec(
+    "zlib", zlib.compress, lambda data, max_size: _decompress_stream(zlib.decompressobj(), data, max_size))
+if bz2 is not None:
+    register_payload_codec(
+        "bz2", bz2.compress, lambda data, max_size: _decompress_stream(bz2.BZ2Decompressor(), data, max_size))
+if lzma is not None:
+    register_payload_codec(
+        "lzma", lzma.compress, lambda data, max_size: _decompress_stream(lzma.LZMADecompressor(), data, max_size))
+
+# The errors of the codecs on invalid data
+_DECOMPRESS_ERRORS: tuple[type[Exception], ...] = (ValueError, OSError, zlib.error)
+if lzma is not None:
+    _DECOMPRESS_ERRORS += (lzma.LZMAError,)
 
 
 def _socketpair_compat() -> tuple[socket.socket, socket.socket]:
@@ -459,13 +666,52 @@ def _socketpair_compat() -> tuple[socket.socket, socket.socket]:
     return (sock1, sock2)
 
 
+class _EventFd:
+    """Linux eventfd with the part of the socket interface used to wake up
+    the network loop, so it can replace both ends of the socketpair."""
+
+    __slots__ = "_fd",
+
+    def __init__(self) -> None:
+        self._fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)  # type: ignore[attr-defined]
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def send(self, data: bytes) -> int:
+        os.write(self._fd, _EVENTFD_INCREMENT)
+        return len(data)
+
+    def recv(self, bufsize: int) -> bytes:
+        # Reading resets the counter, however many writes were done.
+        return os.read(self._fd, 8)
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def _wakeup_socketpair() -> tuple[socket.socket | _EventFd, socket.socket | _EventFd]:
+    """Return the two ends used to wake up the network loop from another
+    thread, a single eventfd where available or a socketpair otherwise."""
+    if hasattr(os, "eventfd"):
+        try:
+            eventfd = _EventFd()
+        except OSError:
+            pass
+        else:
+            return (eventfd, eventfd)
+    return _socketpair_compat()
+
+
 def _force_bytes(s: str | bytes) -> bytes:
     if isinstance(s, str):
         return s.encode("utf-8")
     return s
 
 
-def _encode_payload(payload: str | bytes | bytearray | int | float | None) -> bytes|bytearray:
+def _encode_payload(payload: str | bytes | bytearray | int | float | None) -> bytes:
     if isinstance(payload, str):
         return payload.encode("utf-8")
 
@@ -475,7 +721,12 @@ def _encode_payload(payload: str | bytes | bytearray | int | float | None) -> by
     if payload is None:
         return b""
 
-    if not isinstance(payload, (bytes, bytearray)):
+    if isinstance(payload, bytearray):
+        # The payload is sent later, possibly more than once, so it must not
+        # change if the caller reuses the bytearray.
+        return bytes(payload)
+
+    if not isinstance(payload, bytes):
         raise TypeError(
             "payload must be a string, bytearray, int, float or None."
         )
@@ -483,23 +734,54 @@ def _encode_payload(payload: str | bytes | bytearray | int | float | None) -> by
     return payload
 
 
+def _pack_uint16_property(packed_properties: bytes, identifier: int, value: int) -> bytes:
+    """Append a two byte integer property to already packed properties."""
+    props_len, vbi_len = VariableByteIntegers.decode(packed_properties)
+    return (
+        VariableByteIntegers.encode(props_len + 3) + packed_properties[vbi_len:]
+        + struct.pack("!BH", identifier, value)
+    )
+
+
+def _remaining_length_size(remaining_length: int) -> int:
+    """Return the number of bytes encoding a remaining length."""
+    if remaining_length < 128:
+        return 1
+    if remaining_length < 16384:
+        return 2
+    if remaining_length < 2097152:
+        return 3
+    return 4
+
+
+# Protects the creation of MQTTMessageInfo conditions.
+_message_info_condition_lock = threading.Lock()
+
+
 class MQTTMessageInfo:
     """This is a class returned from `Client.publish()` and can be used to find
     out the mid of the message that was published, and to determine whether the
     message has been published, and/or wait until it is published.
     """
 
-    __slots__ = 'mid', '_published', '_condition', 'rc', '_iterpos'
+    __slots__ = 'mid', '_published', '_condition', 'rc', '_iterpos', 'rate_limit_wait'
 
     def __init__(self, mid: int):
         self.mid = mid
         """ The message Id (int)"""
         self._published = False
-        self._condition = threading.Condition()
+        # Created by the first call to wait_for_publish(), most messages are
+        # never waited for.
+        self._condition: threading.Condition | None = None
         self.rc: MQTTErrorCode = MQTTErrorCode.MQTT_ERR_SUCCESS
         """ The `MQTTErrorCode` that give status for this message.
         This value could change until the message `is_published`"""
         self._iterpos = 0
+        self.rate_limit_wait = 0.0
+        """ The time in seconds the message was held back by the rate limit,
+        see `Client.rate_limit_set()` (float). Only the time spent as the
+        next message to publish is counted, not the time spent queued behind
+        other held messages."""
 
     def __str__(self) -> str:
         return str((self.rc, self.mid))
@@ -530,9 +812,13 @@ class MQTTMessageInfo:
             raise IndexError("index out of range")
 
     def _set_as_published(self) -> None:
-        with self._condition:
-            self._published = True
-            self._condition.notify()
+        # _published must be set before looking for a condition, see
+        # wait_for_publish().
+        self._published = True
+        condition = self._condition
+        if condition is not None:
+            with condition:
+                condition.notify()
 
     def wait_for_publish(self, timeout: float | None = None) -> None:
         """Block until the message associated with this object is published, or
@@ -558,6 +844,13 @@ class MQTTMessageInfo:
         def timed_out() -> bool:
             return False if timeout_time is None else time_func() > timeout_time
 
+        # The condition must exist before _published is checked, so that
+        # _set_as_published() either sees it or has already set _published.
+        if self._condition is None:
+            with _message_info_condition_lock:
+                if self._condition is None:
+                    self._condition = threading.Condition()
+
         with self._condition:
             while not self._published and not timed_out():
                 self._condition.wait(timeout_tenth)
@@ -578,15 +871,350 @@ class MQTTMessageInfo:
         elif self.rc > 0:
             raise RuntimeError(f'Message publish failed: {error_string(self.rc)}')
 
-        with self._condition:
-            return self._published
+        return self._published
+
+
+class _InflightControl:
+    """Adapts the inflight window to the round trip time of messages.
+
+    The window grows by one message every window acknowledgements, and is
+    halved when a message takes more than latency_factor times the lowest
+    round trip time seen to be acknowledged, or when the broker reports its
+    quota exceeded. It is halved at most once per round trip time, since
+    messages sent before a decrease are expected to be late too.
+    """
+
+    __slots__ = "_decrease_time", "_min_rtt", "latency_factor", "maximum", "minimum", "window"
+
+    def __init__(self, minimum: int, latency_factor: float) -> None:
+        self.minimum = minimum
+        self.maximum = 65535
+        self.latency_factor = latency_factor
+        self.window = float(minimum)
+        self._min_rtt = 0.0
+        self._decrease_time = 0.0
+
+    def reset(self, maximum: int) -> int:
+        """Start again from the minimum window, on a new connection."""
+        self.maximum = maximum if maximum > 0 else 65535
+        self.window = float(min(self.minimum, self.maximum))
+        self._min_rtt = 0.0
+        self._decrease_time = 0.0
+        return int(self.window)
+
+    def acknowledged(self, rtt: float, now: float) -> int:
+        if self._min_rtt == 0.0 or rtt < self._min_rtt:
+            self._min_rtt = max(rtt, _INFLIGHT_MIN_RTT)
+        if rtt > self.latency_factor * self._min_rtt:
+            return self.decrease(now)
+        self.window = min(self.window + 1 / self.window, self.maximum)
+        return int(self.window)
+
+    def decrease(self, now: float) -> int:
+        if now - self._decrease_time >= self._min_rtt:
+            self._decrease_time = now
+            self.window = max(self.window / 2, min(self.minimum, self.maximum))
+        return int(self.window)
+
+
+class _TokenBucket:
+    """Limits a rate to rate tokens per second, with bursts of up to burst
+    tokens.
+
+    More tokens than the burst may be taken at once when the bucket is full,
+    the bucket is then in debt until it fills again.
+    """
+
+    __slots__ = "_stamp", "burst", "rate", "tokens"
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._stamp = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """Return how long to wait before amount tokens can be taken."""
+        self.tokens = min(self.tokens + (now - self._stamp) * self.rate, self.burst)
+        self._stamp = now
+        missing = min(amount, self.burst) - self.tokens
+        if missing > 0:
+            return missing / self.rate
+        return 0.0
+
+    def take(self, amount: float) -> None:
+        self.tokens -= amount
+
+
+class _MessageCallbacks(NamedTuple):
+    """The callbacks of received messages.
+
+    Never changed once published by the client, so that messages are
+    dispatched without locking. The client changes its own copies of them
+    under _callback_mutex, and publishes them again when it dispatches the
+    next message.
+    """
+
+    on_message: CallbackOnMessage | None
+    # The callbacks of message_callback_add() by topic filter
+    matcher: MQTTMatcher
+    # The same callbacks by the MQTT v5.0 Subscription Identifier given to
+    # their topic filter
+    id_callbacks: dict[int, CallbackOnMessage]
+    # The topic filters subscribed with their identifier
+    bound: frozenset[str]
+
+
+class _TopicAliases:
+    """Topic aliases assigned to outgoing topics.
+
+    When all aliases are in use, the alias of the least recently used topic
+    is given to the new one.
+    """
+
+    __slots__ = "_aliases", "lock", "maximum"
+
+    def __init__(self) -> None:
+        self.maximum = 0
+        # Reentrant as callbacks may publish while a message is queued.
+        self.lock = threading.RLock()
+        self._aliases: collections.OrderedDict[bytes, int] = collections.OrderedDict()
+
+    def reset(self, maximum: int) -> None:
+        with self.lock:
+            self.maximum = maximum
+            self._aliases.clear()
+
+    def get(self, topic: bytes) -> tuple[int, bool]:
+        """Return the alias of topic and whether the broker already knows it."""
+        alias = self._aliases.get(topic)
+        if alias is not None:
+            self._aliases.move_to_end(topic)
+            return alias, True
+        if len(self._aliases) < self.maximum:
+            alias = len(self._aliases) + 1
+        else:
+            _, alias = self._aliases.popitem(last=False)
+        self._aliases[topic] = alias
+        return alias, False
+
+
+class _OutPacket:
+    """A packet queued to be sent.
+
+    The header, and for PUBLISH the variable header, is kept apart from the
+    payload so the latter is never copied. pos is the number of bytes
+    already written.
+    """
+
+    __slots__ = "command", "info", "mid", "packet", "payload", "pos", "qos", "to_process"
+
+    def __init__(
+        self,
+        command: int,
+        mid: int,
+        qos: int,
+        packet: bytes | bytearray,
+        payload: bytes | bytearray | memoryview,
+        info: MQTTMessageInfo | None,
+    ) -> None:
+        self.command = command
+        self.mid = mid
+        self.qos = qos
+        self.pos = 0
+        self.to_process = len(packet) + len(payload)
+        self.packet = packet
+        self.payload = payload
+        self.info = info
+
+    def views(self) -> list[memoryview]:
+        """Return views of the parts of the packet not written yet."""
+        header_length = len(self.packet)
+        if self.pos < header_length:
+            if not self.payload:
+                return [memoryview(self.packet)[self.pos:]]
+            return [memoryview(self.packet)[self.pos:], memoryview(self.payload)]
+        return [memoryview(self.payload)[self.pos - header_length:]]
+
+
+class _OutPacketQueue:
+    """The packets waiting to be written to the socket.
+
+    Each lane is a FIFO, the first non-empty lane is written first. Packets
+    put back after a write, including the one partly written, are written
+    again before any other, as the same batch.
+    """
+
+    __slots__ = "_controls", "_front", "_lanes"
+
+    def __init__(self) -> None:
+        self._front: collections.deque[_OutPacket] = collections.deque()
+        self._lanes: list[collections.deque[_OutPacket]] = [collections.deque() for _ in range(_LANES)]
+        # The number of packets other than PUBLISH in each lane
+        self._controls = [0] * _LANES
+
+    def __len__(self) -> int:
+        return len(self._front) + sum(len(lane) for lane in self._lanes)
+
+    def __bool__(self) -> bool:
+        return bool(self._front) or any(self._lanes)
+
+    def __iter__(self) -> Iterator[_OutPacket]:
+        return itertools.chain(self._front, *self._lanes)
+
+    def append(self, packet: _OutPacket, lane: int) -> None:
+        self._lanes[lane].append(packet)
+        if (packet.command & 0xF0) != PUBLISH:
+            self._controls[lane] += 1
+
+    def extendleft(self, packets: Iterable[_OutPacket]) -> None:
+        self._front.extendleft(packets)
+
+    def has_front(self) -> bool:
+        """Return whether packets were put back by extendleft()."""
+        return bool(self._front)
+
+    def has_control(self) -> bool:
+        """Return whether packets other than PUBLISH are in the lanes."""
+        return any(self._controls)
+
+    def popfront(self) -> list[_OutPacket]:
+        """Remove and return the packets put back by extendleft()."""
+        packets = list(self._front)
+        self._front.clear()
+        return packets
+
+    def peek(self) -> _OutPacket:
+        """Return the packet popleft() would return, without removing it."""
+        if self._front:
+            return self._front[0]
+        for lane in self._lanes:
+            if lane:
+                return lane[0]
+        raise IndexError("peek from an empty queue")
+
+    def popleft(self) -> _OutPacket:
+        if self._front:
+            return self._front.popleft()
+        for i, lane in enumerate(self._lanes):
+            if lane:
+                packet = lane.popleft()
+                if (packet.command & 0xF0) != PUBLISH:
+                    self._controls[i] -= 1
+                return packet
+        raise IndexError("pop from an empty queue")
+
+    def popleft_control(self) -> _OutPacket:
+        """Remove and return the first packet other than PUBLISH of the lanes,
+        leaving the PUBLISH packets before it queued."""
+        for i, lane in enumerate(self._lanes):
+            if self._controls[i]:
+                for j, packet in enumerate(lane):
+                    if (packet.command & 0xF0) != PUBLISH:
+                        del lane[j]
+                        self._controls[i] -= 1
+                        return packet
+        raise IndexError("pop from an empty queue")
+
+    def clear(self) -> None:
+        self._front.clear()
+        for lane in self._lanes:
+            lane.clear()
+        self._controls = [0] * _LANES
+
+
+class TopicPublisher:
+    """Publishes messages with the same topic, QoS, retain flag and properties.
+
+    Use `Client.publisher()` to create one.
+    """
+
+    __slots__ = '_base_length', '_client', '_command', '_packed_properties', '_packed_topic', '_topic_bytes', 'priority', 'properties', 'qos', 'retain', 'topic'
+
+    def __init__(
+        self,
+        client: Client,
+        topic: str,
+        qos: int = 0,
+        retain: bool = False,
+        properties: Properties | None = None,
+        priority: int = PublishPriority.NORMAL,
+    ):
+        if client._protocol != MQTTv5 and (topic is None or len(topic) == 0):
+            raise ValueError('Invalid topic.')
+
+        topic_bytes = topic.encode('utf-8')
+
+        client._raise_for_invalid_topic(topic_bytes)
+
+        if qos < 0 or qos > 2:
+            raise ValueError('Invalid QoS level.')
+
+        if priority not in _PUBLISH_LANES:
+            raise ValueError('Invalid priority.')
+
+        self._client = client
+        self.topic = topic
+        """ The topic messages are published on (str)."""
+        self.qos = qos
+        """ The Quality of Service of the messages (int)."""
+        self.retain = retain
+        """ The retain flag of the messages (bool)."""
+        self.properties = properties
+        """ In MQTT v5.0, the properties of the messages. (`Properties`)"""
+        self.priority = priority
+        """ The priority of the messages over the other outgoing packets (`PublishPriority`)."""
+        self._topic_bytes = topic_bytes
+        self._command = PUBLISH | (qos << 1) | retain
+        self._packed_topic = struct.pack("!H", len(topic_bytes)) + topic_bytes
+        self._packed_properties = b""
+        if client._protocol == MQTTv5:
+            self._packed_properties = b'\x00' if properties is None else properties.pack()
+        # Remaining length of a message without payload
+        self._base_length = len(self._packed_topic) + len(self._packed_properties)
+        if qos > 0:
+            self._base_length += 2
+
+    def _pack_header(self, mid: int, payloadlen: int, dup: bool) -> bytearray:
+        packet = bytearray()
+        packet.append(self._command | ((dup & 0x1) << 3))
+        remaining_length = self._base_length + payloadlen
+        while remaining_length > 127:
+            packet.append((remaining_length & 127) | 0x80)
+            remaining_length >>= 7
+        packet.append(remaining_length)
+        packet += self._packed_topic
+        if self.qos > 0:
+            packet += mid.to_bytes(2, "big")
+        packet += self._packed_properties
+        return packet
+
+    def send(self, payload: PayloadType = None) -> MQTTMessageInfo:
+        """Publish a message with the given payload.
+
+        This is equivalent to ``client.publish(topic, payload, qos, retain,
+        properties, priority)`` with the arguments the publisher was created with.
+
+        :param payload: The actual message to send, as for `Client.publish()`.
+
+        :raises ValueError: if the length of the payload is greater than 268435455 bytes.
+        """
+        local_payload = _encode_payload(payload)
+
+        if len(local_payload) > 268435455:
+            raise ValueError('Payload too large.')
+
+        client = self._client
+        return client._publish(
+            client._mid_generate(), self._topic_bytes, local_payload, self.qos, self.retain, self.properties,
+            publisher=self, priority=self.priority)
 
 
 class MQTTMessage:
     """ This is a class that describes an incoming message. It is
     passed to the `on_message` callback as the message parameter.
     """
-    __slots__ = 'timestamp', 'state', 'dup', 'mid', '_topic', 'payload', 'qos', 'retain', 'info', 'properties'
+    __slots__ = 'timestamp', 'state', 'dup', 'mid', '_topic', 'payload', 'qos', 'retain', 'info', 'properties', '_priority'
 
     def __init__(self, mid: int = 0, topic: bytes = b""):
         self.timestamp = 0.0
@@ -595,8 +1223,10 @@ class MQTTMessage:
         self.mid = mid
         """ The message id (int)."""
         self._topic = topic
-        self.payload = b""
-        """the message payload (bytes)"""
+        self.payload: bytes | memoryview = b""
+        """the message payload (bytes, or a read-only memoryview if
+        `Client.payload_memoryview` is set). It is annotated as either, so
+        type checkers require code expecting bytes to check or convert it."""
         self.qos = 0
         """ The message Quality of Service (0, 1 or 2)."""
         self.retain = False
@@ -604,6 +1234,7 @@ class MQTTMessage:
         self.info = MQTTMessageInfo(mid)
         self.properties: Properties | None = None
         """ In MQTT v5.0, the properties associated with the message. (`Properties`)"""
+        self._priority: int = PublishPriority.NORMAL
 
     def __eq__(self, other: object) -> bool:
         """Override the default Equals behavior"""
@@ -727,7 +1358,7 @@ class Client:
 
     `on_connect`, `on_connect_fail`, `on_disconnect`, `on_message`, `on_publish`,
     `on_subscribe`, `on_unsubscribe`, `on_log`, `on_socket_open`, `on_socket_close`,
-    `on_socket_register_write`, `on_socket_unregister_write`
+    `on_socket_register_write`, `on_socket_unregister_write`, `on_backpressure`
     """
 
     def __init__(
@@ -749,12 +1380,16 @@ class Client:
                 f'transport must be "websockets", "tcp" or "unix", not {transport}')
 
         self._manual_ack = manual_ack
+        self._payload_memoryview = False
         self._transport = transport
         self._protocol = protocol
         self._userdata = userdata
         self._sock: SocketLike | None = None
-        self._sockpairR: socket.socket | None = None
-        self._sockpairW: socket.socket | None = None
+        self._sockpairR: socket.socket | _EventFd | None = None
+        self._sockpairW: socket.socket | _EventFd | None = None
+        # Whether the network loop has already been woken up and not yet
+        # handled the wakeup.
+        self._sockpair_pending = False
         self._keepalive = 60
         self._connect_timeout = 5.0
         self._client_mode = MQTT_CLIENT
@@ -802,14 +1437,21 @@ class Client:
         self._in_packet: _InPacket = {
             "command": 0,
             "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
             "remaining_length": 0,
             "packet": bytearray(b""),
             "to_process": 0,
             "pos": 0,
+            "pooled": False,
         }
-        self._out_packet: collections.deque[_OutPacket] = collections.deque()
+        # Fixed size buffer the socket is read into. Data received but not
+        # yet handled is self._in_buffer[self._in_buffer_pos:self._in_buffer_end].
+        # Packets too large for it are read into their own buffer, taken
+        # from self._in_buffer_pool.
+        self._in_buffer = bytearray(_RECEIVE_CHUNK_SIZE)
+        self._in_buffer_pos = 0
+        self._in_buffer_end = 0
+        self._in_buffer_pool = _ReceiveBufferPool(_RECEIVE_POOL_SIZE)
+        self._out_packet = _OutPacketQueue()
         self._last_msg_in = time_func()
         self._last_msg_out = time_func()
         self._reconnect_min_delay = 1
@@ -822,12 +1464,48 @@ class Client:
         self._out_messages: collections.OrderedDict[
             int, MQTTMessage
         ] = collections.OrderedDict()
+        # Mids of the messages of _out_messages waiting for an inflight slot,
+        # in the same order. Entries of messages no longer queued are skipped
+        # when taken off it.
+        self._out_queued_mids: collections.deque[int] = collections.deque()
         self._in_messages: collections.OrderedDict[
             int, MQTTMessage
         ] = collections.OrderedDict()
         self._max_inflight_messages = 20
+        # max_inflight_messages limited by the broker's Receive Maximum
+        self._inflight_window = 20
+        self._inflight_control: _InflightControl | None = None
         self._inflight_messages = 0
+        # Maximum Packet Size of the broker, 0 if unlimited.
+        self._max_packet_size = 0
         self._max_queued_messages = 0
+        # Payload bytes of the QoS > 0 messages not yet acknowledged and of
+        # the QoS 0 messages not yet written, only counted when limited.
+        self._max_queued_bytes = 0
+        self._queued_bytes_low = 0
+        self._queued_bytes_block = False
+        self._queued_bytes_timeout: float | None = None
+        self._queued_bytes = 0
+        self._queued_bytes_high = False
+        self._queued_bytes_condition = threading.Condition()
+        # The thread which last ran the network loop, in which publish()
+        # never blocks.
+        self._network_thread: threading.Thread | None = None
+        self._rate_limit_messages: _TokenBucket | None = None
+        self._rate_limit_bytes: _TokenBucket | None = None
+        # While a message is held back by the rate limit, the time it was
+        # first held back and the time it may be written.
+        self._rate_limit_since = 0.0
+        self._rate_limit_until = 0.0
+        # Payload compression by topic filter, replaced as a whole when
+        # changed so that they are used without locking.
+        self._compression_filters: dict[str, tuple[PayloadCodec, int, int]] = {}
+        self._compression_matcher = MQTTMatcher()
+        self._outgoing_topic_alias_maximum = 0
+        self._out_topic_aliases = _TopicAliases()
+        self._incoming_topic_alias_maximum = 0
+        self._in_topic_alias_maximum = 0
+        self._in_topic_aliases: dict[int, bytes] = {}
         self._connect_properties: Properties | None = None
         self._will_properties: Properties | None = None
         self._will = False
@@ -836,6 +1514,21 @@ class Client:
         self._will_qos = 0
         self._will_retain = False
         self._on_message_filtered = MQTTMatcher()
+        # Messages are dispatched by MQTT v5.0 Subscription Identifier
+        # while all the filters of message_callback_add() are subscribed
+        # with theirs: the identifiers of the filters, their callbacks, and
+        # the filters subscribed with their identifier.
+        self._subscription_ids: dict[str, int] = {}
+        self._subscription_id_callbacks: dict[int, CallbackOnMessage] = {}
+        self._subscription_id_bound: set[str] = set()
+        self._subscription_id_next = 0
+        # Filters subscribed with their identifier waiting for the SUBACK,
+        # by mid.
+        self._subscription_id_pending: dict[int, tuple[str, int]] = {}
+        # Whether the broker supports Subscription Identifiers, and whether
+        # the application sets its own.
+        self._subscription_ids_available = True
+        self._subscription_ids_user = False
         self._host = ""
         self._port = 1883
         self._bind_address = ""
@@ -870,6 +1563,12 @@ class Client:
         self._on_socket_close: CallbackOnSocket | None = None
         self._on_socket_register_write: CallbackOnSocket | None = None
         self._on_socket_unregister_write: CallbackOnSocket | None = None
+        # The message callbacks dispatched to, published again from
+        # _on_message, _on_message_filtered and the Subscription Identifiers
+        # by the first message dispatched after they changed.
+        self._message_callbacks = _MessageCallbacks(None, MQTTMatcher(), {}, frozenset())
+        self._message_callbacks_stale = False
+        self._on_backpressure: CallbackOnBackpressure | None = None
         self._websocket_path = "/mqtt"
         self._websocket_extra_headers: WebSocketHeaders | None = None
         # for clean_start == MQTT_CLEAN_START_FIRST_ONLY
@@ -1023,7 +1722,10 @@ class Client:
     @property
     def max_inflight_messages(self) -> int:
         """
-        Maximum number of messages with QoS > 0 that can be partway through the network flow at once
+        Maximum number of messages with QoS > 0 that can be partway through the network flow at once,
+        0 means unlimited
+
+        With MQTT v5.0 the broker's Receive Maximum may lower it, see `inflight_window`.
 
         This property may not be changed if the connection is already open.
         """
@@ -1040,6 +1742,38 @@ class Client:
             raise ValueError("Invalid inflight.")
 
         self._max_inflight_messages = value
+        self._inflight_window = value
+        if self._inflight_control is not None:
+            self._inflight_window = self._inflight_control.reset(value)
+
+    @property
+    def inflight_window(self) -> int:
+        """
+        Maximum number of messages with QoS > 0 that can actually be partway
+        through the network flow at once, 0 means unlimited.
+
+        This is `max_inflight_messages`, except with MQTT v5.0 where it is
+        limited by the Receive Maximum sent by the broker in CONNACK, or
+        equal to it if `max_inflight_messages` is 0. With
+        `adaptive_inflight_set()`, it changes within those limits.
+        """
+        return self._inflight_window
+
+    @property
+    def max_packet_size(self) -> int:
+        """
+        Maximum size in bytes of the packets the broker accepts, 0 if
+        unlimited.
+
+        With MQTT v5.0 this is the Maximum Packet Size sent by the broker in
+        CONNACK. Messages larger than that are not sent: `publish()` returns
+        MQTT_ERR_PAYLOAD_SIZE, and messages with QoS > 0 stored before the
+        connection are dropped with that rc, instead of the broker closing
+        the connection.
+
+        This property is read-only.
+        """
+        return self._max_packet_size
 
     @property
     def max_queued_messages(self) -> int:
@@ -1061,6 +1795,63 @@ class Client:
 
         self._max_queued_messages = value
 
+    @property
+    def outgoing_topic_alias_maximum(self) -> int:
+        """
+        Maximum number of topic aliases the client assigns to the topics it
+        publishes on, 0 (the default) disables automatic topic aliases.
+
+        With MQTT v5.0 a topic alias replaces the topic of a message once it
+        has been sent with the alias, which saves bandwidth when long topics
+        are published to repeatedly. The number of aliases actually used is
+        limited by the Topic Alias Maximum sent by the broker in CONNACK. When
+        all of them are used, the alias of the least recently published topic
+        is reassigned. The aliases are forgotten on reconnection.
+
+        Messages that already have a TopicAlias property are sent unchanged,
+        automatic and manual topic aliases shouldn't be mixed.
+
+        This property may not be changed if the connection is already open.
+        """
+        return self._outgoing_topic_alias_maximum
+
+    @outgoing_topic_alias_maximum.setter
+    def outgoing_topic_alias_maximum(self, value: int) -> None:
+        if not self._connection_closed():
+            raise RuntimeError("updating outgoing_topic_alias_maximum on established connection is not supported")
+
+        if value < 0 or value > 65535:
+            raise ValueError("Invalid topic alias maximum.")
+
+        self._outgoing_topic_alias_maximum = value
+
+    @property
+    def incoming_topic_alias_maximum(self) -> int:
+        """
+        Maximum number of topic aliases the broker may use in the messages
+        it sends to the client, 0 (the default) if the broker may not use them.
+
+        With MQTT v5.0 this is advertised to the broker as the Topic Alias
+        Maximum of the CONNECT packet, unless the connect properties already
+        contain one, in which case that value is used instead. Topic aliases
+        of received messages are resolved before the message is delivered,
+        so :py:attr:`MQTTMessage.topic` is always the full topic. The aliases
+        are forgotten on reconnection.
+
+        This property may not be changed if the connection is already open.
+        """
+        return self._incoming_topic_alias_maximum
+
+    @incoming_topic_alias_maximum.setter
+    def incoming_topic_alias_maximum(self, value: int) -> None:
+        if not self._connection_closed():
+            raise RuntimeError("updating incoming_topic_alias_maximum on established connection is not supported")
+
+        if value < 0 or value > 65535:
+            raise ValueError("Invalid topic alias maximum.")
+
+        self._incoming_topic_alias_maximum = value
+
     @property
     def will_topic(self) -> str | None:
         """
@@ -1082,6 +1873,25 @@ class Client:
         """
         return self._will_payload
 
+    @property
+    def payload_memoryview(self) -> bool:
+        """If True, the payload of received messages is a read-only memoryview
+        over the received packet instead of a copy of it as bytes.
+
+        This avoids copying large payloads. The view stays valid for as long
+        as a reference to it is kept, but code that needs `bytes` (for
+        example to use it as a dict key or to call ``.decode()``) must convert
+        it with ``bytes(msg.payload)``. `MQTTMessage.payload` is annotated as
+        ``bytes | memoryview`` for this reason.
+
+        Defaults to False.
+        """
+        return self._payload_memoryview
+
+    @payload_memoryview.setter
+    def payload_memoryview(self, value: bool) -> None:
+        self._payload_memoryview = value
+
     @property
     def logger(self) -> logging.Logger | None:
         return self._logger
@@ -1105,6 +1915,21 @@ class Client:
                 MQTT_LOG_DEBUG, "socket was None: %s", err)
             raise ConnectionError() from err
 
+    def _sock_recv_into(self, buffer: memoryview) -> int:
+        if self._sock is None:
+            raise ConnectionError("self._sock is None")
+        try:
+            return self._sock.recv_into(buffer, len(buffer))
+        except ssl.SSLWantReadError as err:
+            raise BlockingIOError() from err
+        except ssl.SSLWantWriteError as err:
+            self._call_socket_register_write()
+            raise BlockingIOError() from err
+        except AttributeError as err:
+            self._easy_log(
+                MQTT_LOG_DEBUG, "socket was None: %s", err)
+            raise ConnectionError() from err
+
     def _sock_send(self, buf: bytes) -> int:
         if self._sock is None:
             raise ConnectionError("self._sock is None")
@@ -1120,6 +1945,34 @@ class Client:
             self._call_socket_register_write()
             raise BlockingIOError() from err
 
+    def _sock_sendv(self, buffers: list[memoryview]) -> int:
+        """Send as much as possible of the concatenation of buffers."""
+        if self._sock is None:
+            raise ConnectionError("self._sock is None")
+
+        if len(buffers) == 1:
+            return self._sock_send(buffers[0])  # type: ignore[arg-type]
+
+        if _HAVE_SENDMSG and type(self._sock) is socket.socket:
+            # Plain sockets can write all buffers with a single system call.
+            try:
+                return self._sock.sendmsg(buffers)
+            except BlockingIOError as err:
+                self._call_socket_register_write()
+                raise BlockingIOError() from err
+
+        # TLS and WebSocket connections frame the data they are given, so
+        # join the buffers to write them as one record/frame. Buffers that
+        # would make that copy too large are left for the next call.
+        size = len(buffers[0])
+        count = 1
+        while count < len(buffers) and size + len(buffers[count]) <= _WRITE_BATCH_SIZE:
+            size += len(buffers[count])
+            count += 1
+        if count == 1:
+            return self._sock_send(buffers[0])  # type: ignore[arg-type]
+        return self._sock_send(b"".join(buffers[:count]))
+
     def _sock_close(self) -> None:
         """Close the connection to the server."""
         if not self._sock:
@@ -1551,16 +2404,15 @@ class Client:
         if self._port <= 0:
             raise ValueError('Invalid port number.')
 
-        self._in_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": bytearray(b""),
-            "to_process": 0,
-            "pos": 0,
-        }
+        self._in_packet_reset()
+        self._in_buffer_pos = 0
+        self._in_buffer_end = 0
+        self._out_topic_aliases.reset(0)
+        self._in_topic_aliases.clear()
+        self._inflight_window = self._max_inflight_messages
+        if self._inflight_control is not None:
+            self._inflight_window = self._inflight_control.reset(self._inflight_window)
+        self._max_packet_size = 0
 
         self._ping_t = 0.0
         self._state = _ConnectionState.MQTT_CS_CONNECTING
@@ -1570,11 +2422,15 @@ class Client:
         # Mark all currently outgoing QoS = 0 packets as lost,
         # or `wait_for_publish()` could hang forever
         for pkt in self._out_packet:
-            if pkt["command"] & 0xF0 == PUBLISH and pkt["qos"] == 0 and pkt["info"] is not None:
-                pkt["info"].rc = MQTT_ERR_CONN_LOST
-                pkt["info"]._set_as_published()
+            if pkt.command & 0xF0 == PUBLISH and pkt.qos == 0:
+                if pkt.info is not None:
+                    pkt.info.rc = MQTT_ERR_CONN_LOST
+                    pkt.info._set_as_published()
+                if self._max_queued_bytes > 0:
+                    self._queued_bytes_remove(len(pkt.payload))
 
         self._out_packet.clear()
+        self._rate_limit_until = 0.0
 
         with self._msgtime_mutex:
             self._last_msg_in = time_func()
@@ -1630,7 +2486,8 @@ class Client:
 
         if self._sockpairR is None or self._sockpairW is None:
             self._reset_sockets(sockpair_only=True)
-            self._sockpairR, self._sockpairW = _socketpair_compat()
+            self._sockpairR, self._sockpairW = _wakeup_socketpair()
+            self._sockpair_pending = False
 
         return self._loop(timeout)
 
@@ -1651,9 +2508,15 @@ class Client:
         # if bytes are pending do not wait in select
         if pending_bytes > 0:
             timeout = 0.0
+        elif self._rate_limit_until:
+            # Wake up when the message held back by the rate limit may be
+            # written.
+            timeout = min(timeout, max(self._rate_limit_until - time_func(), 0.0))
 
         # sockpairR is used to break out of select() before the timeout, on a
-        # call to publish() etc.
+        # call to publish() etc. The socket is None once the connection is
+        # lost, then select() raises TypeError.
+        rlist: list[Any]
         if self._sockpairR is None:
             rlist = [self._sock]
         else:
@@ -1691,13 +2554,7 @@ class Client:
             # Stimulate output write even though we didn't ask for it, because
             # at that point the publish or other command wasn't present.
             socklist[1].insert(0, self._sock)
-            # Clear sockpairR - only ever a single byte written.
-            try:
-                # Read many bytes at once - this allows up to 10000 calls to
-                # publish() inbetween calls to loop().
-                self._sockpairR.recv(10000)
-            except BlockingIOError:
-                pass
+            self._sockpair_drain()
 
         if self._sock in socklist[1]:
             rc = self.loop_write()
@@ -1713,6 +2570,7 @@ class Client:
         qos: int = 0,
         retain: bool = False,
         properties: Properties | None = None,
+        priority: int = PublishPriority.NORMAL,
     ) -> MQTTMessageInfo:
         """Publish a message on a topic.
 
@@ -1729,6 +2587,14 @@ class Client:
         :param bool retain: If set to true, the message will be set as the "last known
             good"/retained message for the topic.
         :param Properties properties: (MQTT v5.0 only) the MQTT v5.0 properties to be included.
+        :param PublishPriority priority: The priority of the message over the
+            other packets waiting to be sent. Messages of higher priority are
+            written to the network first, messages of the same priority are
+            written in order. Acknowledgements and PINGREQ are always written
+            before any message. The priority is ignored when the topic alias
+            is set automatically, see `outgoing_topic_alias_maximum`. QoS 1
+            and 2 messages waiting for a free inflight slot get one in order,
+            whatever their priority.
 
         Returns a `MQTTMessageInfo` class, which can be used to determine whether
         the message has been delivered (using `is_published()`) or to block
@@ -1749,6 +2615,7 @@ class Client:
             invalid (contains a wildcard), except if the MQTT version used is v5.0.
             For v5.0, a zero length topic can be used when a Topic Alias has been set.
         :raises ValueError: if qos is not one of 0, 1 or 2
+        :raises ValueError: if priority is not a `PublishPriority`
         :raises ValueError: if the length of the payload is greater than 268435455 bytes.
         """
         if self._protocol != MQTTv5:
@@ -1762,6 +2629,9 @@ class Client:
         if qos < 0 or qos > 2:
             raise ValueError('Invalid QoS level.')
 
+        if priority not in _PUBLISH_LANES:
+            raise ValueError('Invalid priority.')
+
         local_payload = _encode_payload(payload)
 
         if len(local_payload) > 268435455:
@@ -1769,10 +2639,192 @@ class Client:
 
         local_mid = self._mid_generate()
 
+        return self._publish(local_mid, topic_bytes, local_payload, qos, retain, properties, priority=priority)
+
+    def publish_many(
+        self,
+        msgs: Iterable[PublishMessageDict | PublishMessageTuple],
+    ) -> list[MQTTMessageInfo]:
+        """Publish several messages at once.
+
+        This is equivalent to calling `publish()` for each message in turn,
+        but the messages are validated, given their message ID and queued as
+        one batch, and the network loop is only woken up once for all of them.
+
+        :param msgs: the messages to publish. Each message is either a dict
+            with the keyword arguments of `publish()`, of which only "topic" is
+            required::
+
+                {"topic": "<topic>", "payload": "<payload>", "qos": <qos>,
+                 "retain": <retain>, "properties": <properties>,
+                 "priority": <priority>}
+
+            or a tuple of the positional arguments of `publish()`, of which
+            all but the topic may be omitted::
+
+                ("<topic>", "<payload>", qos, retain, properties, priority)
+
+        Returns a list with the `MQTTMessageInfo` of each message, in the
+        same order as msgs. If the queue is full, see `max_queued_bytes_set()`,
+        none of the messages is published: their rc is MQTT_ERR_QUEUE_SIZE and
+        their mid 0, as no message ID is used.
+
+        :raises ValueError: under the same conditions as `publish()`, in which
+            case none of the messages is published.
+        :raises TypeError: if a message is neither a dict nor a tuple.
+        """
+        batch = []
+        topics: dict[str, bytes] = {}
+        topic: str
+        payload: PayloadType
+        qos: int
+        retain: bool
+        properties: Properties | None
+        priority: int
+        for msg in msgs:
+            if isinstance(msg, (tuple, list)):
+                # Padded with the default values of the missing items.
+                if len(msg) > len(_PUBLISH_DEFAULTS):
+                    raise TypeError('message has too many items')
+                topic, payload, qos, retain, properties, priority = cast(
+                    "tuple[str, PayloadType, int, bool, Properties | None, int]",
+                    tuple(msg) + _PUBLISH_DEFAULTS[len(msg):],
+                )
+            elif isinstance(msg, dict):
+                topic = msg["topic"]
+                payload = msg.get("payload")
+                qos = msg.get("qos", 0)
+                retain = msg.get("retain", False)
+                properties = msg.get("properties")
+                priority = msg.get("priority", PublishPriority.NORMAL)
+            else:
+                raise TypeError('message must be a dict, tuple, or list')
+
+            # Most batches repeat a few topics, only validate them once.
+            topic_bytes = topics.get(topic)
+            if topic_bytes is None:
+                if self._protocol != MQTTv5 and (topic is None or len(topic) == 0):
+                    raise ValueError('Invalid topic.')
+                topic_bytes = topic.encode('utf-8')
+                self._raise_for_invalid_topic(topic_bytes)
+                topics[topic] = topic_bytes
+
+            if qos < 0 or qos > 2:
+                raise ValueError('Invalid QoS level.')
+
+            if priority not in _PUBLISH_LANES:
+                raise ValueError('Invalid priority.')
+
+            local_payload = _encode_payload(payload)
+
+            if len(local_payload) > 268435455:
+                raise ValueError('Payload too large.')
+
+            batch.append((topic_bytes, local_payload, qos, retain, properties, priority))
+
+        if not batch:
+            return []
+
+        # The whole batch is accepted if the queue accepts messages.
+        if self._max_queued_bytes > 0 and not self._queued_bytes_wait():
+            infos = [MQTTMessageInfo(0) for _ in batch]
+            for info in infos:
+                info.rc = MQTTErrorCode.MQTT_ERR_QUEUE_SIZE
+            return infos
+
+        mids = self._mid_generate_many(len(batch))
+
+        with self._out_message_mutex:
+            infos = [
+                self._publish(
+                    mid, topic_bytes, local_payload, qos, retain, properties, wakeup=False, check_queued_bytes=False,
+                    priority=priority)
+                for mid, (topic_bytes, local_payload, qos, retain, properties, priority) in zip(mids, batch)
+            ]
+
+        if self._out_packet:
+            rc = self._packet_queue_wakeup()
+            if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
+                for info in infos:
+                    if info.rc == MQTTErrorCode.MQTT_ERR_SUCCESS:
+                        info.rc = rc
+        return infos
+
+    def publisher(
+        self,
+        topic: str,
+        qos: int = 0,
+        retain: bool = False,
+        properties: Properties | None = None,
+        priority: int = PublishPriority.NORMAL,
+    ) -> TopicPublisher:
+        """Return a `TopicPublisher` to publish messages on a topic.
+
+        The topic is validated and encoded, and the properties packed, once
+        when the publisher is created instead of on every `publish()` call.
+        This is useful when the same topics are published to very often.
+
+        :param str topic: The topic that the messages should be published on.
+        :param int qos: The quality of service level to use.
+        :param bool retain: If set to true, the messages will be set as the
+            "last known good"/retained message for the topic.
+        :param Properties properties: (MQTT v5.0 only) the MQTT v5.0 properties
+            to be included. Changing them after the publisher is created has
+            no effect on its messages.
+        :param PublishPriority priority: The priority of the messages, as for
+            `publish()`.
+
+        :raises ValueError: under the same conditions as `publish()`.
+        """
+        return TopicPublisher(self, topic, qos, retain, properties, priority)
+
+    def _publish(
+        self,
+        local_mid: int,
+        topic_bytes: bytes,
+        local_payload: bytes,
+        qos: int,
+        retain: bool,
+        properties: Properties | None,
+        wakeup: bool = True,
+        publisher: TopicPublisher | None = None,
+        check_queued_bytes: bool = True,
+        priority: int = PublishPriority.NORMAL,
+    ) -> MQTTMessageInfo:
+        if self._compression_filters and local_payload:
+            local_payload, compressed_properties = self._payload_compress(topic_bytes, local_payload, properties)
+            if compressed_properties is not properties:
+                # The packed properties of the publisher lack the codec.
+                properties = compressed_properties
+                publisher = None
+
+        packed_properties = None
+        if self._max_packet_size > 0:
+            # Packed once, for the size and the packet.
+            if publisher is not None:
+                packed_properties = publisher._packed_properties
+            elif self._protocol == MQTTv5 and properties is not None:
+                packed_properties = properties.pack()
+            size = self._publish_packet_size(topic_bytes, len(local_payload), qos, properties, packed_properties)
+            if size > self._max_packet_size:
+                self._easy_log(
+                    MQTT_LOG_WARNING,
+                    "Not publishing message (m%d) on '%s': packet of %d bytes, the broker accepts at most %d",
+                    local_mid, topic_bytes.decode('utf-8'), size, self._max_packet_size)
+                info = MQTTMessageInfo(local_mid)
+                info.rc = MQTTErrorCode.MQTT_ERR_PAYLOAD_SIZE
+                return info
+
+        if check_queued_bytes and self._max_queued_bytes > 0 and not self._queued_bytes_wait():
+            info = MQTTMessageInfo(local_mid)
+            info.rc = MQTTErrorCode.MQTT_ERR_QUEUE_SIZE
+            return info
+
         if qos == 0:
             info = MQTTMessageInfo(local_mid)
             rc = self._send_publish(
-                local_mid, topic_bytes, local_payload, qos, retain, False, info, properties)
+                local_mid, topic_bytes, local_payload, qos, retain, False, info, properties, wakeup, publisher,
+                priority, packed_properties)
             info.rc = rc
             return info
         else:
@@ -1783,6 +2835,7 @@ class Client:
             message.retain = retain
             message.dup = False
             message.properties = properties
+            message._priority = priority
 
             with self._out_message_mutex:
                 if self._max_queued_messages > 0 and len(self._out_messages) >= self._max_queued_messages:
@@ -1794,7 +2847,9 @@ class Client:
                     return message.info
 
                 self._out_messages[message.mid] = message
-                if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
+                if self._max_queued_bytes > 0:
+                    self._queued_bytes_add(len(local_payload))
+                if self._inflight_window == 0 or self._inflight_messages < self._inflight_window:
                     self._inflight_messages += 1
                     if qos == 1:
                         message.state = mqtt_ms_wait_for_puback
@@ -1802,7 +2857,8 @@ class Client:
                         message.state = mqtt_ms_wait_for_pubrec
 
                     rc = self._send_publish(message.mid, topic_bytes, message.payload, message.qos, message.retain,
-                                            message.dup, message.info, message.properties)
+                                            message.dup, message.info, message.properties, wakeup, publisher,
+                                            priority, packed_properties)
 
                     # remove from inflight messages so it will be send after a connection is made
                     if rc == MQTTErrorCode.MQTT_ERR_NO_CONN:
@@ -1813,9 +2869,56 @@ class Client:
                     return message.info
                 else:
                     message.state = mqtt_ms_queued
+                    self._out_queued_mids.append(message.mid)
                     message.info.rc = MQTTErrorCode.MQTT_ERR_SUCCESS
                     return message.info
 
+    def _publish_packet_size(
+        self,
+        topic: bytes,
+        payloadlen: int,
+        qos: int,
+        properties: Properties | None,
+        packed_properties: bytes | None = None,
+    ) -> int:
+        """Return the size of a PUBLISH packet. When the topic alias is set
+        automatically, this is an upper bound, with both the topic and the
+        alias. packed_properties are the properties if already packed."""
+        remaining_length = 2 + len(topic) + payloadlen
+        if qos > 0:
+            remaining_length += 2
+        if self._protocol == MQTTv5:
+            if properties is None:
+                remaining_length += 1
+            else:
+                if packed_properties is None:
+                    packed_properties = properties.pack()
+                remaining_length += len(packed_properties)
+                if hasattr(properties, "TopicAlias"):
+                    return 1 + _remaining_length_size(remaining_length) + remaining_length
+            if self._out_topic_aliases.maximum > 0 and topic:
+                # The Topic Alias property, and maybe a longer properties length
+                remaining_length += 4
+        return 1 + _remaining_length_size(remaining_length) + remaining_length
+
+    def _messages_drop_oversize(self) -> None:
+        """Drop the stored messages larger than the broker accepts, except
+        those the broker already received."""
+        for m in list(self._out_messages.values()):
+            if m.state not in (mqtt_ms_publish, mqtt_ms_queued):
+                continue
+            if self._publish_packet_size(m._topic, len(m.payload), m.qos, m.properties) <= self._max_packet_size:
+                continue
+            self._easy_log(
+                MQTT_LOG_WARNING,
+                "Dropping message (m%d) on '%s': larger than the broker accepts (%d bytes)",
+                m.mid, m.topic, self._max_packet_size)
+            del self._out_messages[m.mid]
+            m.info.rc = MQTTErrorCode.MQTT_ERR_PAYLOAD_SIZE
+            m.info._set_as_published()
+            if self._max_queued_bytes > 0:
+                self._queued_bytes_remove(len(m.payload))
+
     def username_pw_set(
         self, username: str | None, password: str | None = None
     ) -> None:
@@ -2035,7 +3138,31 @@ class Client:
         if self._sock is None:
             return (MQTT_ERR_NO_CONN, None)
 
-        return self._send_subscribe(False, topic_qos_list, properties)
+        binding = None
+        if self._protocol == MQTTv5:
+            if properties is not None and hasattr(properties, "SubscriptionIdentifier"):
+                # They could be the identifiers given to the callbacks, whose
+                # messages would then be dispatched to the wrong callback.
+                self._subscription_ids_disable()
+            else:
+                if len(topic_qos_list) == 1:
+                    properties, binding = self._subscription_id_bind(topic_qos_list[0][0].decode('utf-8'), properties)
+                if binding is None:
+                    # The subscriptions replace any made with an identifier.
+                    self._subscription_id_unbind([t.decode('utf-8') for t, _ in topic_qos_list])
+
+        if binding is None:
+            return self._send_subscribe(False, topic_qos_list, properties)
+
+        # The SUBACK may be handled before _send_subscribe() returns
+        with self._callback_mutex:
+            mid = self._mid_generate()
+            self._subscription_id_pending[mid] = binding
+        rc, mid = self._send_subscribe(False, topic_qos_list, properties, mid)
+        if rc != MQTT_ERR_SUCCESS:
+            with self._callback_mutex:
+                self._subscription_id_pending.pop(mid, None)
+        return (rc, mid)
 
     def unsubscribe(
         self, topic: str | list[str], properties: Properties | None = None
@@ -2077,6 +3204,8 @@ class Client:
         if self._sock is None:
             return (MQTTErrorCode.MQTT_ERR_NO_CONN, None)
 
+        self._subscription_id_unbind([t.decode('utf-8') for t in topic_list])
+
         return self._send_unsubscribe(False, topic_list, properties)
 
     def loop_read(self, max_packets: int = 1) -> MQTTErrorCode:
@@ -2087,6 +3216,7 @@ class Client:
         on.
 
         Do not use if you are using `loop_start()` or `loop_forever()`."""
+        self._network_thread = threading.current_thread()
         if self._sock is None:
             return MQTTErrorCode.MQTT_ERR_NO_CONN
 
@@ -2102,6 +3232,15 @@ class Client:
                 return self._loop_rc_handle(rc)
             elif rc == MQTTErrorCode.MQTT_ERR_AGAIN:
                 return MQTTErrorCode.MQTT_ERR_SUCCESS
+
+        # select() won't report packets that were already read from the
+        # socket, so handle everything left in the buffer before returning.
+        while self._sock is not None:
+            rc = self._packet_read(recv=False)
+            if rc > 0:
+                return self._loop_rc_handle(rc)
+            elif rc == MQTTErrorCode.MQTT_ERR_AGAIN:
+                break
         return MQTTErrorCode.MQTT_ERR_SUCCESS
 
     def loop_write(self) -> MQTTErrorCode:
@@ -2134,20 +3273,34 @@ class Client:
     def want_write(self) -> bool:
         """Call to determine if there is network data waiting to be written.
         Useful if you are calling select() yourself rather than using `loop()`, `loop_start()` or `loop_forever()`.
+
+        While the next message is held back by the rate limit, see
+        `rate_limit_set()`, this returns False until it may be written,
+        unless other packets, such as acknowledgements, are queued.
         """
-        return len(self._out_packet) > 0
+        if not self._out_packet:
+            return False
+        if self._rate_limit_until and time_func() < self._rate_limit_until and not self._out_packet.has_front():
+            packet = self._out_packet.peek()
+            return (packet.command & 0xF0) != PUBLISH or self._out_packet.has_control()
+        return True
 
     def loop_misc(self) -> MQTTErrorCode:
         """Process miscellaneous network events. Use in place of calling `loop()` if you
         wish to call select() or equivalent on.
 
         Do not use if you are using `loop_start()` or `loop_forever()`."""
+        self._network_thread = threading.current_thread()
         if self._sock is None:
             return MQTTErrorCode.MQTT_ERR_NO_CONN
 
         now = time_func()
         self._check_keepalive()
 
+        if self._rate_limit_until and now >= self._rate_limit_until and self.want_write():
+            # The message held back by the rate limit may now be written.
+            self._call_socket_register_write()
+
         if self._ping_t > 0 and now - self._ping_t >= self._keepalive:
             # client->ping_t != 0 means we are waiting for a pingresp.
             # This hasn't happened in the keepalive time so we should disconnect.
@@ -2157,30 +3310,395 @@ class Client:
                 self._state = _ConnectionState.MQTT_CS_DISCONNECTED
                 rc = MQTTErrorCode.MQTT_ERR_SUCCESS
             else:
-                self._state = _ConnectionState.MQTT_CS_CONNECTION_LOST
-                rc = MQTTErrorCode.MQTT_ERR_KEEPALIVE
+                self._state = _ConnectionState.MQTT_CS_CONNECTION_LOST
+                rc = MQTTErrorCode.MQTT_ERR_KEEPALIVE
+
+            self._do_on_disconnect(
+                packet_from_broker=False,
+                v1_rc=rc,
+            )
+
+            return MQTTErrorCode.MQTT_ERR_CONN_LOST
+
+        return MQTTErrorCode.MQTT_ERR_SUCCESS
+
+    def max_inflight_messages_set(self, inflight: int) -> None:
+        """Set the maximum number of messages with QoS>0 that can be part way
+        through their network flow at once. Defaults to 20.
+
+        With MQTT v5.0 the broker's Receive Maximum may lower it, or set it
+        if inflight is 0. See `inflight_window`."""
+        self.max_inflight_messages = inflight
+
+    def adaptive_inflight_set(self, enabled: bool = True, min_inflight: int = 1, latency_factor: float = 2.0) -> None:
+        """Adapt the number of messages with QoS>0 in flight to the broker.
+
+        When enabled, the window of messages in flight starts at
+        min_inflight on every connection. It grows by one message each time
+        a full window is acknowledged, up to `max_inflight_messages` and the
+        broker's Receive Maximum. It is halved, down to min_inflight, when a
+        PUBACK or PUBCOMP comes more than latency_factor times slower than
+        the fastest one, or when the broker reports its quota exceeded.
+        The current window is `inflight_window`.
+
+        This may not be changed if the connection is already open.
+        """
+        if not self._connection_closed():
+            raise RuntimeError("updating adaptive inflight on established connection is not supported")
+
+        if not enabled:
+            self._inflight_control = None
+            self._inflight_window = self._max_inflight_messages
+            return
+
+        if min_inflight < 1:
+            raise ValueError("Invalid minimum inflight.")
+        if latency_factor <= 1.0:
+            raise ValueError("Invalid latency factor.")
+
+        self._inflight_control = _InflightControl(min_inflight, latency_factor)
+        self._inflight_window = self._inflight_control.reset(self._max_inflight_messages)
+
+    def max_queued_messages_set(self, queue_size: int) -> Client:
+        """Set the maximum number of messages in the outgoing message queue.
+        0 means unlimited."""
+        if not isinstance(queue_size, int):
+            raise ValueError('Invalid type of queue size.')
+        self.max_queued_messages = queue_size
+        return self
+
+    def max_queued_bytes_set(
+        self,
+        queued_bytes: int,
+        low_watermark: int | None = None,
+        block: bool = False,
+        timeout: float | None = None,
+    ) -> Client:
+        """Limit the payload bytes of the outgoing messages held by the client.
+        0 means unlimited, which is the default.
+
+        The payloads counted are those of messages with QoS>0 until they are
+        acknowledged, and those of messages with QoS 0 until they are written
+        to the socket. Once they reach queued_bytes, `on_backpressure` is
+        called with high set to True and no more messages are accepted until
+        they fall back to low_watermark (half of queued_bytes by default),
+        when `on_backpressure` is called with high set to False.
+
+        While no more messages are accepted, `publish()` returns
+        MQTT_ERR_QUEUE_SIZE, unless block is True. Then it waits until
+        messages are accepted again, and raises `queue.Full` if this takes
+        longer than timeout seconds. It never waits in the thread running the
+        network loop, whether started by `loop_start()`, `loop_forever()` or
+        `loop()`, or driven with `loop_read()` and `loop_misc()`, including
+        in the callbacks: there publish() returns MQTT_ERR_QUEUE_SIZE.
+
+        This may not be changed if the connection is already open.
+        """
+        if not self._connection_closed():
+            raise RuntimeError("updating max_queued_bytes on established connection is not supported")
+        if queued_bytes < 0:
+            raise ValueError("Invalid queue size.")
+        if low_watermark is None:
+            low_watermark = queued_bytes // 2
+        if low_watermark < 0 or (queued_bytes > 0 and low_watermark >= queued_bytes):
+            raise ValueError("Invalid low watermark.")
+
+        with self._queued_bytes_condition:
+            self._max_queued_bytes = queued_bytes
+            self._queued_bytes_low = low_watermark
+            self._queued_bytes_block = block
+            self._queued_bytes_timeout = timeout
+            # Messages may have been published before the connection.
+            self._queued_bytes = sum(len(m.payload) for m in self._out_messages.values()) + sum(
+                len(p.payload) for p in self._out_packet if p.command & 0xF0 == PUBLISH and p.qos == 0
+            )
+            self._queued_bytes_high = 0 < queued_bytes <= self._queued_bytes
+            self._queued_bytes_condition.notify_all()
+        return self
+
+    @property
+    def queued_bytes(self) -> int:
+        """
+        Payload bytes of the outgoing messages held by the client, as limited
+        by `max_queued_bytes_set()`. Always 0 if there is no limit.
+        """
+        return self._queued_bytes
+
+    def _queued_bytes_add(self, length: int) -> None:
+        with self._queued_bytes_condition:
+            self._queued_bytes += length
+            if self._queued_bytes_high or self._queued_bytes < self._max_queued_bytes:
+                return
+            self._queued_bytes_high = True
+        self._call_backpressure(True)
+
+    def _queued_bytes_remove(self, length: int) -> None:
+        with self._queued_bytes_condition:
+            self._queued_bytes -= length
+            if not self._queued_bytes_high or self._queued_bytes > self._queued_bytes_low:
+                return
+            self._queued_bytes_high = False
+            self._queued_bytes_condition.notify_all()
+        self._call_backpressure(False)
+
+    def _queued_bytes_wait(self) -> bool:
+        """Return whether new messages are accepted, after waiting for it
+        if publish() blocks."""
+        with self._queued_bytes_condition:
+            if not self._queued_bytes_high:
+                return True
+            if not self._queued_bytes_block or threading.current_thread() == self._network_thread:
+                return False
+            if not self._queued_bytes_condition.wait_for(
+                lambda: not self._queued_bytes_high, self._queued_bytes_timeout,
+            ):
+                raise queue.Full
+            return True
+
+    def rate_limit_set(
+        self,
+        messages_per_second: float = 0,
+        bytes_per_second: float = 0,
+        burst_messages: float | None = None,
+        burst_bytes: float | None = None,
+    ) -> None:
+        """Limit the rate at which messages are published. 0 means unlimited,
+        which is the default.
+
+        Messages over the limit are not refused: they stay queued and are
+        written to the network as soon as the limit allows it, without
+        blocking the network loop or the other packets: acknowledgements,
+        PINGREQ, SUBSCRIBE, DISCONNECT and the other packets are still written
+        while messages are held back.
+        The time each message was held back as the next message to publish
+        is available as
+        :py:attr:`info.rate_limit_wait <MQTTMessageInfo.rate_limit_wait>`.
+
+        :param float messages_per_second: the maximum number of messages
+            published per second.
+        :param float bytes_per_second: the maximum number of bytes of the
+            PUBLISH packets written per second.
+        :param float burst_messages: the number of messages which may be
+            published at once after a pause. Defaults to one second of
+            messages_per_second, and at least one message.
+        :param float burst_bytes: the number of bytes which may be written at
+            once after a pause. Defaults to one second of bytes_per_second.
+            A message larger than that is written when the limit allowed
+            burst_bytes, and delays the following ones.
+
+        The limit may be changed at any time.
+        """
+        if messages_per_second < 0 or bytes_per_second < 0:
+            raise ValueError("Invalid rate.")
+        if burst_messages is None:
+            burst_messages = max(messages_per_second, 1)
+        if burst_bytes is None:
+            burst_bytes = bytes_per_second
+        if burst_messages <= 0 or (bytes_per_second > 0 and burst_bytes <= 0):
+            raise ValueError("Invalid burst.")
+
+        now = time_func()
+        self._rate_limit_messages = None
+        if messages_per_second > 0:
+            self._rate_limit_messages = _TokenBucket(messages_per_second, burst_messages, now)
+        self._rate_limit_bytes = None
+        if bytes_per_second > 0:
+            self._rate_limit_bytes = _TokenBucket(bytes_per_second, burst_bytes, now)
+
+    def _rate_limit_take(self, packet: _OutPacket) -> bool:
+        """Return whether a PUBLISH packet may be written now, and if so count
+        it in the rate."""
+        messages = self._rate_limit_messages
+        bytes_ = self._rate_limit_bytes
+        now = time_func()
+        delay = 0.0
+        if messages is not None:
+            delay = messages.delay(1, now)
+        if bytes_ is not None:
+            delay = max(delay, bytes_.delay(packet.to_process, now))
+
+        if delay > 0:
+            if not self._rate_limit_until:
+                self._rate_limit_since = now
+            self._rate_limit_until = now + delay
+            return False
+
+        if messages is not None:
+            messages.take(1)
+        if bytes_ is not None:
+            bytes_.take(packet.to_process)
+        if self._rate_limit_until:
+            self._rate_limit_until = 0.0
+            if packet.info is not None:
+                packet.info.rate_limit_wait = now - self._rate_limit_since
+            if packet.qos > 0:
+                # The round trip time starts now.
+                message = self._out_messages.get(packet.mid)
+                if message is not None:
+                    message.timestamp = now
+        return True
+
+    def compression_set(
+        self,
+        topic_filter: str,
+        codec: str | None = "zlib",
+        threshold: int = 256,
+        max_size: int = _DECOMPRESS_MAX_SIZE,
+    ) -> None:
+        """Compress the payload of the messages published on the topics
+        matching topic_filter, and decompress those received on them.
+
+        :param str topic_filter: the topic filter, which may contain wildcards.
+            If several topic filters match a topic, the longest one is used.
+        :param str codec: the name of the codec, "zlib", "bz2", "lzma" or one
+            added with `register_payload_codec()`. None stops compressing
+            the messages on topic_filter.
+        :param int threshold: with MQTT v5.0, payloads smaller than this
+            many bytes are not compressed.
+        :param int max_size: the maximum size of a decompressed payload,
+            268435455 bytes by default. Received payloads which would
+            decompress to more are not decompressed.
+
+        With MQTT v5.0, compressed messages carry a "content-encoding" user
+        property set to the name of their codec, so that receivers know how
+        to decompress them. Payloads are only compressed if this makes them
+        smaller, and never when the PayloadFormatIndicator property is set.
+        Received messages with such a user property are decompressed, and
+        the user property removed, before they are given to `on_message`.
+        The ContentType property is left alone, it describes the
+        decompressed payload.
+
+        With MQTT v3.1 and v3.1.1 messages can't tell whether they are
+        compressed, so all of them are compressed whatever their size, and
+        all received messages are decompressed with codec: publishers and
+        subscribers of the topics must agree on the codec.
+
+        Empty payloads are never compressed, since they delete retained
+        messages. Received messages that can't be decompressed are given to
+        `on_message` unchanged.
+
+        :raises ValueError: if the codec isn't registered, the threshold
+            is negative or max_size isn't positive.
+        """
+        if codec is not None and codec not in _payload_codecs:
+            raise ValueError(f"Unknown payload codec {codec}.")
+        if threshold < 0:
+            raise ValueError("Invalid threshold.")
+        if max_size <= 0:
+            raise ValueError("Invalid maximum size.")
+
+        with self._callback_mutex:
+            filters = dict(self._compression_filters)
+            if codec is None:
+                filters.pop(topic_filter, None)
+            else:
+                filters[topic_filter] = (_payload_codecs[codec], threshold, max_size)
+            matcher = MQTTMatcher()
+            for sub, setting in filters.items():
+                matcher[sub] = (sub, *setting)
+            self._compression_filters = filters
+            self._compression_matcher = matcher
+
+    def _compression_match(self, topic: str) -> tuple[str, PayloadCodec, int, int] | None:
+        """Return the compression settings of the longest filter matching topic."""
+        best = None
+        for setting in self._compression_matcher.iter_match(topic):
+            if best is None or len(setting[0]) > len(best[0]):
+                best = setting
+        return best
+
+    def _payload_compress(
+        self, topic: bytes, payload: bytes, properties: Properties | None,
+    ) -> tuple[bytes, Properties | None]:
+        try:
+            setting = self._compression_match(topic.decode('utf-8'))
+        except UnicodeDecodeError:
+            return payload, properties
+        if setting is None:
+            return payload, properties
+        _, codec, threshold, _ = setting
 
-            self._do_on_disconnect(
-                packet_from_broker=False,
-                v1_rc=rc,
-            )
+        if self._protocol != MQTTv5:
+            return codec.compress(payload), properties
+
+        if len(payload) < threshold:
+            return payload, properties
+        if properties is not None and getattr(properties, "PayloadFormatIndicator", 0) == 1:
+            return payload, properties
+        compressed = codec.compress(payload)
+        # Counting the user property naming the codec
+        if len(compressed) + 5 + len(_CONTENT_ENCODING) + len(codec.name) >= len(payload):
+            return payload, properties
+
+        # Don't change the properties of the caller.
+        if properties is None:
+            properties = Properties(PacketTypes.PUBLISH)
+        else:
+            properties = copy.copy(properties)
+        properties.UserProperty = (_CONTENT_ENCODING, codec.name)
+        return compressed, properties
 
-            return MQTTErrorCode.MQTT_ERR_CONN_LOST
+    def _payload_decompress(self, topic: str, message: MQTTMessage) -> None:
+        setting = self._compression_match(topic)
+        if setting is None:
+            return
+        _, codec, _, max_size = setting
 
-        return MQTTErrorCode.MQTT_ERR_SUCCESS
+        user_properties = None
+        if self._protocol == MQTTv5:
+            user_properties = getattr(message.properties, "UserProperty", None)
+            names = [value for key, value in user_properties or () if key == _CONTENT_ENCODING]
+            if not names:
+                return
+            named_codec = _payload_codecs.get(names[-1])
+            if named_codec is None:
+                self._easy_log(
+                    MQTT_LOG_WARNING, "Unknown payload codec %s of message on '%s'", names[-1], topic)
+                return
+            codec = named_codec
 
-    def max_inflight_messages_set(self, inflight: int) -> None:
-        """Set the maximum number of messages with QoS>0 that can be part way
-        through their network flow at once. Defaults to 20."""
-        self.max_inflight_messages = inflight
+        try:
+            payload = codec.decompress(message.payload, max_size)
+        except _DECOMPRESS_ERRORS as err:
+            self._easy_log(
+                MQTT_LOG_ERR, "Failed to decompress %s message on '%s': %s", codec.name, topic, err)
+            return
 
-    def max_queued_messages_set(self, queue_size: int) -> Client:
-        """Set the maximum number of messages in the outgoing message queue.
-        0 means unlimited."""
-        if not isinstance(queue_size, int):
-            raise ValueError('Invalid type of queue size.')
-        self.max_queued_messages = queue_size
-        return self
+        message.payload = payload
+        if user_properties is not None:
+            properties = cast(Properties, message.properties)
+            delattr(properties, "UserProperty")
+            others = [item for item in user_properties if item[0] != _CONTENT_ENCODING]
+            if others:
+                properties.UserProperty = others
+
+    def receive_buffer_set(self, chunk_size: int = _RECEIVE_CHUNK_SIZE, pool_size: int = _RECEIVE_POOL_SIZE) -> None:
+        """Configure how incoming data is read from the network.
+
+        :param int chunk_size: size of each read from the socket. A single
+            read can return several small packets, which are then handled
+            without further system calls. Packets larger than this are read
+            directly into a buffer allocated with the size of the packet.
+            Defaults to 64 KiB.
+        :param int pool_size: number of buffers of such large packets kept to
+            be reused when packets of a similar size are received. 0 disables
+            reuse. Defaults to 4.
+
+        This may not be called if the connection is already open.
+        """
+        if not self._connection_closed():
+            raise RuntimeError("updating receive buffer on established connection is not supported")
+        # The fixed header of a packet must fit in a single chunk.
+        if chunk_size < 5:
+            raise ValueError("Invalid chunk size.")
+        if pool_size < 0:
+            raise ValueError("Invalid pool size.")
+
+        self._in_buffer = bytearray(chunk_size)
+        self._in_buffer_pos = 0
+        self._in_buffer_end = 0
+        self._in_buffer_pool.max_buffers = pool_size
+        self._in_buffer_pool.clear()
 
     def user_data_set(self, userdata: Any) -> None:
         """Set the user data variable passed to callbacks. May be any data type."""
@@ -2340,7 +3858,8 @@ class Client:
         if self._thread is not None:
             return MQTTErrorCode.MQTT_ERR_INVAL
 
-        self._sockpairR, self._sockpairW = _socketpair_compat()
+        self._sockpairR, self._sockpairW = _wakeup_socketpair()
+        self._sockpair_pending = False
         self._thread_terminate = False
         self._thread = threading.Thread(target=self._thread_main, name=f"paho-mqtt-client-{self._client_id.decode()}")
         self._thread.daemon = True
@@ -2608,6 +4127,7 @@ class Client:
     def on_message(self, func: CallbackOnMessage | None) -> None:
         with self._callback_mutex:
             self._on_message = func
+            self._message_callbacks_stale = True
 
     def message_callback(
         self,
@@ -2673,6 +4193,55 @@ class Client:
             return func
         return decorator
 
+    @property
+    def on_backpressure(self) -> CallbackOnBackpressure | None:
+        """The callback called when the outgoing messages held by the client
+        reach or fall back below the limits set with `max_queued_bytes_set()`.
+
+        Expected signature (for all callback API version)::
+
+            backpressure_callback(client, userdata, high)
+
+        :param Client client: the client instance for this callback
+        :param userdata: the private user data as set in Client() or user_data_set()
+        :param bool high: True when the high watermark is reached and no more
+            messages are accepted, False when they fall back to the low
+            watermark and messages are accepted again.
+
+        It is called from the thread which published or completed the
+        message, which isn't always the network thread.
+
+        Decorator: @client.backpressure_callback() (``client`` is the name of the
+            instance which this callback is being attached to)
+        """
+        return self._on_backpressure
+
+    @on_backpressure.setter
+    def on_backpressure(self, func: CallbackOnBackpressure | None) -> None:
+        with self._callback_mutex:
+            self._on_backpressure = func
+
+    def backpressure_callback(
+        self,
+    ) -> Callable[[CallbackOnBackpressure], CallbackOnBackpressure]:
+        def decorator(func: CallbackOnBackpressure) -> CallbackOnBackpressure:
+            self.on_backpressure = func
+            return func
+        return decorator
+
+    def _call_backpressure(self, high: bool) -> None:
+        with self._callback_mutex:
+            on_backpressure = self.on_backpressure
+
+        if on_backpressure:
+            try:
+                on_backpressure(self, self._userdata, high)
+            except Exception as err:
+                self._easy_log(
+                    MQTT_LOG_ERR, 'Caught exception in on_backpressure: %s', err)
+                if not self.suppress_exceptions:
+                    raise
+
     @property
     def on_unsubscribe(self) -> CallbackOnUnsubscribe | None:
         """The callback called when the broker responds to an unsubscribe
@@ -2994,6 +4563,14 @@ class Client:
 
         See `on_message` for the expected signature of the callback.
 
+        With MQTT v5.0, 'sub' is given a Subscription Identifier, sent by
+        `subscribe()` when subscribing to 'sub' alone. While all the topic
+        specific callbacks are subscribed that way, the broker tells which
+        of them a message matches, and they are found without matching the
+        topic. Register callbacks before subscribing to benefit from it.
+        This stops once the application sets Subscription Identifiers in
+        `subscribe()` itself.
+
         Decorator: @client.topic_callback(sub) (``client`` is the name of the
             instance which this callback is being attached to)
 
@@ -3008,6 +4585,11 @@ class Client:
 
         with self._callback_mutex:
             self._on_message_filtered[sub] = callback
+            sub_id = self._subscription_ids.get(sub)
+            if sub_id is None:
+                sub_id = self._subscription_ids[sub] = self._subscription_id_generate()
+            self._subscription_id_callbacks[sub_id] = callback
+            self._message_callbacks_stale = True
 
     def topic_callback(
         self, sub: str
@@ -3024,10 +4606,13 @@ class Client:
             raise ValueError("sub must defined.")
 
         with self._callback_mutex:
-            try:
-                del self._on_message_filtered[sub]
-            except KeyError:  # no such subscription
-                pass
+            sub_id = self._subscription_ids.pop(sub, None)
+            if sub_id is None:  # no such subscription
+                return
+            del self._on_message_filtered[sub]
+            del self._subscription_id_callbacks[sub_id]
+            self._subscription_id_bound.discard(sub)
+            self._message_callbacks_stale = True
 
     # ============================================================
     # Private functions
@@ -3051,201 +4636,314 @@ class Client:
 
         return rc
 
-    def _packet_read(self) -> MQTTErrorCode:
-        # This gets called if pselect() indicates that there is network data
-        # available - ie. at least one byte.  What we do depends on what data we
-        # already have.
-        # If we've not got a command, attempt to read one and save it. This should
-        # always work because it's only a single byte.
-        # Then try to read the remaining length. This may fail because it is may
-        # be more than one byte - will need to save data pending next read if it
-        # does fail.
-        # Then try to read the remaining payload, where 'payload' here means the
-        # combined variable header and actual payload. This is the most likely to
-        # fail due to longer length, so save current data and current position.
-        # After all data is read, send to _mqtt_handle_packet() to deal with.
-        # Finally, free the memory and reset everything to starting conditions.
-        if self._in_packet['command'] == 0:
-            try:
-                command = self._sock_recv(1)
-            except BlockingIOError:
-                return MQTTErrorCode.MQTT_ERR_AGAIN
-            except TimeoutError as err:
-                self._easy_log(
-                    MQTT_LOG_ERR, 'timeout on socket: %s', err)
-                return MQTTErrorCode.MQTT_ERR_CONN_LOST
-            except OSError as err:
-                self._easy_log(
-                    MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
-                return MQTTErrorCode.MQTT_ERR_CONN_LOST
+    def _packet_read(self, recv: bool = True) -> MQTTErrorCode:
+        # This gets called if select() indicates that there is network data
+        # available - ie. at least one byte - or by loop_read() to handle
+        # packets that are already buffered.
+        # Data is read from the socket in chunks into self._in_buffer, which
+        # may then hold several packets. Each call handles exactly one packet:
+        # if the buffer doesn't contain a complete one yet, read more data (if
+        # recv is True) until it does or until the socket would block.
+        # Once the remaining length of a packet too large for self._in_buffer
+        # is known, a buffer of that size is allocated (or reused) and the
+        # rest of the packet is read directly into it.
+        # After all data is read, send to _packet_handle() to deal with.
+        # Finally, reset _in_packet to starting conditions.
+        count = 100  # Don't get stuck in this loop if we have a huge message.
+        while True:
+            if self._in_packet['have_remaining']:
+                if self._in_packet['to_process'] == 0:
+                    rc = MQTTErrorCode.MQTT_ERR_SUCCESS
+                    break
             else:
-                if len(command) == 0:
-                    return MQTTErrorCode.MQTT_ERR_CONN_LOST
-                self._in_packet['command'] = command[0]
-
-        if self._in_packet['have_remaining'] == 0:
-            # Read remaining
-            # Algorithm for decoding taken from pseudo code at
-            # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
-            while True:
-                try:
-                    byte = self._sock_recv(1)
-                except BlockingIOError:
-                    return MQTTErrorCode.MQTT_ERR_AGAIN
-                except OSError as err:
-                    self._easy_log(
-                        MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
-                    return MQTTErrorCode.MQTT_ERR_CONN_LOST
-                else:
-                    if len(byte) == 0:
-                        return MQTTErrorCode.MQTT_ERR_CONN_LOST
-                    byte_value = byte[0]
-                    self._in_packet['remaining_count'].append(byte_value)
-                    # Max 4 bytes length for remaining length as defined by protocol.
-                    # Anything more likely means a broken/malicious client.
-                    if len(self._in_packet['remaining_count']) > 4:
-                        return MQTTErrorCode.MQTT_ERR_PROTOCOL
-
-                    self._in_packet['remaining_length'] += (
-                        byte_value & 127) * self._in_packet['remaining_mult']
-                    self._in_packet['remaining_mult'] = self._in_packet['remaining_mult'] * 128
-
-                if (byte_value & 128) == 0:
+                rc = self._packet_parse()
+                if rc != MQTTErrorCode.MQTT_ERR_AGAIN:
                     break
-
-            self._in_packet['have_remaining'] = 1
-            self._in_packet['to_process'] = self._in_packet['remaining_length']
-
-        count = 100 # Don't get stuck in this loop if we have a huge message.
-        while self._in_packet['to_process'] > 0:
-            try:
-                data = self._sock_recv(self._in_packet['to_process'])
-            except BlockingIOError:
+            if not recv:
                 return MQTTErrorCode.MQTT_ERR_AGAIN
-            except OSError as err:
-                self._easy_log(
-                    MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
-                return MQTTErrorCode.MQTT_ERR_CONN_LOST
-            else:
-                if len(data) == 0:
-                    return MQTTErrorCode.MQTT_ERR_CONN_LOST
-                self._in_packet['to_process'] -= len(data)
-                self._in_packet['packet'] += data
             count -= 1
             if count == 0:
                 with self._msgtime_mutex:
                     self._last_msg_in = time_func()
                 return MQTTErrorCode.MQTT_ERR_AGAIN
 
+            rc = self._packet_fill()
+            if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
+                return rc
+
+        if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
+            return rc
+
         # All data for this packet is read.
-        self._in_packet['pos'] = 0
+        in_packet = self._in_packet
         rc = self._packet_handle()
 
-        # Free data and reset values
+        # Free data and reset values. The packet buffer may only be reused if
+        # nothing handed out to the application still refers to it.
+        if in_packet['pooled']:
+            self._in_buffer_pool.put(in_packet['packet'])
+        self._in_packet_reset()
+
+        with self._msgtime_mutex:
+            self._last_msg_in = time_func()
+        return rc
+
+    def _packet_parse(self) -> MQTTErrorCode:
+        """Extract the next packet from the receive buffer into _in_packet.
+
+        Returns MQTT_ERR_AGAIN if the buffer doesn't hold a complete packet.
+        If the packet is too large for the receive buffer, its own buffer is
+        set up in _in_packet and the rest of it must be read into it.
+        """
+        buf = self._in_buffer
+        start = self._in_buffer_pos
+        end = self._in_buffer_end
+        available = end - start
+        if available < 2:
+            return MQTTErrorCode.MQTT_ERR_AGAIN
+
+        # Decode remaining length. Max 4 bytes length for remaining length as
+        # defined by protocol. Anything more likely means a broken/malicious
+        # client.
+        remaining_length = 0
+        multiplier = 1
+        header_length = 1
+        while True:
+            if header_length > 4:
+                return MQTTErrorCode.MQTT_ERR_PROTOCOL
+            if header_length >= available:
+                return MQTTErrorCode.MQTT_ERR_AGAIN
+            byte_value = buf[start + header_length]
+            header_length += 1
+            remaining_length += (byte_value & 127) * multiplier
+            multiplier *= 128
+            if (byte_value & 128) == 0:
+                break
+
+        packet_start = start + header_length
+        packet_end = packet_start + remaining_length
+        if packet_end <= end:
+            packet = buf[packet_start:packet_end]
+            to_process = 0
+            pooled = False
+            self._in_buffer_pos = packet_end
+        elif header_length + remaining_length > len(buf):
+            # The packet will never fit in the receive buffer, move what we
+            # already have of it to a buffer of its own.
+            packet = self._in_buffer_pool.get(remaining_length)
+            received = end - packet_start
+            packet[:received] = buf[packet_start:end]
+            to_process = remaining_length - received
+            pooled = True
+            self._in_buffer_pos = end
+        else:
+            return MQTTErrorCode.MQTT_ERR_AGAIN
+
+        # The received bytes are consumed before the packet is handled, as
+        # handling it may reset the buffer (e.g. on reconnect).
+        self._in_packet = {
+            "command": buf[start],
+            "have_remaining": 1,
+            "remaining_length": remaining_length,
+            "packet": packet,
+            "to_process": to_process,
+            "pos": remaining_length - to_process,
+            "pooled": pooled,
+        }
+        if to_process > 0:
+            return MQTTErrorCode.MQTT_ERR_AGAIN
+        return MQTTErrorCode.MQTT_ERR_SUCCESS
+
+    def _packet_fill(self) -> MQTTErrorCode:
+        """Read available data from the socket, either into the buffer of
+        the large packet being received or into the receive buffer."""
+        if self._in_packet['have_remaining']:
+            view = memoryview(self._in_packet['packet'])[self._in_packet['pos']:]
+        else:
+            if self._in_buffer_pos > 0:
+                # Move the start of the next packet to the front of the buffer.
+                length = self._in_buffer_end - self._in_buffer_pos
+                if length > 0:
+                    self._in_buffer[:length] = self._in_buffer[self._in_buffer_pos:self._in_buffer_end]
+                self._in_buffer_pos = 0
+                self._in_buffer_end = length
+            view = memoryview(self._in_buffer)[self._in_buffer_end:]
+
+        try:
+            with view:
+                count = self._sock_recv_into(view)
+        except BlockingIOError:
+            return MQTTErrorCode.MQTT_ERR_AGAIN
+        except TimeoutError as err:
+            self._easy_log(
+                MQTT_LOG_ERR, 'timeout on socket: %s', err)
+            return MQTTErrorCode.MQTT_ERR_CONN_LOST
+        except OSError as err:
+            self._easy_log(
+                MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
+            return MQTTErrorCode.MQTT_ERR_CONN_LOST
+
+        if count == 0:
+            return MQTTErrorCode.MQTT_ERR_CONN_LOST
+        if self._in_packet['have_remaining']:
+            self._in_packet['pos'] += count
+            self._in_packet['to_process'] -= count
+        else:
+            self._in_buffer_end += count
+        return MQTTErrorCode.MQTT_ERR_SUCCESS
+
+    def _in_packet_reset(self) -> None:
         self._in_packet = {
             "command": 0,
             "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
             "remaining_length": 0,
             "packet": bytearray(b""),
             "to_process": 0,
             "pos": 0,
+            "pooled": False,
         }
 
-        with self._msgtime_mutex:
-            self._last_msg_in = time_func()
-        return rc
-
     def _packet_write(self) -> MQTTErrorCode:
         while True:
-            try:
-                packet = self._out_packet.popleft()
-            except IndexError:
-                return MQTTErrorCode.MQTT_ERR_SUCCESS
+            # Send as many queued packets as possible with a single call. The
+            # packets are taken off the queue while being sent, and those not
+            # completely written are put back at its front. They are sent
+            # again as they are, since TLS and WebSocket connections must be
+            # given the same data after a partial write.
+            packets = self._out_packet.popfront()
+            if not packets:
+                size = 0
+                rate_limited = self._rate_limit_messages is not None or self._rate_limit_bytes is not None
+                held = False
+                try:
+                    while len(packets) < _WRITE_BATCH_PACKETS and size < _WRITE_BATCH_SIZE:
+                        if held:
+                            packet = self._out_packet.popleft_control()
+                        else:
+                            packet = self._out_packet.peek()
+                            if (rate_limited and packet.pos == 0 and (packet.command & 0xF0) == PUBLISH
+                                    and not self._rate_limit_take(packet)):
+                                # Written by a later call, once the rate allows
+                                # it. The messages after it wait too, in order.
+                                held = True
+                                continue
+                            self._out_packet.popleft()
+                        packets.append(packet)
+                        size += packet.to_process
+                        if (packet.command & 0xF0) == DISCONNECT:
+                            # Nothing must be sent after a DISCONNECT.
+                            break
+                except IndexError:
+                    pass
+                if not packets:
+                    return MQTTErrorCode.MQTT_ERR_SUCCESS
+
+            buffers = []
+            for packet in packets:
+                buffers.extend(packet.views())
 
             try:
-                write_length = self._sock_send(
-                    packet['packet'][packet['pos']:])
+                write_length = self._sock_sendv(buffers)
             except (AttributeError, ValueError):
-                self._out_packet.appendleft(packet)
+                self._packet_write_restore(packets)
                 return MQTTErrorCode.MQTT_ERR_SUCCESS
             except BlockingIOError:
-                self._out_packet.appendleft(packet)
+                self._packet_write_restore(packets)
                 return MQTTErrorCode.MQTT_ERR_AGAIN
             except OSError as err:
-                self._out_packet.appendleft(packet)
+                self._packet_write_restore(packets)
                 self._easy_log(
                     MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
                 return MQTTErrorCode.MQTT_ERR_CONN_LOST
 
-            if write_length > 0:
-                packet['to_process'] -= write_length
-                packet['pos'] += write_length
-
-                if packet['to_process'] == 0:
-                    if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
-                        with self._callback_mutex:
-                            on_publish = self.on_publish
-
-                        if on_publish:
-                            with self._in_callback_mutex:
-                                try:
-                                    if self._callback_api_version == CallbackAPIVersion.VERSION1:
-                                        on_publish = cast(CallbackOnPublish_v1, on_publish)
-
-                                        on_publish(self, self._userdata, packet["mid"])
-                                    elif self._callback_api_version == CallbackAPIVersion.VERSION2:
-                                        on_publish = cast(CallbackOnPublish_v2, on_publish)
-
-                                        on_publish(
-                                            self,
-                                            self._userdata,
-                                            packet["mid"],
-                                            ReasonCode(PacketTypes.PUBACK),
-                                            Properties(PacketTypes.PUBACK),
-                                        )
-                                    else:
-                                        raise RuntimeError("Unsupported callback API version")
-                                except Exception as err:
-                                    self._easy_log(
-                                        MQTT_LOG_ERR, 'Caught exception in on_publish: %s', err)
-                                    if not self.suppress_exceptions:
-                                        raise
-
-                        # TODO: Something is odd here. I don't see why packet["info"] can't be None.
-                        # A packet could be produced by _handle_connack with qos=0 and no info
-                        # (around line 3645). Ignore the mypy check for now but I feel there is a bug
-                        # somewhere.
-                        packet['info']._set_as_published()  # type: ignore
-
-                    if (packet['command'] & 0xF0) == DISCONNECT:
-                        with self._msgtime_mutex:
-                            self._last_msg_out = time_func()
-
-                        self._do_on_disconnect(
-                            packet_from_broker=False,
-                            v1_rc=MQTTErrorCode.MQTT_ERR_SUCCESS,
-                        )
-                        self._sock_close()
-                        # Only change to disconnected if the disconnection was wanted
-                        # by the client (== state was disconnecting). If the broker disconnected
-                        # use unilaterally don't change the state and client may reconnect.
-                        if self._state == _ConnectionState.MQTT_CS_DISCONNECTING:
-                            self._state = _ConnectionState.MQTT_CS_DISCONNECTED
-                        return MQTTErrorCode.MQTT_ERR_SUCCESS
-
-                else:
-                    # We haven't finished with this packet
-                    self._out_packet.appendleft(packet)
-            else:
+            if write_length == 0:
+                self._packet_write_restore(packets)
                 break
 
+            for i, packet in enumerate(packets):
+                length = min(write_length, packet.to_process)
+                packet.to_process -= length
+                packet.pos += length
+                write_length -= length
+
+                if packet.to_process > 0:
+                    # We haven't finished with this packet, nor the ones
+                    # after it.
+                    self._packet_write_restore(packets[i:])
+                    break
+
+                if self._packet_written(packet):
+                    return MQTTErrorCode.MQTT_ERR_SUCCESS
+
         with self._msgtime_mutex:
             self._last_msg_out = time_func()
 
         return MQTTErrorCode.MQTT_ERR_SUCCESS
 
+    def _packet_write_restore(self, packets: list[_OutPacket]) -> None:
+        """Put packets not completely written back at the front of the queue,
+        still counted in the rate limit."""
+        self._out_packet.extendleft(reversed(packets))
+
+    def _packet_written(self, packet: _OutPacket) -> bool:
+        """Complete a packet which was entirely written to the socket.
+
+        Returns True if it was a DISCONNECT, after which the socket is closed.
+        """
+        if (packet.command & 0xF0) == PUBLISH and packet.qos == 0:
+            with self._callback_mutex:
+                on_publish = self.on_publish
+
+            if on_publish:
+                with self._in_callback_mutex:
+                    try:
+                        if self._callback_api_version == CallbackAPIVersion.VERSION1:
+                            on_publish = cast(CallbackOnPublish_v1, on_publish)
+
+                            on_publish(self, self._userdata, packet.mid)
+                        elif self._callback_api_version == CallbackAPIVersion.VERSION2:
+                            on_publish = cast(CallbackOnPublish_v2, on_publish)
+
+                            on_publish(
+                                self,
+                                self._userdata,
+                                packet.mid,
+                                ReasonCode(PacketTypes.PUBACK),
+                                Properties(PacketTypes.PUBACK),
+                            )
+                        else:
+                            raise RuntimeError("Unsupported callback API version")
+                    except Exception as err:
+                        self._easy_log(
+                            MQTT_LOG_ERR, 'Caught exception in on_publish: %s', err)
+                        if not self.suppress_exceptions:
+                            raise
+
+            # TODO: Something is odd here. I don't see why packet.info can't be None.
+            # A packet could be produced by _handle_connack with qos=0 and no info
+            # (around line 3645). Ignore the mypy check for now but I feel there is a bug
+            # somewhere.
+            packet.info._set_as_published()  # type: ignore
+            if self._max_queued_bytes > 0:
+                self._queued_bytes_remove(len(packet.payload))
+
+        if (packet.command & 0xF0) == DISCONNECT:
+            with self._msgtime_mutex:
+                self._last_msg_out = time_func()
+
+            self._do_on_disconnect(
+                packet_from_broker=False,
+                v1_rc=MQTTErrorCode.MQTT_ERR_SUCCESS,
+            )
+            self._sock_close()
+            # Only change to disconnected if the disconnection was wanted
+            # by the client (== state was disconnecting). If the broker disconnected
+            # use unilaterally don't change the state and client may reconnect.
+            if self._state == _ConnectionState.MQTT_CS_DISCONNECTING:
+                self._state = _ConnectionState.MQTT_CS_DISCONNECTED
+            return True
+        return False
+
     def _easy_log(self, level: LogLevel, fmt: str, *args: Any) -> None:
         if self.on_log is not None:
             buf = fmt % args
@@ -3303,6 +5001,16 @@ class Client:
                 self._last_mid = 1
             return self._last_mid
 
+    def _mid_generate_many(self, count: int) -> list[int]:
+        mids = []
+        with self._mid_generate_mutex:
+            for _ in range(count):
+                self._last_mid += 1
+                if self._last_mid == 65536:
+                    self._last_mid = 1
+                mids.append(self._last_mid)
+        return mids
+
     @staticmethod
     def _raise_for_invalid_topic(topic: bytes) -> None:
         """ Check if the topic is a topic without wildcard and valid length.
@@ -3368,29 +5076,27 @@ class Client:
         self,
         mid: int,
         topic: bytes,
-        payload: bytes|bytearray = b"",
+        payload: bytes | bytearray | memoryview = b"",
         qos: int = 0,
         retain: bool = False,
         dup: bool = False,
         info: MQTTMessageInfo | None = None,
         properties: Properties | None = None,
+        wakeup: bool = True,
+        publisher: TopicPublisher | None = None,
+        priority: int = PublishPriority.NORMAL,
+        packed_properties: bytes | None = None,
     ) -> MQTTErrorCode:
         # we assume that topic and payload are already properly encoded
         if not isinstance(topic, bytes):
             raise TypeError('topic must be bytes, not str')
-        if payload and not isinstance(payload, (bytes, bytearray)):
+        if payload and not isinstance(payload, (bytes, bytearray, memoryview)):
             raise TypeError('payload must be bytes if set')
 
         if self._sock is None:
             return MQTTErrorCode.MQTT_ERR_NO_CONN
 
-        command = PUBLISH | ((dup & 0x1) << 3) | (qos << 1) | retain
-        packet = bytearray()
-        packet.append(command)
-
         payloadlen = len(payload)
-        remaining_length = 2 + len(topic) + payloadlen
-
         if payloadlen == 0:
             if self._protocol == MQTTv5:
                 self._easy_log(
@@ -3418,15 +5124,69 @@ class Client:
                     dup, qos, retain, mid, topic, payloadlen
                 )
 
+        topic_aliases = self._out_topic_aliases
+        if topic_aliases.maximum > 0 and topic and (properties is None or not hasattr(properties, "TopicAlias")):
+            # The broker must receive the packet setting an alias before
+            # those using it, so assigning an alias and queuing the packet
+            # must be done atomically, and the priority is ignored.
+            if packed_properties is None:
+                packed_properties = b"\x00" if properties is None else properties.pack()
+            if 0 < self._max_packet_size < self._publish_packet_size(topic, payloadlen, qos, properties, packed_properties):
+                return self._send_publish_oversize(mid)
+            with topic_aliases.lock:
+                alias, known = topic_aliases.get(topic)
+                packed_properties = _pack_uint16_property(packed_properties, 35, alias)  # Topic Alias
+                # Once the broker knows the alias, the topic is sent empty.
+                packet = self._pack_publish(mid, b"" if known else topic, payloadlen, qos, retain, dup, packed_properties)
+                rc = self._packet_queue(PUBLISH, packet, mid, qos, info, payload, wakeup=False)
+            if wakeup:
+                return self._packet_queue_wakeup()
+            return rc
+
+        if publisher is not None:
+            # Everything but the length, mid and dup flag is already packed.
+            packet = publisher._pack_header(mid, payloadlen, dup)
+        else:
+            if self._protocol == MQTTv5 and packed_properties is None:
+                packed_properties = b'\x00' if properties is None else properties.pack()
+            packet = self._pack_publish(mid, topic, payloadlen, qos, retain, dup, packed_properties)
+
+        if 0 < self._max_packet_size < len(packet) + payloadlen:
+            return self._send_publish_oversize(mid)
+
+        # The payload is queued as is and written after the header, it isn't
+        # copied into the packet.
+        return self._packet_queue(PUBLISH, packet, mid, qos, info, payload, wakeup, priority)
+
+    def _send_publish_oversize(self, mid: int) -> MQTTErrorCode:
+        self._easy_log(
+            MQTT_LOG_WARNING,
+            "Not sending PUBLISH (m%d): larger than the broker accepts (%d bytes)",
+            mid, self._max_packet_size)
+        return MQTTErrorCode.MQTT_ERR_PAYLOAD_SIZE
+
+    def _pack_publish(
+        self,
+        mid: int,
+        topic: bytes,
+        payloadlen: int,
+        qos: int,
+        retain: bool,
+        dup: bool,
+        packed_properties: bytes | None,
+    ) -> bytearray:
+        """Pack a PUBLISH packet up to, but excluding, its payload."""
+        command = PUBLISH | ((dup & 0x1) << 3) | (qos << 1) | retain
+        packet = bytearray()
+        packet.append(command)
+
+        remaining_length = 2 + len(topic) + payloadlen
+
         if qos > 0:
             # For message id
             remaining_length += 2
 
-        if self._protocol == MQTTv5:
-            if properties is None:
-                packed_properties = b'\x00'
-            else:
-                packed_properties = properties.pack()
+        if packed_properties is not None:
             remaining_length += len(packed_properties)
 
         self._pack_remaining_length(packet, remaining_length)
@@ -3436,12 +5196,10 @@ class Client:
             # For message id
             packet.extend(struct.pack("!H", mid))
 
-        if self._protocol == MQTTv5:
+        if packed_properties is not None:
             packet.extend(packed_properties)
 
-        packet.extend(payload)
-
-        return self._packet_queue(PUBLISH, packet, mid, qos, info)
+        return packet
 
     def _send_pubrec(self, mid: int) -> MQTTErrorCode:
         self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: %d)", mid)
@@ -3501,6 +5259,13 @@ class Client:
                 packed_connect_properties = b'\x00'
             else:
                 packed_connect_properties = self._connect_properties.pack()
+            self._in_topic_alias_maximum = getattr(
+                self._connect_properties, "TopicAliasMaximum", self._incoming_topic_alias_maximum,
+            )
+            if self._in_topic_alias_maximum > 0 and not hasattr(self._connect_properties, "TopicAliasMaximum"):
+                packed_connect_properties = _pack_uint16_property(
+                    packed_connect_properties, 34, self._in_topic_alias_maximum,  # Topic Alias Maximum
+                )
             remaining_length += len(packed_connect_properties)
             if self._will:
                 if self._will_properties is None:
@@ -3614,6 +5379,7 @@ class Client:
         dup: int,
         topics: Sequence[tuple[bytes, SubscribeOptions | int]],
         properties: Properties | None = None,
+        mid: int | None = None,
     ) -> tuple[MQTTErrorCode, int]:
         remaining_length = 2
         if self._protocol == MQTTv5:
@@ -3629,7 +5395,7 @@ class Client:
         packet = bytearray()
         packet.append(command)
         self._pack_remaining_length(packet, remaining_length)
-        local_mid = self._mid_generate()
+        local_mid = self._mid_generate() if mid is None else mid
         packet.extend(struct.pack("!H", local_mid))
 
         if self._protocol == MQTTv5:
@@ -3712,9 +5478,10 @@ class Client:
     def _messages_reconnect_reset_out(self) -> None:
         with self._out_message_mutex:
             self._inflight_messages = 0
+            self._out_queued_mids.clear()
             for m in self._out_messages.values():
                 m.timestamp = 0
-                if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
+                if self._inflight_window == 0 or self._inflight_messages < self._inflight_window:
                     if m.qos == 0:
                         m.state = mqtt_ms_publish
                     elif m.qos == 1:
@@ -3737,6 +5504,22 @@ class Client:
                                 m.state = mqtt_ms_publish
                 else:
                     m.state = mqtt_ms_queued
+                    self._out_queued_mids.append(m.mid)
+
+    def _sockpair_drain(self) -> None:
+        if self._sockpairR is None:
+            return
+        try:
+            # Read many bytes at once - a few threads may have written
+            # a byte at the same time.
+            self._sockpairR.recv(10000)
+        except BlockingIOError:
+            pass
+        # Only then allow the next queued packet to wake up the loop again:
+        # a byte written before sockpairR is cleared would be lost, with no
+        # later packet writing another. Packets queued until then are written
+        # by the loop_write() following the wakeup.
+        self._sockpair_pending = False
 
     def _messages_reconnect_reset_in(self) -> None:
         with self._in_message_mutex:
@@ -3762,22 +5545,30 @@ class Client:
         mid: int,
         qos: int,
         info: MQTTMessageInfo | None = None,
+        payload: bytes | bytearray | memoryview = b"",
+        wakeup: bool = True,
+        priority: int = PublishPriority.NORMAL,
     ) -> MQTTErrorCode:
-        mpkt: _OutPacket = {
-            "command": command,
-            "mid": mid,
-            "qos": qos,
-            "pos": 0,
-            "to_process": len(packet),
-            "packet": packet,
-            "info": info,
-        }
+        if command & 0xF0 == PUBLISH:
+            lane = _PUBLISH_LANES[priority]
+            if self._max_queued_bytes > 0 and qos == 0:
+                self._queued_bytes_add(len(payload))
+        else:
+            lane = _PACKET_LANES.get(command & 0xF0, _LANE_NORMAL)
+        self._out_packet.append(_OutPacket(command, mid, qos, packet, payload, info), lane)
 
-        self._out_packet.append(mpkt)
+        if not wakeup:
+            # The caller queues more packets, then calls _packet_queue_wakeup().
+            return MQTTErrorCode.MQTT_ERR_SUCCESS
+        return self._packet_queue_wakeup()
 
+    def _packet_queue_wakeup(self) -> MQTTErrorCode:
         # Write a single byte to sockpairW (connected to sockpairR) to break
-        # out of select() if in threaded mode.
-        if self._sockpairW is not None:
+        # out of select() if in threaded mode. Once written, the loop will
+        # write all the packets queued until it handles the wakeup, so
+        # there is no need to write another byte before.
+        if self._sockpairW is not None and not self._sockpair_pending:
+            self._sockpair_pending = True
             try:
                 self._sockpairW.send(sockpair_data)
             except BlockingIOError:
@@ -3891,6 +5682,30 @@ class Client:
         if result == 0:
             self._state = _ConnectionState.MQTT_CS_CONNECTED
             self._reconnect_delay = None
+            if self._protocol == MQTTv5 and properties is not None:
+                self._out_topic_aliases.reset(min(
+                    self._outgoing_topic_alias_maximum,
+                    getattr(properties, "TopicAliasMaximum", 0),
+                ))
+                receive_maximum = getattr(properties, "ReceiveMaximum", 65535)
+                if self._max_inflight_messages == 0:
+                    self._inflight_window = receive_maximum
+                else:
+                    self._inflight_window = min(self._max_inflight_messages, receive_maximum)
+                if self._inflight_control is not None:
+                    self._inflight_window = self._inflight_control.reset(self._inflight_window)
+                self._max_packet_size = getattr(properties, "MaximumPacketSize", 0)
+                if self._max_packet_size > 0:
+                    with self._out_message_mutex:
+                        self._messages_drop_oversize()
+                self._subscription_ids_available = getattr(properties, "SubscriptionIdentifierAvailable", 1) == 1
+            with self._callback_mutex:
+                # The subscriptions of a new session are made again, SUBACK of
+                # the previous connection are never received.
+                self._subscription_id_pending.clear()
+                if self._subscription_id_bound and (not flags & 0x01 or not self._subscription_ids_available):
+                    self._subscription_id_bound.clear()
+                    self._message_callbacks_stale = True
 
         if self._protocol == MQTTv5:
             self._easy_log(
@@ -3949,12 +5764,23 @@ class Client:
         if result == 0:
             rc = MQTTErrorCode.MQTT_ERR_SUCCESS
             with self._out_message_mutex:
+                # Messages to resend which no longer fit in the inflight window
+                # once limited by the broker's Receive Maximum. They are ahead
+                # of those already queued.
+                requeued_mids: list[int] = []
                 for m in self._out_messages.values():
                     m.timestamp = time_func()
                     if m.state == mqtt_ms_queued:
+                        self._out_queued_mids.extendleft(reversed(requeued_mids))
                         self.loop_write()  # Process outgoing messages that have just been queued up
                         return MQTT_ERR_SUCCESS
 
+                    if (m.qos > 0 and m.state == mqtt_ms_publish
+                            and 0 < self._inflight_window <= self._inflight_messages):
+                        m.state = mqtt_ms_queued
+                        requeued_mids.append(m.mid)
+                        continue
+
                     if m.qos == 0:
                         with self._in_callback_mutex:  # Don't call loop_write after _send_publish()
                             rc = self._send_publish(
@@ -3964,7 +5790,8 @@ class Client:
                                 m.qos,
                                 m.retain,
                                 m.dup,
-                                properties=m.properties
+                                properties=m.properties,
+                                priority=m._priority
                             )
                         if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
                             return rc
@@ -3980,7 +5807,8 @@ class Client:
                                     m.qos,
                                     m.retain,
                                     m.dup,
-                                    properties=m.properties
+                                    properties=m.properties,
+                                    priority=m._priority
                                 )
                             if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
                                 return rc
@@ -3996,7 +5824,8 @@ class Client:
                                     m.qos,
                                     m.retain,
                                     m.dup,
-                                    properties=m.properties
+                                    properties=m.properties,
+                                    priority=m._priority
                                 )
                             if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
                                 return rc
@@ -4008,6 +5837,7 @@ class Client:
                             if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
                                 return rc
                     self.loop_write()  # Process outgoing messages that have just been queued up
+                self._out_queued_mids.extendleft(reversed(requeued_mids))
 
             return rc
         elif result > 0 and result < 6:
@@ -4055,6 +5885,13 @@ class Client:
 
         with self._callback_mutex:
             on_subscribe = self.on_subscribe
+            binding = self._subscription_id_pending.pop(mid, None)
+            if binding is not None:
+                sub, sub_id = binding
+                if (self._subscription_ids.get(sub) == sub_id and not self._subscription_ids_user
+                        and reasoncodes and not reasoncodes[0].is_failure):
+                    self._subscription_id_bound.add(sub)
+                    self._message_callbacks_stale = True
 
         if on_subscribe:
             with self._in_callback_mutex:  # Don't call loop_write after _send_publish()
@@ -4095,14 +5932,41 @@ class Client:
         message.qos = (header & 0x06) >> 1
         message.retain = (header & 0x01) != 0
 
-        pack_format = f"!H{len(self._in_packet['packet']) - 2}s"
-        (slen, packet) = struct.unpack(pack_format, self._in_packet['packet'])
-        pack_format = f"!{slen}s{len(packet) - slen}s"
-        (topic, packet) = struct.unpack(pack_format, packet)
+        # Decode by offset into the packet rather than unpacking it piece by
+        # piece, so that the payload is sliced out only once.
+        packet = memoryview(self._in_packet['packet'])
+        if len(packet) < 2:
+            return MQTTErrorCode.MQTT_ERR_PROTOCOL
+        slen, = struct.unpack_from("!H", packet)
+        pos = 2 + slen
+        topic = bytes(packet[2:pos])
 
         if self._protocol != MQTTv5 and len(topic) == 0:
             return MQTTErrorCode.MQTT_ERR_PROTOCOL
 
+        if message.qos > 0:
+            message.mid, = struct.unpack_from("!H", packet, pos)
+            pos += 2
+
+        if self._protocol == MQTTv5:
+            # Properties are parsed from a copy of their own section only,
+            # the payload stays in place.
+            props_len, vbi_len = VariableByteIntegers.decode(packet[pos:pos + 4])
+            message.properties = Properties(PUBLISH >> 4)
+            message.properties.unpack(bytes(packet[pos:pos + vbi_len + props_len]))
+            pos += vbi_len + props_len
+
+            if hasattr(message.properties, "TopicAlias"):
+                alias = message.properties.TopicAlias
+                if alias == 0 or alias > self._in_topic_alias_maximum:
+                    return MQTTErrorCode.MQTT_ERR_PROTOCOL
+                if len(topic) == 0:
+                    topic = self._in_topic_aliases.get(alias, b"")
+                else:
+                    self._in_topic_aliases[alias] = topic
+            if len(topic) == 0:
+                return MQTTErrorCode.MQTT_ERR_PROTOCOL
+
         # Handle topics with invalid UTF-8
         # This replaces an invalid topic with a message and the hex
         # representation of the topic for logging. When the user attempts to
@@ -4114,16 +5978,15 @@ class Client:
 
         message.topic = topic
 
-        if message.qos > 0:
-            pack_format = f"!H{len(packet) - 2}s"
-            (message.mid, packet) = struct.unpack(pack_format, packet)
-
-        if self._protocol == MQTTv5:
-            message.properties = Properties(PUBLISH >> 4)
-            props, props_len = message.properties.unpack(packet)
-            packet = packet[props_len:]
-
-        message.payload = packet
+        if self._payload_memoryview:
+            payload = packet[pos:]
+            if hasattr(payload, "toreadonly"):
+                payload = payload.toreadonly()
+            message.payload = payload
+            # The message now refers to the packet buffer, it can't be reused.
+            self._in_packet['pooled'] = False
+        else:
+            message.payload = bytes(packet[pos:])
 
         if self._protocol == MQTTv5:
             self._easy_log(
@@ -4209,7 +6072,7 @@ class Client:
                 message = self._in_messages.pop(mid)
                 self._handle_on_message(message)
                 self._inflight_messages -= 1
-                if self._max_inflight_messages > 0:
+                if self._inflight_window > 0:
                     with self._out_message_mutex:
                         rc = self._update_inflight()
                     if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
@@ -4228,27 +6091,29 @@ class Client:
 
     def _update_inflight(self) -> MQTTErrorCode:
         # Dont lock message_mutex here
-        for m in self._out_messages.values():
-            if self._inflight_messages < self._max_inflight_messages:
-                if m.qos > 0 and m.state == mqtt_ms_queued:
-                    self._inflight_messages += 1
-                    if m.qos == 1:
-                        m.state = mqtt_ms_wait_for_puback
-                    elif m.qos == 2:
-                        m.state = mqtt_ms_wait_for_pubrec
-                    rc = self._send_publish(
-                        m.mid,
-                        m.topic.encode('utf-8'),
-                        m.payload,
-                        m.qos,
-                        m.retain,
-                        m.dup,
-                        properties=m.properties,
-                    )
-                    if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
-                        return rc
-            else:
-                return MQTTErrorCode.MQTT_ERR_SUCCESS
+        queued_mids = self._out_queued_mids
+        while queued_mids and self._inflight_messages < self._inflight_window:
+            m = self._out_messages.get(queued_mids.popleft())
+            if m is None or m.qos == 0 or m.state != mqtt_ms_queued:
+                continue
+            self._inflight_messages += 1
+            m.timestamp = time_func()
+            if m.qos == 1:
+                m.state = mqtt_ms_wait_for_puback
+            elif m.qos == 2:
+                m.state = mqtt_ms_wait_for_pubrec
+            rc = self._send_publish(
+                m.mid,
+                m.topic.encode('utf-8'),
+                m.payload,
+                m.qos,
+                m.retain,
+                m.dup,
+                properties=m.properties,
+                priority=m._priority,
+            )
+            if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
+                return rc
         return MQTTErrorCode.MQTT_ERR_SUCCESS
 
     def _handle_pubrec(self) -> MQTTErrorCode:
@@ -4259,10 +6124,12 @@ class Client:
             return MQTTErrorCode.MQTT_ERR_PROTOCOL
 
         mid, = struct.unpack("!H", self._in_packet['packet'][:2])
+        quota_exceeded = False
         if self._protocol == MQTTv5:
             if self._in_packet['remaining_length'] > 2:
                 reasonCode = ReasonCode(PUBREC >> 4)
                 reasonCode.unpack(self._in_packet['packet'][2:])
+                quota_exceeded = reasonCode.value == 151
                 if self._in_packet['remaining_length'] > 3:
                     properties = Properties(PUBREC >> 4)
                     props, props_len = properties.unpack(
@@ -4272,6 +6139,8 @@ class Client:
         with self._out_message_mutex:
             if mid in self._out_messages:
                 msg = self._out_messages[mid]
+                if quota_exceeded and self._inflight_control is not None:
+                    self._inflight_window = self._inflight_control.decrease(time_func())
                 msg.state = mqtt_ms_wait_for_pubcomp
                 msg.timestamp = time_func()
                 return self._send_pubrel(mid)
@@ -4426,9 +6295,11 @@ class Client:
 
         msg = self._out_messages.pop(mid)
         msg.info._set_as_published()
+        if self._max_queued_bytes > 0:
+            self._queued_bytes_remove(len(msg.payload))
         if msg.qos > 0:
             self._inflight_messages -= 1
-            if self._max_inflight_messages > 0:
+            if self._inflight_window > 0:
                 rc = self._update_inflight()
                 if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
                     return rc
@@ -4458,12 +6329,92 @@ class Client:
 
         with self._out_message_mutex:
             if mid in self._out_messages:
+                if self._inflight_control is not None:
+                    now = time_func()
+                    if reasonCode.value == 151:  # Quota exceeded
+                        self._inflight_window = self._inflight_control.decrease(now)
+                    else:
+                        self._inflight_window = self._inflight_control.acknowledged(
+                            now - self._out_messages[mid].timestamp, now)
                 # Only inform the client the message has been sent once.
                 rc = self._do_on_publish(mid, reasonCode, properties)
                 return rc
 
         return MQTTErrorCode.MQTT_ERR_SUCCESS
 
+    def _subscription_id_generate(self) -> int:
+        # Must be called with _callback_mutex held
+        while True:
+            self._subscription_id_next = self._subscription_id_next % 268435455 + 1
+            if self._subscription_id_next not in self._subscription_id_callbacks:
+                return self._subscription_id_next
+
+    def _subscription_id_bind(
+        self, sub: str, properties: Properties | None
+    ) -> tuple[Properties | None, tuple[str, int] | None]:
+        """Add the Subscription Identifier of the callback of sub to the
+        SUBSCRIBE properties, returning them and the binding to record once
+        the SUBSCRIBE is sent."""
+        if self._subscription_ids_user or not self._subscription_ids_available:
+            return properties, None
+        with self._callback_mutex:
+            sub_id = self._subscription_ids.get(sub)
+        if sub_id is None:
+            return properties, None
+        if properties is None:
+            properties = Properties(PacketTypes.SUBSCRIBE)
+        else:
+            properties = copy.copy(properties)
+        properties.SubscriptionIdentifier = sub_id
+        return properties, (sub, sub_id)
+
+    def _subscription_id_unbind(self, subs: list[str]) -> None:
+        """Unbind the filters from their Subscription Identifier, including
+        those waiting for the SUBACK."""
+        if not self._subscription_id_bound and not self._subscription_id_pending:
+            return
+        with self._callback_mutex:
+            for mid, (sub, _) in list(self._subscription_id_pending.items()):
+                if sub in subs:
+                    del self._subscription_id_pending[mid]
+            self._subscription_id_bound.difference_update(subs)
+            self._message_callbacks_stale = True
+
+    def _subscription_ids_disable(self) -> None:
+        """Stop dispatching messages by Subscription Identifier, once the
+        application sets its own."""
+        with self._callback_mutex:
+            self._subscription_ids_user = True
+            self._subscription_id_pending.clear()
+            self._subscription_id_bound.clear()
+            self._message_callbacks_stale = True
+
+    def _message_callbacks_publish(self) -> _MessageCallbacks:
+        """Publish the message callbacks as they are now, for dispatch."""
+        with self._callback_mutex:
+            if self._message_callbacks_stale:
+                # The matcher is copied as its nodes are changed.
+                self._message_callbacks = _MessageCallbacks(
+                    self._on_message,
+                    self._on_message_filtered.copy(),
+                    self._subscription_id_callbacks.copy(),
+                    frozenset(self._subscription_id_bound),
+                )
+                self._message_callbacks_stale = False
+            return self._message_callbacks
+
+    @staticmethod
+    def _subscription_id_callbacks_get(
+        callbacks: _MessageCallbacks, message: MQTTMessage
+    ) -> list[CallbackOnMessage] | None:
+        """Return the callbacks of the Subscription Identifiers of the message,
+        or None if they must be found by matching its topic."""
+        sub_ids = getattr(message.properties, "SubscriptionIdentifier", None)
+        if not sub_ids or len(callbacks.bound) != len(callbacks.id_callbacks):
+            return None
+        id_callbacks = callbacks.id_callbacks
+        return [id_callbacks[sub_id] for sub_id in sub_ids if sub_id in id_callbacks]
+
     def _handle_on_message(self, message: MQTTMessage) -> None:
 
         try:
@@ -4471,15 +6422,24 @@ class Client:
         except UnicodeDecodeError:
             topic = None
 
-        on_message_callbacks = []
-        with self._callback_mutex:
-            if topic is not None:
-                on_message_callbacks = list(self._on_message_filtered.iter_match(message.topic))
+        if self._compression_filters and topic is not None and message.payload:
+            self._payload_decompress(topic, message)
 
-            if len(on_message_callbacks) == 0:
-                on_message = self.on_message
-            else:
-                on_message = None
+        # A snapshot, read without locking unless it must be published again
+        callbacks = self._message_callbacks
+        if self._message_callbacks_stale:
+            callbacks = self._message_callbacks_publish()
+        on_message_callbacks = []
+        if topic is not None:
+            found = self._subscription_id_callbacks_get(callbacks, message)
+            if found is None:
+                found = list(callbacks.matcher.iter_match(topic))
+            on_message_callbacks = found
+
+        if len(on_message_callbacks) == 0:
+            on_message = callbacks.on_message
+        else:
+            on_message = None
 
         for callback in on_message_callbacks:
             with self._in_callback_mutex:
@@ -4678,6 +6638,40 @@ class Client:
 
         return ssl_sock
 
+class _ReceiveBufferPool:
+    """Buffers of large incoming packets, kept to be reused for later packets
+    of the same or a slightly smaller size."""
+
+    __slots__ = "_buffers", "max_buffers"
+
+    def __init__(self, max_buffers: int):
+        self.max_buffers = max_buffers
+        self._buffers: list[bytearray] = []
+
+    def get(self, size: int) -> bytearray:
+        best = None
+        for i, buf in enumerate(self._buffers):
+            # Shrinking a bytearray by less than half doesn't reallocate it.
+            if size <= len(buf) < size * 2 and (best is None or len(buf) < len(self._buffers[best])):
+                best = i
+        if best is None:
+            return bytearray(size)
+        buf = self._buffers.pop(best)
+        del buf[size:]
+        return buf
+
+    def put(self, buf: bytearray) -> None:
+        if self.max_buffers <= 0:
+            return
+        if len(self._buffers) >= self.max_buffers:
+            # Forget the least recently used buffer.
+            del self._buffers[0]
+        self._buffers.append(buf)
+
+    def clear(self) -> None:
+        self._buffers = []
+
+
 class _WebsocketWrapper:
     OPCODE_CONTINUATION = 0x0
     OPCODE_TEXT = 0x1
@@ -4976,6 +6970,11 @@ class _WebsocketWrapper:
     def recv(self, length: int) -> bytes:
         return self._recv_impl(length)
 
+    def recv_into(self, buffer: memoryview, nbytes: int = 0) -> int:
+        data = self._recv_impl(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
     def read(self, length: int) -> bytes:
         return self._recv_impl(length)
 
@@ -68,6 +68,14 @@ class MessageType(enum.IntEnum):
     AUTH = 0xF0
 
 
+class PublishPriority(enum.IntEnum):
+    """Priority of a published message over the other packets waiting to be
+    written to the socket. Acknowledgements and PINGREQ always come first."""
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+
+
 class LogLevel(enum.IntEnum):
     MQTT_LOG_INFO = 0x01
     MQTT_LOG_NOTICE = 0x02
@@ -1,78 +1,385 @@
+import collections
+import sys
+
+
+def _edge(levels):
+    """Return the levels of an edge as stored in a node."""
+    return levels[0] if len(levels) == 1 else levels
+
+
+def _edge_levels(edge):
+    """Return the levels of an edge as a tuple."""
+    return (edge,) if edge.__class__ is str else edge
+
+
+def _copy_node(node):
+    """Return a copy of a node, sharing its children."""
+    copy = MQTTMatcher.Node(node._levels)
+    if node._children is not None:
+        copy._children = node._children.copy()
+    copy._content = node._content
+    return copy
+
+
 class MQTTMatcher:
     """Intended to manage topic filters including wildcards.
 
     Internally, MQTTMatcher use a prefix tree (trie) to store
     values associated with filters, and has an iter_match()
     method to iterate efficiently over all filters that match
-    some topic name."""
+    some topic name.
+
+    The trie is path compressed: a chain of topic levels without
+    values nor branches is a single node, and the levels of the
+    filters are interned, so that many similar filters share them.
+
+    The matches of the last cache_size topics are cached, until
+    a filter is added or deleted.
+
+    copy() returns a matcher sharing the nodes of the trie, they
+    are copied once when a filter is added or deleted."""
 
     class Node:
-        __slots__ = '_children', '_content'
+        __slots__ = '_children', '_content', '_levels'
 
-        def __init__(self):
-            self._children = {}
+        def __init__(self, levels=()):
+            # The levels of the edge leading to the node, a str
+            # for a single level or else a tuple.
+            self._levels = levels
+            # Children by the first level of their edge, None
+            # for leaves.
+            self._children = None
             self._content = None
 
-    def __init__(self):
+    def __init__(self, cache_size=1024):
         self._root = self.Node()
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        # Whether the nodes may be shared with copies, and the ids of
+        # those created since, which are not.
+        self._shared = False
+        self._owned = set()
+
+    def copy(self):
+        """Return a copy of the matcher, in time independent of the
+        number of filters. Adding or deleting a filter afterwards
+        copies the nodes on its path not yet copied, in either
+        matcher."""
+        copy = MQTTMatcher(self._cache_size)
+        copy._root = self._root
+        copy._shared = self._shared = True
+        self._owned = set()
+        return copy
+
+    def _node(self, levels):
+        """Return a new node, owned by the matcher"""
+        node = self.Node(levels)
+        if self._shared:
+            self._owned.add(id(node))
+        return node
+
+    def _own(self, node):
+        """Return the node, or a copy of it if it may be shared"""
+        if id(node) in self._owned:
+            return node
+        node = _copy_node(node)
+        self._owned.add(id(node))
+        return node
+
+    def _unshare(self, key):
+        """Copy the nodes on the path to the topic filter :key, which
+        may be shared with copies of the matcher, before changing them"""
+        levels = key.split('/')
+        node = self._root = self._own(self._root)
+        i = 0
+        while i < len(levels) and node._children is not None:
+            child = node._children.get(levels[i])
+            if child is None:
+                break
+            child = node._children[levels[i]] = self._own(child)
+            edge = _edge_levels(child._levels)
+            if len(edge) > 1 and tuple(levels[i:i + len(edge)]) != edge:
+                break
+            node, i = child, i + len(edge)
 
     def __setitem__(self, key, value):
         """Add a topic filter :key to the prefix tree
         and associate it to :value"""
+        if self._shared:
+            self._unshare(key)
+        levels = tuple(sys.intern(sym) for sym in key.split('/'))
         node = self._root
-        for sym in key.split('/'):
-            node = node._children.setdefault(sym, self.Node())
+        i = 0
+        while i < len(levels):
+            sym = levels[i]
+            if node._children is None:
+                node._children = {}
+            child = node._children.get(sym)
+            if child is None:
+                node._children[sym] = node = self._node(_edge(levels[i:]))
+                break
+            edge = _edge_levels(child._levels)
+            k = 1
+            while k < len(edge) and i + k < len(levels) and levels[i + k] == edge[k]:
+                k += 1
+            if k < len(edge):
+                # Split the edge where the filter leaves it.
+                parent = node._children[sym] = self._node(_edge(edge[:k]))
+                parent._children = {edge[k]: child}
+                child._levels = _edge(edge[k:])
+                child = parent
+            node, i = child, i + k
         node._content = value
+        self._cache.clear()
+
+    def _find(self, key):
+        """Return the path of nodes to the topic filter :key, or
+        None if :key ends within the edge of a node, where it has
+        no value"""
+        levels = key.split('/')
+        path = [self._root]
+        i = 0
+        while i < len(levels):
+            children = path[-1]._children
+            if children is None:
+                raise KeyError(key)
+            node = children[levels[i]]
+            edge = _edge_levels(node._levels)
+            if len(edge) > 1 and tuple(levels[i:i + len(edge)]) != edge:
+                if tuple(levels[i:]) == edge[:len(levels) - i]:
+                    return None
+                raise KeyError(key)
+            path.append(node)
+            i += len(edge)
+        return path
 
     def __getitem__(self, key):
         """Retrieve the value associated with some topic filter :key"""
         try:
-            node = self._root
-            for sym in key.split('/'):
-                node = node._children[sym]
-            if node._content is None:
+            path = self._find(key)
+            if path is None or path[-1]._content is None:
                 raise KeyError(key)
-            return node._content
+            return path[-1]._content
         except KeyError as ke:
             raise KeyError(key) from ke
 
     def __delitem__(self, key):
         """Delete the value associated with some topic filter :key"""
-        lst = []
+        if self._shared:
+            self._unshare(key)
         try:
-            parent, node = None, self._root
-            for k in key.split('/'):
-                 parent, node = node, node._children[k]
-                 lst.append((parent, k, node))
+            path = self._find(key)
+            if path is None:
+                # Like the other filters without value.
+                return
             # TODO
-            node._content = None
+            path[-1]._content = None
         except KeyError as ke:
             raise KeyError(key) from ke
         else:  # cleanup
-            for parent, k, node in reversed(lst):
-                if node._children or node._content is not None:
-                     break
-                del parent._children[k]
+            self._cache.clear()
+            node = path.pop()
+            while path and not node._children and node._content is None:
+                parent = path.pop()
+                del parent._children[_edge_levels(node._levels)[0]]
+                if not parent._children:
+                    parent._children = None
+                node = parent
+            # Merge what is left with its only child.
+            if path and node._content is None and node._children and len(node._children) == 1:
+                (child,) = node._children.values()
+                node._levels = _edge(_edge_levels(node._levels) + _edge_levels(child._levels))
+                node._children = child._children
+                if node._children is not None and self._shared and id(child) not in self._owned:
+                    node._children = node._children.copy()
+                node._content = child._content
 
     def iter_match(self, topic):
         """Return an iterator on all values associated with filters
         that match the :topic"""
-        lst = topic.split('/')
-        normal = not topic.startswith('$')
-        def rec(node, i=0):
-            if i == len(lst):
-                if node._content is not None:
-                    yield node._content
+        cache = self._cache
+        try:
+            matches = cache[topic]
+            cache.move_to_end(topic)
+        except KeyError:
+            matches = self._match(topic)
+            if self._cache_size > 0:
+                cache[topic] = matches
+                if len(cache) > self._cache_size:
+                    try:
+                        cache.popitem(last=False)
+                    except KeyError:  # emptied by another thread
+                        pass
+        return iter(matches)
+
+    def match_many(self, topics):
+        """Return a list with, for each topic of :topics, a tuple of
+        all values associated with filters that match it, in the
+        order iter_match() would return them.
+
+        The trie is walked once for all the topics, topics sharing
+        levels follow the same path together. Each distinct topic is
+        only matched once."""
+        topics = list(topics)
+        results = {}
+        pending = []
+        cache = self._cache
+        for topic in topics:
+            if topic in results:
+                continue
+            matches = cache.get(topic)
+            results[topic] = matches
+            if matches is None:
+                pending.append(topic)
+        if pending:
+            for topic, matches in zip(pending, self._match_many(pending)):
+                results[topic] = matches
+                if self._cache_size > 0:
+                    cache[topic] = matches
+            try:
+                while len(cache) > self._cache_size:
+                    cache.popitem(last=False)
+            except KeyError:  # emptied by another thread
+                pass
+        return [results[topic] for topic in topics]
+
+    def _match_many(self, topics):
+        """Return the matches of each of the distinct :topics, walking
+        the trie as _match() does with groups of topics."""
+        split = [topic.split('/') for topic in topics]
+        matches = [[] for _ in topics]
+        # Nodes to visit with the index of their topic level, or -1,
+        # and the indexes of the topics which reached them.
+        stack = [(self._root, 0, range(len(topics)))]
+        while stack:
+            node, i, group = stack.pop()
+            content = node._content
+            if i < 0:
+                for t in group:
+                    matches[t].append(content)
+                continue
+            if len(group) == 1:
+                # Nothing left to share
+                t = group[0]
+                self._walk(split[t], not topics[t].startswith('$'), node, i, matches[t])
+                continue
+            if content is not None:
+                for t in group:
+                    if len(split[t]) == i:
+                        matches[t].append(content)
+            children = node._children
+            if children is None:
+                continue
+            if i == 0:
+                wildcards = [t for t in group if not topics[t].startswith('$')]
             else:
-                part = lst[i]
-                if part in node._children:
-                    for content in rec(node._children[part], i + 1):
-                        yield content
-                if '+' in node._children and (normal or i > 0):
-                    for content in rec(node._children['+'], i + 1):
-                        yield content
-            if '#' in node._children and (normal or i > 0):
-                content = node._children['#']._content
-                if content is not None:
-                    yield content
-        return rec(self._root)
+                wildcards = group
+            # Pushed in reverse order of visit: '#', '+' then the
+            # exact levels.
+            if wildcards:
+                child = children.get('#')
+                if child is not None and child._content is not None and child._levels == '#':
+                    stack.append((child, -1, wildcards))
+            candidates = []
+            child = children.get('+')
+            if child is not None:
+                longer = [t for t in wildcards if len(split[t]) > i]
+                if longer:
+                    candidates.append((child, longer))
+            by_level = {}
+            for t in group:
+                if len(split[t]) > i:
+                    by_level.setdefault(split[t][i], []).append(t)
+            for sym, subgroup in by_level.items():
+                child = children.get(sym)
+                if child is not None:
+                    candidates.append((child, subgroup))
+            for child, subgroup in candidates:
+                edge = child._levels
+                if edge.__class__ is str:
+                    stack.append((child, i + 1, subgroup))
+                    continue
+                # The first level matched, check the others. A '#'
+                # is a wildcard if it ends the edge, else a level.
+                end = i + len(edge)
+                rest = edge[1:]
+                wildcard = rest[-1] == '#'
+                if wildcard:
+                    rest = rest[:-1]
+                matched = []
+                for t in subgroup:
+                    levels = split[t]
+                    if len(levels) < (end - 1 if wildcard else end):
+                        continue
+                    for j, sym in enumerate(rest, i + 1):
+                        if sym != '+' and sym != levels[j]:
+                            break
+                    else:
+                        matched.append(t)
+                if not matched:
+                    continue
+                if not wildcard:
+                    stack.append((child, end, matched))
+                    continue
+                if child._content is not None:
+                    stack.append((child, -1, matched))
+                literal = [t for t in matched if len(split[t]) >= end and split[t][end - 1] == '#']
+                if literal:
+                    stack.append((child, end, literal))
+        return [tuple(m) for m in matches]
+
+    def _match(self, topic):
+        """Return a tuple of all values associated with filters that
+        match the :topic, in depth first order: at each level the
+        exact filter level, then '+', then '#'."""
+        matches = []
+        self._walk(topic.split('/'), not topic.startswith('$'), self._root, 0, matches)
+        return tuple(matches)
+
+    def _walk(self, lst, normal, node, i, matches):
+        """Append to :matches the values of the filters below :node
+        matching the levels :lst from the index :i."""
+        length = len(lst)
+        # Nodes to visit with the index of their topic level, or -1
+        # for nodes ending with '#' whose content only has to be
+        # collected.
+        stack = [(node, i)]
+        while stack:
+            node, i = stack.pop()
+            if i < 0:
+                matches.append(node._content)
+                continue
+            if i == length and node._content is not None:
+                matches.append(node._content)
+            children = node._children
+            if children is None:
+                continue
+            # Pushed in reverse order of visit: '#', '+' then the
+            # exact level.
+            wildcards = normal or i > 0
+            if wildcards:
+                child = children.get('#')
+                if child is not None and child._content is not None and child._levels == '#':
+                    stack.append((child, -1))
+            if i == length:
+                continue
+            for child in (children.get('+') if wildcards else None, children.get(lst[i])):
+                if child is None:
+                    continue
+                edge = child._levels
+                if edge.__class__ is str:
+                    stack.append((child, i + 1))
+                    continue
+                # The first level matched, check the others. A '#'
+                # is a wildcard if it ends the edge, else a level.
+                j = i + 1
+                for sym in edge[1:-1]:
+                    if j == length or (sym != '+' and sym != lst[j]):
+                        break
+                    j += 1
+                else:
+                    sym = edge[-1]
+                    if sym == '#' and child._content is not None:
+                        stack.append((child, -1))
+                    if j < length and (sym == '+' or sym == lst[j]):
+                        stack.append((child, j + 1))
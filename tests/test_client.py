@@ -1,15 +1,23 @@
+import os
+import queue
+import select
+import socket
+import ssl
+import struct
 import threading
 import time
 import unicodedata
+import zlib
 
 import paho.mqtt.client as client
 import pytest
-from paho.mqtt.enums import CallbackAPIVersion, MQTTErrorCode, MQTTProtocolVersion
+from paho.mqtt.enums import CallbackAPIVersion, MQTTErrorCode, MQTTProtocolVersion, PublishPriority
 from paho.mqtt.packettypes import PacketTypes
 from paho.mqtt.properties import Properties
 from paho.mqtt.reasoncodes import ReasonCode
 
 import tests.paho_test as paho_test
+from tests import mqtt5_props
 
 # Import test fixture
 from tests.testsupport.broker import FakeBroker, fake_broker  # noqa: F401
@@ -480,6 +488,1065 @@ class TestPublish:
         assert not packet_in  # Check connection is closed
 
 
+    def test_publish_burst(self, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_publish_burst",
+            transport=fake_broker.transport,
+        )
+
+        published = []
+        infos = []
+
+        def on_connect(mqttc, obj, flags, reason_code, properties):
+            # Messages published from a callback are queued, then written
+            # together by the next loop().
+            infos.extend(mqttc.publish(f"test/{i}", b"x" * i) for i in range(200))
+
+        def on_publish(mqttc, obj, mid, reason_code, properties):
+            published.append(mid)
+
+        mqttc.on_connect = on_connect
+        mqttc.on_publish = on_publish
+
+        mqttc.connect("localhost", fake_broker.port)
+        fake_broker.start()
+
+        connect_packet = paho_test.gen_connect(
+            "test_publish_burst", keepalive=60,
+            proto_ver=client.MQTTv311)
+        fake_broker.expect_packet("connect", connect_packet)
+
+        connack_packet = paho_test.gen_connack(rc=0)
+        count = fake_broker.send_packet(connack_packet)
+        assert count == len(connack_packet)
+
+        assert mqttc.loop(timeout=1) == MQTTErrorCode.MQTT_ERR_SUCCESS
+        assert len(infos) == 200
+        assert not published
+        assert mqttc.want_write()
+        assert mqttc.loop_write() == MQTTErrorCode.MQTT_ERR_SUCCESS
+        assert not mqttc.want_write()
+
+        assert published == [info.mid for info in infos]
+        assert all(info.is_published() for info in infos)
+
+        publish_packets = b"".join(
+            paho_test.gen_publish(f"test/{i}", payload=b"x" * i, qos=0)
+            for i in range(200)
+        )
+        fake_broker.expect_packet("publish", publish_packets)
+
+        mqttc.disconnect()
+
+        disconnect_packet = paho_test.gen_disconnect()
+        fake_broker.expect_packet("disconnect", disconnect_packet)
+
+
+    def test_publish_large_payload(self, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_publish_large_payload",
+            transport=fake_broker.transport,
+        )
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            connect_packet = paho_test.gen_connect(
+                "test_publish_large_payload", keepalive=60,
+                proto_ver=client.MQTTv311)
+            fake_broker.expect_packet("connect", connect_packet)
+
+            connack_packet = paho_test.gen_connack(rc=0)
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+
+            large_payload = bytes(range(256)) * 4096
+            mqttc.publish("test/large", large_payload, qos=1)
+            # A bytearray may be reused by the caller once publish() returns.
+            payload = bytearray(b"first")
+            mqttc.publish("test/bytearray", payload, qos=1)
+            payload[:] = b"second"
+
+            publish_packet = paho_test.gen_publish(
+                b"test/large", payload=large_payload, qos=1, mid=1)
+            fake_broker.expect_packet("publish", publish_packet)
+            publish_packet = paho_test.gen_publish(
+                b"test/bytearray", payload=b"first", qos=1, mid=2)
+            fake_broker.expect_packet("publish", publish_packet)
+
+            mqttc.disconnect()
+
+            disconnect_packet = paho_test.gen_disconnect()
+            fake_broker.expect_packet("disconnect", disconnect_packet)
+
+        finally:
+            mqttc.loop_stop()
+
+
+    def test_publish_many(self, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_publish_many",
+            transport=fake_broker.transport,
+        )
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            connect_packet = paho_test.gen_connect(
+                "test_publish_many", keepalive=60,
+                proto_ver=client.MQTTv311)
+            fake_broker.expect_packet("connect", connect_packet)
+
+            connack_packet = paho_test.gen_connack(rc=0)
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+
+            # A single invalid message rejects the whole batch.
+            with pytest.raises(ValueError):
+                mqttc.publish_many([("test/a", b"a"), ("test/#", b"b")])
+            with pytest.raises(TypeError):
+                mqttc.publish_many(["test/a"])
+            assert mqttc.publish_many([]) == []
+
+            infos = mqttc.publish_many([
+                ("test/a",),
+                ("test/b", "payload"),
+                ("test/a", b"qos1", 1),
+                {"topic": "test/c", "payload": 42, "qos": 1, "retain": True},
+                ["test/d", None, 0, True],
+            ])
+            assert [info.mid for info in infos] == [1, 2, 3, 4, 5]
+            assert all(info.rc == MQTTErrorCode.MQTT_ERR_SUCCESS for info in infos)
+
+            publish_packets = b"".join([
+                paho_test.gen_publish(b"test/a", qos=0),
+                paho_test.gen_publish(b"test/b", payload=b"payload", qos=0),
+                paho_test.gen_publish(b"test/a", payload=b"qos1", qos=1, mid=3),
+                paho_test.gen_publish(b"test/c", payload=b"42", qos=1, mid=4, retain=True),
+                paho_test.gen_publish(b"test/d", qos=0, retain=True),
+            ])
+            fake_broker.expect_packet("publish", publish_packets)
+
+            infos[0].wait_for_publish(1)
+            infos[4].wait_for_publish(1)
+            assert infos[4].is_published()
+
+            mqttc.disconnect()
+
+            disconnect_packet = paho_test.gen_disconnect()
+            fake_broker.expect_packet("disconnect", disconnect_packet)
+
+        finally:
+            mqttc.loop_stop()
+
+
+    @pytest.mark.parametrize("proto_ver", [
+        (MQTTProtocolVersion.MQTTv311),
+        (MQTTProtocolVersion.MQTTv5),
+    ])
+    def test_publisher(self, proto_ver, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_publisher",
+            protocol=proto_ver,
+            transport=fake_broker.transport,
+        )
+
+        with pytest.raises(ValueError):
+            mqttc.publisher("test/+")
+        with pytest.raises(ValueError):
+            mqttc.publisher("test", qos=3)
+
+        properties = None
+        packed_properties = b""
+        if proto_ver == MQTTProtocolVersion.MQTTv5:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ContentType = "text/plain"
+            packed_properties = mqtt5_props.gen_string_prop(mqtt5_props.PROP_CONTENT_TYPE, "text/plain")
+
+        publisher0 = mqttc.publisher("test/qos0")
+        publisher1 = mqttc.publisher("test/qos1", qos=1, retain=True, properties=properties)
+        assert publisher1.topic == "test/qos1"
+        assert publisher1.qos == 1
+        assert publisher1.retain
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            connack_packet = paho_test.gen_connack(rc=0, proto_ver=proto_ver)
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+
+            infos = [
+                publisher0.send("first"),
+                publisher1.send(b"second"),
+                publisher0.send(None),
+                publisher1.send(b"x" * 200),
+            ]
+            assert [info.mid for info in infos] == [1, 2, 3, 4]
+
+            publish_packets = b"".join([
+                paho_test.gen_publish(b"test/qos0", payload=b"first", qos=0, proto_ver=proto_ver),
+                paho_test.gen_publish(
+                    b"test/qos1", payload=b"second", qos=1, mid=2, retain=True,
+                    proto_ver=proto_ver, properties=packed_properties),
+                paho_test.gen_publish(b"test/qos0", qos=0, proto_ver=proto_ver),
+                paho_test.gen_publish(
+                    b"test/qos1", payload=b"x" * 200, qos=1, mid=4, retain=True,
+                    proto_ver=proto_ver, properties=packed_properties),
+            ])
+            fake_broker.expect_packet("publish", publish_packets)
+
+            mqttc.disconnect()
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+        finally:
+            mqttc.loop_stop()
+
+
+    def test_outgoing_topic_alias(self, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_outgoing_topic_alias",
+            protocol=MQTTProtocolVersion.MQTTv5,
+            transport=fake_broker.transport,
+        )
+        assert mqttc.outgoing_topic_alias_maximum == 0
+        mqttc.outgoing_topic_alias_maximum = 2
+
+        connected = threading.Event()
+        mqttc.on_connect = lambda *args: connected.set()
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            # The broker allows 10 topic aliases
+            connack_packet = paho_test.gen_connack(rc=0, proto_ver=5)
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+            assert connected.wait(1)
+
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ContentType = "text/plain"
+            manual_alias = Properties(PacketTypes.PUBLISH)
+            manual_alias.TopicAlias = 5
+            mqttc.publish_many([
+                ("topic/a", b"1", 0, False, properties),
+                ("topic/a", b"2"),
+                ("topic/b", b"3", 1),
+                ("topic/c", b"4"),
+                ("topic/a", b"5"),
+                ("topic/c", b"6"),
+                ("topic/d", b"7", 0, False, manual_alias),
+            ])
+
+            def alias(n, properties=b""):
+                return properties + mqtt5_props.gen_uint16_prop(mqtt5_props.PROP_TOPIC_ALIAS, n)
+
+            content_type = mqtt5_props.gen_string_prop(mqtt5_props.PROP_CONTENT_TYPE, "text/plain")
+            publish_packets = b"".join([
+                paho_test.gen_publish(b"topic/a", qos=0, payload=b"1", proto_ver=5, properties=alias(1, content_type)),
+                paho_test.gen_publish(b"", qos=0, payload=b"2", proto_ver=5, properties=alias(1)),
+                paho_test.gen_publish(b"topic/b", qos=1, payload=b"3", mid=3, proto_ver=5, properties=alias(2)),
+                # Both aliases are used, the least recently used one is reassigned
+                paho_test.gen_publish(b"topic/c", qos=0, payload=b"4", proto_ver=5, properties=alias(1)),
+                paho_test.gen_publish(b"topic/a", qos=0, payload=b"5", proto_ver=5, properties=alias(2)),
+                paho_test.gen_publish(b"", qos=0, payload=b"6", proto_ver=5, properties=alias(1)),
+                paho_test.gen_publish(b"topic/d", qos=0, payload=b"7", proto_ver=5, properties=alias(5)),
+            ])
+            fake_broker.expect_packet("publish", publish_packets)
+
+            mqttc.disconnect()
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+        finally:
+            mqttc.loop_stop()
+
+
+    def test_receive_maximum(self, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_receive_maximum",
+            protocol=MQTTProtocolVersion.MQTTv5,
+            transport=fake_broker.transport,
+        )
+        assert mqttc.inflight_window == 20
+
+        connected = threading.Event()
+        mqttc.on_connect = lambda *args: connected.set()
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            # The broker only accepts 2 unacknowledged messages
+            connack_packet = paho_test.gen_connack(
+                rc=0, proto_ver=5, property_helper=False,
+                properties=mqtt5_props.gen_uint16_prop(mqtt5_props.PROP_RECEIVE_MAXIMUM, 2),
+            )
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+            assert connected.wait(1)
+            assert mqttc.max_inflight_messages == 20
+            assert mqttc.inflight_window == 2
+
+            for i in range(3):
+                mqttc.publish("topic", str(i), qos=1)
+
+            fake_broker.expect_packet("publish", b"".join(
+                paho_test.gen_publish(b"topic", qos=1, mid=mid, payload=str(mid - 1).encode(), proto_ver=5)
+                for mid in (1, 2)
+            ))
+            fake_broker.expect_no_packet(0.2)
+
+            fake_broker.send_packet(paho_test.gen_puback(1, proto_ver=5))
+            fake_broker.expect_packet(
+                "publish",
+                paho_test.gen_publish(b"topic", qos=1, mid=3, payload=b"2", proto_ver=5),
+            )
+
+            mqttc.disconnect()
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+        finally:
+            mqttc.loop_stop()
+
+    def test_max_packet_size(self, fake_broker: FakeBroker, monkeypatch: pytest.MonkeyPatch) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_max_packet_size",
+            protocol=MQTTProtocolVersion.MQTTv5,
+            transport=fake_broker.transport,
+        )
+        assert mqttc.max_packet_size == 0
+
+        connected = threading.Event()
+        mqttc.on_connect = lambda *args: connected.set()
+        logs = []
+        mqttc.on_log = lambda client, userdata, level, buf: logs.append(buf)
+
+        # Stored until connected, then too large for the broker.
+        stored_info = mqttc.publish("topic", b"x" * 100, qos=1)
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            connack_packet = paho_test.gen_connack(
+                rc=0, proto_ver=5, property_helper=False,
+                properties=mqtt5_props.gen_uint32_prop(mqtt5_props.PROP_MAXIMUM_PACKET_SIZE, 50),
+            )
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+            assert connected.wait(1)
+            assert mqttc.max_packet_size == 50
+            assert stored_info.rc == MQTTErrorCode.MQTT_ERR_PAYLOAD_SIZE
+            with pytest.raises(RuntimeError):
+                stored_info.wait_for_publish(1)
+            assert any(buf.startswith("Dropping message (m1) on 'topic'") for buf in logs)
+
+            # 50 bytes with a 40 bytes payload
+            assert mqttc.publish("topic", b"x" * 41).rc == MQTTErrorCode.MQTT_ERR_PAYLOAD_SIZE
+            assert logs[-1].startswith("Not publishing message (m2) on 'topic'")
+            assert mqttc.publish("topic", b"x" * 41, qos=1).rc == MQTTErrorCode.MQTT_ERR_PAYLOAD_SIZE
+            assert mqttc.publish("topic", b"x" * 40).rc == MQTTErrorCode.MQTT_ERR_SUCCESS
+            fake_broker.expect_packet(
+                "publish", paho_test.gen_publish(b"topic", qos=0, payload=b"x" * 40, proto_ver=5))
+
+            # The properties are packed once for both the size and the packet.
+            packs = []
+            pack = Properties.pack
+            monkeypatch.setattr(Properties, "pack", lambda self: packs.append(self) or pack(self))
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ContentType = "text"
+            assert mqttc.publish("topic", b"1", properties=properties).rc == MQTTErrorCode.MQTT_ERR_SUCCESS
+            assert len(packs) == 1
+            publisher = mqttc.publisher("topic", qos=1, properties=properties)
+            info = publisher.send(b"2")
+            assert info.rc == MQTTErrorCode.MQTT_ERR_SUCCESS
+            assert len(packs) == 2
+            content_type = mqtt5_props.gen_string_prop(mqtt5_props.PROP_CONTENT_TYPE, "text")
+            fake_broker.expect_packet("publish", b"".join([
+                paho_test.gen_publish(b"topic", qos=0, payload=b"1", proto_ver=5, properties=content_type),
+                paho_test.gen_publish(b"topic", qos=1, mid=info.mid, payload=b"2", proto_ver=5, properties=content_type),
+            ]))
+
+            mqttc.disconnect()
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+        finally:
+            mqttc.loop_stop()
+
+    def test_compression(self, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_compression",
+            protocol=MQTTProtocolVersion.MQTTv5,
+            transport=fake_broker.transport,
+        )
+        mqttc.compression_set("telemetry/#", "zlib", threshold=20)
+
+        received = []
+        message_received = threading.Event()
+
+        def on_message(client, userdata, msg):
+            received.append((msg.payload, getattr(msg.properties, "UserProperty", None)))
+            message_received.set()
+
+        mqttc.on_message = on_message
+        connected = threading.Event()
+        mqttc.on_connect = lambda *args: connected.set()
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            connack_packet = paho_test.gen_connack(rc=0, proto_ver=5)
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+            assert connected.wait(1)
+
+            payload = b'{"temperature": 21.5}' * 10
+            encoding = mqtt5_props.gen_string_pair_prop(mqtt5_props.PROP_USER_PROPERTY, "content-encoding", "zlib")
+
+            mqttc.publish("telemetry/a", payload)
+            # Below the threshold, and not matching
+            mqttc.publish("telemetry/b", b"{}")
+            mqttc.publish("other", payload)
+            fake_broker.expect_packet("publish", b"".join([
+                paho_test.gen_publish(
+                    b"telemetry/a", qos=0, payload=zlib.compress(payload), proto_ver=5, properties=encoding),
+                paho_test.gen_publish(b"telemetry/b", qos=0, payload=b"{}", proto_ver=5),
+                paho_test.gen_publish(b"other", qos=0, payload=payload, proto_ver=5),
+            ]))
+
+            publish_packet = paho_test.gen_publish(
+                b"telemetry/c", qos=0, payload=zlib.compress(payload), proto_ver=5,
+                properties=encoding + mqtt5_props.gen_string_pair_prop(mqtt5_props.PROP_USER_PROPERTY, "a", "1"),
+            )
+            count = fake_broker.send_packet(publish_packet)
+            assert count == len(publish_packet)
+            assert message_received.wait(1)
+            assert received == [(payload, [("a", "1")])]
+
+            mqttc.disconnect()
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+        finally:
+            mqttc.loop_stop()
+
+    @pytest.mark.parametrize("name", sorted(client._payload_codecs))
+    def test_compression_max_size(self, name: str) -> None:
+        codec = client._payload_codecs[name]
+        payload = b"\0" * 100000
+        compressed = codec.compress(payload)
+        assert codec.decompress(compressed, len(payload)) == payload
+        with pytest.raises(ValueError):
+            codec.decompress(compressed, len(payload) - 1)
+        with pytest.raises(client._DECOMPRESS_ERRORS):
+            codec.decompress(compressed[:len(compressed) // 2], len(payload))
+
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2, "test_compression_max_size", protocol=MQTTProtocolVersion.MQTTv5)
+        received = []
+        mqttc.on_message = lambda client, userdata, msg: received.append(msg.payload)
+        with pytest.raises(ValueError):
+            mqttc.compression_set("telemetry/#", name, max_size=0)
+        mqttc.compression_set("telemetry/#", name, max_size=len(payload) - 1)
+
+        # Given unchanged rather than decompressed past max_size.
+        message = client.MQTTMessage(topic=b"telemetry/a")
+        message.payload = compressed
+        message.properties = Properties(PacketTypes.PUBLISH)
+        message.properties.UserProperty = ("content-encoding", name)
+        mqttc._handle_on_message(message)
+        assert received == [compressed]
+
+        # Decompressed when exactly max_size.
+        mqttc.compression_set("telemetry/#", name, max_size=len(payload))
+        message.payload = compressed
+        message.properties.UserProperty = ("content-encoding", name)
+        mqttc._handle_on_message(message)
+        assert received == [compressed, payload]
+
+    def test_subscription_identifier_dispatch(self, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_subscription_identifier_dispatch",
+            protocol=MQTTProtocolVersion.MQTTv5,
+            transport=fake_broker.transport,
+        )
+
+        received = []
+        message_received = threading.Semaphore(0)
+
+        def callback(name):
+            def on_message(client, userdata, msg):
+                received.append((name, msg.topic))
+                message_received.release()
+            return on_message
+
+        mqttc.on_message = callback("default")
+        mqttc.message_callback_add("sensors/+", callback("sensors"))
+        mqttc.message_callback_add("alarms/#", callback("alarms"))
+        connected = threading.Event()
+        mqttc.on_connect = lambda *args: connected.set()
+        subscribed = threading.Semaphore(0)
+        mqttc.on_subscribe = lambda *args: subscribed.release()
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            connack_packet = paho_test.gen_connack(rc=0, proto_ver=5)
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+            assert connected.wait(1)
+
+            def publish(topic, *sub_ids):
+                properties = b"".join(
+                    mqtt5_props.gen_varint_prop(mqtt5_props.PROP_SUBSCRIPTION_IDENTIFIER, sub_id) for sub_id in sub_ids
+                )
+                publish_packet = paho_test.gen_publish(topic, qos=0, payload=b"", proto_ver=5, properties=properties)
+                count = fake_broker.send_packet(publish_packet)
+                assert count == len(publish_packet)
+                assert message_received.acquire(timeout=1)
+
+            for mid, (sub, sub_id) in enumerate((("sensors/+", 1), ("alarms/#", 2)), start=1):
+                mqttc.subscribe(sub)
+                fake_broker.expect_packet("subscribe", paho_test.gen_subscribe(
+                    mid, sub, 0, proto_ver=5,
+                    properties=mqtt5_props.gen_varint_prop(mqtt5_props.PROP_SUBSCRIPTION_IDENTIFIER, sub_id),
+                ))
+                # Until all the callbacks are subscribed with their
+                # identifier, topics are matched.
+                publish("sensors/a", 1)
+                suback_packet = paho_test.gen_suback(mid, 0, proto_ver=5)
+                count = fake_broker.send_packet(suback_packet)
+                assert count == len(suback_packet)
+                assert subscribed.acquire(timeout=1)
+
+            assert received == [("sensors", "sensors/a"), ("sensors", "sensors/a")]
+            del received[:]
+
+            # The identifiers decide, as told by the broker. Without any,
+            # topics are matched.
+            publish("sensors/b", 1)
+            publish("sensors/c", 1, 2)
+            assert message_received.acquire(timeout=1)
+            publish("other", 7)
+            publish("alarms/d")
+            assert received == [
+                ("sensors", "sensors/b"),
+                ("sensors", "sensors/c"),
+                ("alarms", "sensors/c"),
+                ("default", "other"),
+                ("alarms", "alarms/d"),
+            ]
+            del received[:]
+
+            # Unsubscribed callbacks are matched again.
+            mqttc.unsubscribe("alarms/#")
+            publish("alarms/e", 2)
+            assert received == [("alarms", "alarms/e")]
+
+            mqttc.disconnect()
+
+        finally:
+            mqttc.loop_stop()
+
+    def test_subscription_identifier_unbind(self, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_subscription_identifier_unbind",
+            protocol=MQTTProtocolVersion.MQTTv5,
+            transport=fake_broker.transport,
+        )
+
+        received = []
+        message_received = threading.Semaphore(0)
+
+        def callback(name):
+            def on_message(client, userdata, msg):
+                received.append((name, msg.topic))
+                message_received.release()
+            return on_message
+
+        mqttc.on_message = callback("default")
+        mqttc.message_callback_add("a/b", callback("a/b"))
+        connected = threading.Event()
+        mqttc.on_connect = lambda *args: connected.set()
+        subscribed = threading.Semaphore(0)
+        mqttc.on_subscribe = lambda *args: subscribed.release()
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            connack_packet = paho_test.gen_connack(rc=0, proto_ver=5)
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+            assert connected.wait(1)
+
+            sub_id_prop = mqtt5_props.gen_varint_prop(mqtt5_props.PROP_SUBSCRIPTION_IDENTIFIER, 1)
+
+            def subscribe(mid, *args, **kwargs):
+                mqttc.subscribe(*args, **kwargs)
+                packet_in = fake_broker.receive_packet(1000)
+                assert packet_in[0] == 0x82
+                suback_packet = paho_test.gen_suback(mid, 0, proto_ver=5)
+                count = fake_broker.send_packet(suback_packet)
+                assert count == len(suback_packet)
+                assert subscribed.acquire(timeout=1)
+
+            def publish(topic):
+                publish_packet = paho_test.gen_publish(topic, qos=0, payload=b"", proto_ver=5, properties=sub_id_prop)
+                count = fake_broker.send_packet(publish_packet)
+                assert count == len(publish_packet)
+                assert message_received.acquire(timeout=1)
+
+            subscribe(1, "a/b")
+            publish("x/y")
+            assert received == [("a/b", "x/y")]
+            del received[:]
+
+            # Subscribing again without the identifier unbinds the filter.
+            subscribe(2, [("a/b", 0), ("c", 0)])
+            publish("x/y")
+            assert received == [("default", "x/y")]
+            del received[:]
+
+            # The identifier set by the application is not the callback's.
+            subscribe(3, "a/b")
+            properties = Properties(PacketTypes.SUBSCRIBE)
+            properties.SubscriptionIdentifier = 1
+            subscribe(4, "x/#", properties=properties)
+            publish("x/y")
+            subscribe(5, "a/b")
+            publish("x/y")
+            assert received == [("default", "x/y"), ("default", "x/y")]
+
+            mqttc.disconnect()
+
+        finally:
+            mqttc.loop_stop()
+
+    def test_subscription_identifier_suback(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_subscription_identifier_suback",
+            protocol=MQTTProtocolVersion.MQTTv5,
+        )
+        mqttc.message_callback_add("a/b", lambda *args: None)
+        mqttc.message_callback_add("c/d", lambda *args: None)
+
+        reasoncodes = [b"\x00"]
+        packet_queue = mqttc._packet_queue
+
+        def packet_queue_suback(command, packet, mid, qos, *args, **kwargs):
+            rc = packet_queue(command, packet, mid, qos, *args, **kwargs)
+            # Handled by the network thread before subscribe() returns.
+            mqttc._in_packet["packet"] = struct.pack("!HB", mid, 0) + reasoncodes[0]
+            mqttc._handle_suback()
+            return rc
+
+        monkeypatch.setattr(mqttc, "_packet_queue", packet_queue_suback)
+        sock, peer = socket.socketpair()
+        try:
+            sock.setblocking(False)
+            mqttc._sock = sock
+
+            mqttc.subscribe("a/b")
+            assert mqttc._subscription_id_bound == {"a/b"}
+
+            # Without a reason code, the filter is not bound.
+            reasoncodes[0] = b""
+            mqttc.subscribe("c/d")
+            assert mqttc._subscription_id_bound == {"a/b"}
+            assert not mqttc._subscription_id_pending
+        finally:
+            mqttc._sock = None
+            sock.close()
+            peer.close()
+
+    def test_adaptive_inflight(self, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_adaptive_inflight",
+            protocol=MQTTProtocolVersion.MQTTv5,
+            transport=fake_broker.transport,
+        )
+        mqttc.adaptive_inflight_set(min_inflight=1)
+        assert mqttc.inflight_window == 1
+
+        connected = threading.Event()
+        mqttc.on_connect = lambda *args: connected.set()
+        published = threading.Event()
+        mqttc.on_publish = lambda client, userdata, mid, *args: mid == 2 and published.set()
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            connack_packet = paho_test.gen_connack(rc=0, proto_ver=5)
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+            assert connected.wait(1)
+            assert mqttc.inflight_window == 1
+
+            for i in range(3):
+                mqttc.publish("topic", str(i), qos=1)
+
+            fake_broker.expect_packet(
+                "publish",
+                paho_test.gen_publish(b"topic", qos=1, mid=1, payload=b"0", proto_ver=5),
+            )
+            fake_broker.expect_no_packet(0.2)
+
+            # The window grows once a full window is acknowledged
+            fake_broker.send_packet(paho_test.gen_puback(1, proto_ver=5))
+            fake_broker.expect_packet("publish", b"".join(
+                paho_test.gen_publish(b"topic", qos=1, mid=mid, payload=str(mid - 1).encode(), proto_ver=5)
+                for mid in (2, 3)
+            ))
+            assert mqttc.inflight_window == 2
+
+            # and is halved when the broker's quota is exceeded
+            fake_broker.send_packet(paho_test.gen_puback(2, proto_ver=5, reason_code=0x97))
+            assert published.wait(1)
+            assert mqttc.inflight_window == 1
+
+            fake_broker.send_packet(paho_test.gen_puback(3, proto_ver=5))
+
+            mqttc.disconnect()
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+        finally:
+            mqttc.loop_stop()
+
+    @pytest.mark.parametrize("block", [False, True])
+    def test_max_queued_bytes(self, block, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_max_queued_bytes",
+            transport=fake_broker.transport,
+        )
+        mqttc.max_queued_bytes_set(10, low_watermark=5, block=block, timeout=0.1)
+
+        backpressure = []
+        relieved = threading.Event()
+
+        def on_backpressure(client, userdata, high):
+            backpressure.append(high)
+            if not high:
+                relieved.set()
+
+        mqttc.on_backpressure = on_backpressure
+        connected = threading.Event()
+        mqttc.on_connect = lambda *args: connected.set()
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            connack_packet = paho_test.gen_connack(rc=0)
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+            assert connected.wait(1)
+
+            assert mqttc.publish("topic", b"12345678", qos=1).rc == MQTTErrorCode.MQTT_ERR_SUCCESS
+            assert backpressure == []
+            assert mqttc.publish("topic", b"123", qos=1).rc == MQTTErrorCode.MQTT_ERR_SUCCESS
+            assert backpressure == [True]
+            assert mqttc.queued_bytes == 11
+
+            if block:
+                with pytest.raises(queue.Full):
+                    mqttc.publish("topic", b"4", qos=1)
+            else:
+                assert mqttc.publish("topic", b"4", qos=1).rc == MQTTErrorCode.MQTT_ERR_QUEUE_SIZE
+                # Without using up message IDs
+                infos = mqttc.publish_many([("topic", b"4", 1), ("topic", b"4", 1)])
+                assert [(info.rc, info.mid) for info in infos] == [(MQTTErrorCode.MQTT_ERR_QUEUE_SIZE, 0)] * 2
+
+            fake_broker.expect_packet("publish", b"".join([
+                paho_test.gen_publish(b"topic", qos=1, mid=1, payload=b"12345678"),
+                paho_test.gen_publish(b"topic", qos=1, mid=2, payload=b"123"),
+            ]))
+
+            # Down to the low watermark
+            fake_broker.send_packet(paho_test.gen_puback(1))
+            assert relieved.wait(1)
+            assert backpressure == [True, False]
+            assert mqttc.queued_bytes == 3
+
+            info = mqttc.publish("topic", b"5", qos=0)
+            assert (info.rc, info.mid) == (MQTTErrorCode.MQTT_ERR_SUCCESS, 4)
+            fake_broker.expect_packet("publish", paho_test.gen_publish(b"topic", qos=0, payload=b"5"))
+
+            mqttc.disconnect()
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+        finally:
+            mqttc.loop_stop()
+
+    def test_max_queued_bytes_loop_forever(self, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_max_queued_bytes_loop_forever",
+            transport=fake_broker.transport,
+        )
+        mqttc.max_queued_bytes_set(10, block=True, timeout=5)
+        results = []
+
+        def on_connect(client, userdata, flags, reason, properties):
+            # The network loop runs in this thread, publish() must not wait
+            # for it.
+            results.extend(client.publish("topic", payload, qos=1).rc for payload in (b"12345678", b"123", b"4"))
+            client.disconnect()
+
+        mqttc.on_connect = on_connect
+
+        mqttc.connect("localhost", fake_broker.port)
+        loop = threading.Thread(target=mqttc.loop_forever)
+        loop.start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            connack_packet = paho_test.gen_connack(rc=0)
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+
+            loop.join(2)
+            assert not loop.is_alive()
+            assert results == [
+                MQTTErrorCode.MQTT_ERR_SUCCESS,
+                MQTTErrorCode.MQTT_ERR_SUCCESS,
+                MQTTErrorCode.MQTT_ERR_QUEUE_SIZE,
+            ]
+
+        finally:
+            mqttc.disconnect()
+            loop.join(10)
+
+    def test_publish_priority(self, fake_broker: FakeBroker) -> None:
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "test_publish_priority",
+            transport=fake_broker.transport,
+        )
+
+        def on_connect(client, userdata, flags, reason, properties):
+            # Queued while the network loop is busy, written by priority.
+            client.publish("low", b"1", priority=PublishPriority.LOW)
+            client.publish("normal", b"2")
+            client.publish_many([("high", b"3", 0, False, None, PublishPriority.HIGH)])
+            client.publish("normal", b"4")
+
+        mqttc.on_connect = on_connect
+
+        with pytest.raises(ValueError):
+            mqttc.publish("topic", b"", priority=5)
+
+        mqttc.connect("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            connack_packet = paho_test.gen_connack(rc=0)
+            count = fake_broker.send_packet(connack_packet)
+            assert count == len(connack_packet)
+
+            fake_broker.expect_packet("publish", b"".join([
+                paho_test.gen_publish(b"high", qos=0, payload=b"3"),
+                paho_test.gen_publish(b"normal", qos=0, payload=b"2"),
+                paho_test.gen_publish(b"normal", qos=0, payload=b"4"),
+                paho_test.gen_publish(b"low", qos=0, payload=b"1"),
+            ]))
+
+            mqttc.disconnect()
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+        finally:
+            mqttc.loop_stop()
+
+    def test_publish_priority_connect_first(self) -> None:
+        mqttc = client.Client(CallbackAPIVersion.VERSION2, "test_publish_priority_connect_first")
+
+        # A high priority message queued before reconnecting is still sent
+        # after CONNECT and AUTH, and after the acknowledgements.
+        mqttc._packet_queue(client.PUBLISH, b"high", 0, 0, wakeup=False, priority=PublishPriority.HIGH)
+        mqttc._packet_queue(client.PUBACK, b"puback", 1, 0, wakeup=False)
+        mqttc._packet_queue(client.CONNECT, b"connect", 0, 0, wakeup=False)
+        mqttc._packet_queue(client.AUTH, b"auth", 0, 0, wakeup=False)
+
+        assert [packet.packet for packet in mqttc._out_packet] == [b"connect", b"auth", b"puback", b"high"]
+
+    def test_rate_limit(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        now = [1000.0]
+        monkeypatch.setattr(client, "time_func", lambda: now[0])
+
+        mqttc = client.Client(CallbackAPIVersion.VERSION2, "test_rate_limit")
+        mqttc.rate_limit_set(messages_per_second=8, burst_messages=1)
+        sock, peer = socket.socketpair()
+        try:
+            sock.setblocking(False)
+            peer.settimeout(1)
+            mqttc._sock = sock
+
+            # Written at once by publish(), as the client is not looping.
+            infos = [mqttc.publish("topic", str(i), qos=1) for i in range(3)]
+            publishes = [
+                paho_test.gen_publish(b"topic", qos=1, mid=info.mid, payload=str(i).encode())
+                for i, info in enumerate(infos)
+            ]
+            assert peer.recv(1000) == publishes[0]
+            assert infos[0].rate_limit_wait == 0.0
+            assert not mqttc.want_write()
+
+            # Acknowledgements and PINGREQ are not held back with the messages.
+            mqttc._packet_queue(client.PUBACK, paho_test.gen_puback(7), 7, 1, wakeup=False)
+            mqttc._packet_queue(client.PINGREQ, paho_test.gen_pingreq(), 0, 0, wakeup=False)
+            assert mqttc.want_write()
+            mqttc.loop_write()
+            assert peer.recv(1000) == paho_test.gen_puback(7) + paho_test.gen_pingreq()
+            assert not mqttc.want_write()
+
+            now[0] += 0.0625
+            assert not mqttc.want_write()
+            now[0] += 0.0625
+            assert mqttc.want_write()
+            mqttc.loop_write()
+            assert peer.recv(1000) == publishes[1]
+            assert infos[1].rate_limit_wait == 0.125
+            assert not mqttc.want_write()
+
+            # Only counted from when the message is the next one to publish.
+            now[0] += 0.125
+            mqttc.loop_write()
+            assert peer.recv(1000) == publishes[2]
+            assert infos[2].rate_limit_wait == 0.125
+            assert not mqttc.want_write()
+
+            # Nor are the other packets queued after a message held back.
+            info = mqttc.publish("topic", "3", qos=1)
+            _, mid = mqttc.subscribe("sub")
+            assert peer.recv(1000) == paho_test.gen_subscribe(mid, "sub", 0)
+            assert not mqttc.want_write()
+            mqttc.disconnect()
+            assert peer.recv(1000) == paho_test.gen_disconnect()
+            assert not info.is_published()
+        finally:
+            mqttc._sock = None
+            sock.close()
+            peer.close()
+
+    def test_queued_mids(self) -> None:
+        mqttc = client.Client(CallbackAPIVersion.VERSION2, "test_queued_mids")
+        mqttc.max_inflight_messages_set(2)
+        mqttc._last_mid = 65500
+        sock, peer = socket.socketpair()
+        try:
+            sock.setblocking(False)
+            peer.settimeout(1)
+            mqttc._sock = sock
+
+            # As deep a queue as mids allow, wrapping around after 65535.
+            infos = [mqttc.publish("topic", b"", qos=1) for _ in range(65000)]
+            mids = [info.mid for info in infos]
+            assert mids == [*range(65501, 65536), *range(1, 64966)]
+            assert all(info.rc == MQTTErrorCode.MQTT_ERR_SUCCESS for info in infos)
+            assert list(mqttc._out_queued_mids) == mids[2:]
+            assert peer.recv(1000) == b"".join(paho_test.gen_publish(b"topic", qos=1, mid=mid) for mid in mids[:2])
+
+            # A queued message dropped from the session is skipped.
+            del mqttc._out_messages[mids[3]]
+
+            # Each PUBACK promotes the oldest queued message.
+            for acked, promoted in [(mids[0], mids[2]), (mids[1], mids[4]), (mids[2], mids[5])]:
+                peer.sendall(paho_test.gen_puback(acked))
+                mqttc.loop_read()
+                assert peer.recv(1000) == paho_test.gen_publish(b"topic", qos=1, mid=promoted)
+            assert mqttc._out_queued_mids[0] == mids[6]
+            assert len(mqttc._out_queued_mids) == len(mids) - 6
+        finally:
+            mqttc._sock = None
+            sock.close()
+            peer.close()
+
+
 @pytest.mark.parametrize("callback_version", [
     (CallbackAPIVersion.VERSION1),
     (CallbackAPIVersion.VERSION2),
@@ -708,6 +1775,421 @@ class TestPublishBroker2Client:
         assert userdata['callback1'] == 1
         assert userdata['callback2'] == 2
 
+    def test_message_callback_snapshot(self, callback_version):
+        mqttc = client.Client(callback_version, "test_message_callback_snapshot")
+
+        received = []
+        mqttc.on_message = lambda client, userdata, msg: received.append(("default", msg.topic))
+        message = client.MQTTMessage(topic=b"a/b")
+        mqttc._handle_on_message(message)
+        snapshot = mqttc._message_callbacks
+
+        mqttc.message_callback_add("a/+", lambda client, userdata, msg: received.append(("a/+", msg.topic)))
+        # Published again by the next message dispatched
+        assert mqttc._message_callbacks is snapshot
+        mqttc._handle_on_message(message)
+        assert mqttc._message_callbacks is not snapshot
+        mqttc.message_callback_remove("a/+")
+        mqttc._handle_on_message(message)
+
+        assert received == [("default", "a/b"), ("a/+", "a/b"), ("default", "a/b")]
+        assert list(snapshot.matcher.iter_match("a/b")) == []
+
+    def test_multiple_packets_in_one_read(self, callback_version, fake_broker):
+        mqttc = client.Client(callback_version, "client-id", transport=fake_broker.transport)
+
+        received = []
+        all_received = threading.Event()
+
+        def on_message(client, userdata, msg):
+            received.append((msg.topic, msg.payload))
+            if len(received) == 4:
+                all_received.set()
+
+        mqttc.on_message = on_message
+
+        mqttc.connect_async("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            connect_packet = paho_test.gen_connect("client-id")
+            packet_in = fake_broker.receive_packet(len(connect_packet))
+            assert packet_in  # Check connection was not closed
+            assert packet_in == connect_packet
+
+            # Packets that arrive together, including one larger than a
+            # single read, must all be handled.
+            large_payload = b"x" * 200000
+            data = b"".join([
+                paho_test.gen_connack(rc=0),
+                paho_test.gen_publish(b"topic/0", qos=0, payload=b"first"),
+                paho_test.gen_publish(b"topic/1", qos=0, payload=large_payload),
+                paho_test.gen_publish(b"topic/2", qos=0, payload=b""),
+                paho_test.gen_publish(b"topic/3", qos=0, payload=b"last"),
+            ])
+            count = fake_broker.send_packet(data)
+            assert count  # Check connection was not closed
+            assert count == len(data)
+
+            assert all_received.wait(2)
+            assert received == [
+                ("topic/0", b"first"),
+                ("topic/1", large_payload),
+                ("topic/2", b""),
+                ("topic/3", b"last"),
+            ]
+
+            mqttc.disconnect()
+
+            disconnect_packet = paho_test.gen_disconnect()
+            packet_in = fake_broker.receive_packet(len(disconnect_packet))
+            assert packet_in  # Check connection was not closed
+            assert packet_in == disconnect_packet
+
+        finally:
+            mqttc.loop_stop()
+
+        packet_in = fake_broker.receive_packet(1)
+        assert not packet_in  # Check connection is closed
+
+
+    def test_incoming_topic_alias(self, callback_version, fake_broker):
+        mqttc = client.Client(
+            callback_version,
+            "client-id",
+            protocol=MQTTProtocolVersion.MQTTv5,
+            transport=fake_broker.transport,
+        )
+        assert mqttc.incoming_topic_alias_maximum == 0
+        mqttc.incoming_topic_alias_maximum = 2
+
+        received = []
+        all_received = threading.Event()
+
+        def on_message(client, userdata, msg):
+            received.append((msg.topic, msg.payload))
+            if len(received) == 4:
+                all_received.set()
+
+        mqttc.on_message = on_message
+
+        mqttc.connect_async("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            # The client advertises its topic alias maximum
+            connect_packet = paho_test.gen_connect(
+                "client-id", proto_ver=5,
+                properties=mqtt5_props.gen_uint16_prop(mqtt5_props.PROP_TOPIC_ALIAS_MAXIMUM, 2),
+            )
+            packet_in = fake_broker.receive_packet(len(connect_packet))
+            assert packet_in  # Check connection was not closed
+            assert packet_in == connect_packet
+
+            def alias(n):
+                return mqtt5_props.gen_uint16_prop(mqtt5_props.PROP_TOPIC_ALIAS, n)
+
+            data = b"".join([
+                paho_test.gen_connack(rc=0, proto_ver=5),
+                paho_test.gen_publish(b"topic/a", qos=0, payload=b"1", proto_ver=5, properties=alias(1)),
+                paho_test.gen_publish(b"", qos=0, payload=b"2", proto_ver=5, properties=alias(1)),
+                paho_test.gen_publish(b"topic/b", qos=0, payload=b"3", proto_ver=5, properties=alias(1)),
+                paho_test.gen_publish(b"", qos=0, payload=b"4", proto_ver=5, properties=alias(1)),
+            ])
+            count = fake_broker.send_packet(data)
+            assert count == len(data)
+
+            assert all_received.wait(1)
+            assert received == [
+                ("topic/a", b"1"),
+                ("topic/a", b"2"),
+                ("topic/b", b"3"),
+                ("topic/b", b"4"),
+            ]
+
+            # An alias the broker never set is a protocol error
+            publish_packet = paho_test.gen_publish(b"", qos=0, payload=b"5", proto_ver=5, properties=alias(2))
+            count = fake_broker.send_packet(publish_packet)
+            assert count  # Check connection was not closed
+
+            packet_in = fake_broker.receive_packet(1)
+            assert not packet_in  # Check connection is closed
+
+        finally:
+            mqttc.loop_stop()
+
+
+@pytest.mark.parametrize("proto_ver", [
+    (MQTTProtocolVersion.MQTTv311),
+    (MQTTProtocolVersion.MQTTv5),
+])
+class TestPayloadMemoryview:
+    def test_payload_memoryview(self, proto_ver, fake_broker):
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "client-id",
+            protocol=proto_ver,
+            transport=fake_broker.transport,
+        )
+        assert not mqttc.payload_memoryview
+        mqttc.payload_memoryview = True
+
+        received = []
+        all_received = threading.Event()
+
+        def on_message(client, userdata, msg):
+            received.append(msg)
+            if len(received) == 2:
+                all_received.set()
+
+        mqttc.on_message = on_message
+
+        mqttc.connect_async("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            connack_packet = paho_test.gen_connack(rc=0, proto_ver=proto_ver)
+            count = fake_broker.send_packet(connack_packet)
+            assert count  # Check connection was not closed
+
+            properties = mqtt5_props.gen_string_prop(mqtt5_props.PROP_CONTENT_TYPE, "text/plain")
+            for qos, mid, payload in ((0, 0, b"qos0 payload"), (1, 1, b"qos1 payload")):
+                publish_packet = paho_test.gen_publish(
+                    "topic", qos=qos, mid=mid, payload=payload,
+                    proto_ver=proto_ver, properties=properties)
+                count = fake_broker.send_packet(publish_packet)
+                assert count  # Check connection was not closed
+
+            assert all_received.wait(1)
+
+            mqttc.disconnect()
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+        finally:
+            mqttc.loop_stop()
+
+        for msg, expected in zip(received, (b"qos0 payload", b"qos1 payload")):
+            assert msg.topic == "topic"
+            assert isinstance(msg.payload, memoryview)
+            assert msg.payload == expected
+            if proto_ver == MQTTProtocolVersion.MQTTv5:
+                assert msg.properties.ContentType == "text/plain"
+        assert received[1].mid == 1
+
+    @pytest.mark.parametrize("payload_memoryview", [True, False])
+    def test_large_packets(self, proto_ver, payload_memoryview, fake_broker):
+        mqttc = client.Client(
+            CallbackAPIVersion.VERSION2,
+            "client-id",
+            protocol=proto_ver,
+            transport=fake_broker.transport,
+        )
+        mqttc.payload_memoryview = payload_memoryview
+        # Packets larger than a read go to their own (pooled) buffer, which
+        # must not be reused while a payload still refers to it.
+        mqttc.receive_buffer_set(chunk_size=16, pool_size=2)
+
+        payloads = [bytes([i]) * 1000 for i in range(4)]
+        received = []
+        all_received = threading.Event()
+
+        def on_message(client, userdata, msg):
+            received.append(msg.payload)
+            if len(received) == len(payloads):
+                all_received.set()
+
+        mqttc.on_message = on_message
+
+        mqttc.connect_async("localhost", fake_broker.port)
+        mqttc.loop_start()
+
+        try:
+            fake_broker.start()
+
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+            data = paho_test.gen_connack(rc=0, proto_ver=proto_ver) + b"".join(
+                paho_test.gen_publish("topic", qos=0, payload=payload, proto_ver=proto_ver)
+                for payload in payloads
+            )
+            count = fake_broker.send_packet(data)
+            assert count == len(data)
+
+            assert all_received.wait(1)
+
+            mqttc.disconnect()
+            packet_in = fake_broker.receive_packet(1000)
+            assert packet_in  # Check connection was not closed
+
+        finally:
+            mqttc.loop_stop()
+
+        assert received == payloads
+
+
+class FakeTLSSocket:
+    """Records what is sent, and writes as much of it as told by writes:
+    a number of bytes, None for all of it, or an exception."""
+
+    def __init__(self, writes):
+        self.writes = list(writes)
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+        write = self.writes.pop(0) if self.writes else None
+        if isinstance(write, Exception):
+            raise write
+        return len(data) if write is None else write
+
+    def close(self):
+        pass
+
+
+class TestOutPacket:
+    def test_views(self) -> None:
+        packet = client._OutPacket(client.PUBLISH, 1, 0, b"head", b"payload", None)
+        for pos, views in [(0, [b"head", b"payload"]), (2, [b"ad", b"payload"]), (4, [b"payload"]), (6, [b"yload"])]:
+            packet.pos = pos
+            assert [bytes(view) for view in packet.views()] == views
+
+        packet = client._OutPacket(client.PINGREQ, 0, 0, paho_test.gen_pingreq(), b"", None)
+        assert [bytes(view) for view in packet.views()] == [paho_test.gen_pingreq()]
+        packet.pos = 1
+        assert [bytes(view) for view in packet.views()] == [paho_test.gen_pingreq()[1:]]
+
+    def test_partial_write(self) -> None:
+        mqttc = client.Client(CallbackAPIVersion.VERSION2, "test_partial_write")
+        sock = mqttc._sock = FakeTLSSocket([5, BlockingIOError()])
+        first = paho_test.gen_publish(b"topic", qos=0, payload=b"first")
+        second = paho_test.gen_publish(b"topic", qos=0, payload=b"second")
+
+        mqttc.publish("topic", b"first")
+        assert sock.sent == [first, first[5:]]
+        packet = mqttc._out_packet.peek()
+        assert packet.pos == 5
+        assert packet.to_process == len(first) - 5
+
+        # The rest of the first packet is written again alone, then the next.
+        sock.sent.clear()
+        mqttc.publish("topic", b"second")
+        assert sock.sent == [first[5:], second]
+        assert not mqttc.want_write()
+
+    def test_retry_rate_limited(self) -> None:
+        mqttc = client.Client(CallbackAPIVersion.VERSION2, "test_retry_rate_limited")
+        mqttc.rate_limit_set(messages_per_second=2)
+        sock = mqttc._sock = FakeTLSSocket([ssl.SSLWantWriteError()])
+
+        mqttc.publish_many([("topic", b"first"), ("topic", b"second")])
+        batch = paho_test.gen_publish(b"topic", qos=0, payload=b"first") + paho_test.gen_publish(
+            b"topic", qos=0, payload=b"second")
+        assert sock.sent == [batch]
+
+        # TLS requires the same data on retry, whatever the rate limit says.
+        mqttc.rate_limit_set(messages_per_second=1)
+        mqttc.loop_write()
+        assert sock.sent == [batch, batch]
+        assert not mqttc._out_packet
+
+
+wakeup_factories = [pytest.param(client._socketpair_compat, id="socketpair")]
+if hasattr(os, "eventfd"):
+    wakeup_factories.append(pytest.param(client._wakeup_socketpair, id="eventfd"))
+
+
+@pytest.mark.parametrize("wakeup_factory", wakeup_factories)
+class TestLoopWakeup:
+    def make_client(self, wakeup_factory):
+        mqttc = client.Client(CallbackAPIVersion.VERSION2, "test_loop_wakeup")
+        mqttc._sockpairR, mqttc._sockpairW = wakeup_factory()
+        # As with loop_start(), so that queueing packets only wakes up the loop
+        mqttc._thread = threading.current_thread()
+        return mqttc
+
+    @staticmethod
+    def readable(sock, timeout=0.0):
+        return bool(select.select([sock], [], [], timeout)[0])
+
+    def test_coalescing(self, wakeup_factory):
+        mqttc = self.make_client(wakeup_factory)
+        try:
+            assert not self.readable(mqttc._sockpairR)
+            for _ in range(3):
+                mqttc._packet_queue_wakeup()
+            # Only the first wakeup is written until the loop handles it
+            assert self.readable(mqttc._sockpairR)
+            if isinstance(mqttc._sockpairR, client._EventFd):
+                assert mqttc._sockpairR.recv(8) == struct.pack("=Q", 1)
+            else:
+                assert mqttc._sockpairR.recv(100) == client.sockpair_data
+            assert not self.readable(mqttc._sockpairR)
+
+            mqttc._packet_queue_wakeup()
+            mqttc._sockpair_drain()
+            assert not self.readable(mqttc._sockpairR)
+            mqttc._packet_queue_wakeup()
+            assert self.readable(mqttc._sockpairR)
+        finally:
+            mqttc._reset_sockets()
+
+    def test_wakeup_while_draining(self, wakeup_factory):
+        mqttc = self.make_client(wakeup_factory)
+        sockpair_r = mqttc._sockpairR
+
+        class Draining:
+            # A producer queues a packet as the loop drains the wakeup
+            def recv(self, bufsize):
+                mqttc._packet_queue_wakeup()
+                return sockpair_r.recv(bufsize)
+
+        try:
+            mqttc._packet_queue_wakeup()
+            mqttc._sockpairR = Draining()
+            mqttc._sockpair_drain()
+            mqttc._sockpairR = sockpair_r
+            # The next packet queued wakes up the loop again
+            mqttc._packet_queue_wakeup()
+            assert self.readable(sockpair_r)
+        finally:
+            mqttc._sockpairR = sockpair_r
+            mqttc._reset_sockets()
+
+    def test_concurrent_producer(self, wakeup_factory):
+        mqttc = self.make_client(wakeup_factory)
+        done = threading.Event()
+
+        def producer():
+            for _ in range(20000):
+                mqttc._packet_queue_wakeup()
+            done.set()
+
+        thread = threading.Thread(target=producer)
+        try:
+            thread.start()
+            while not done.is_set():
+                if self.readable(mqttc._sockpairR, 0.001):
+                    mqttc._sockpair_drain()
+            thread.join()
+            mqttc._sockpair_drain()
+            # No wakeup was lost with the flag left set
+            mqttc._packet_queue_wakeup()
+            assert self.readable(mqttc._sockpairR)
+        finally:
+            thread.join()
+            mqttc._reset_sockets()
+
 
 class TestCompatibility:
     """
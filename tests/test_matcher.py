@@ -1,4 +1,5 @@
 import paho.mqtt.client as client
+from paho.mqtt.matcher import MQTTMatcher
 import pytest
 
 
@@ -34,3 +35,136 @@ class Test_client_function:
     ])
     def test_not_matching(self, sub, topic):
         assert not client.topic_matches_sub(sub, topic)
+
+    def test_topic_filter(self):
+        topic_filter = client.TopicFilter("sensors/+/temperature/#")
+        assert topic_filter.filter == "sensors/+/temperature/#"
+        assert topic_filter.matches("sensors/a/temperature")
+        assert topic_filter.matches("sensors/b/temperature/max")
+        assert not topic_filter.matches("sensors/a/humidity")
+        assert not topic_filter.matches("sensors/temperature")
+
+        assert client.TopicFilter("plain/topic").matches("plain/topic")
+        assert not client.TopicFilter("plain/topic").matches("plain/topic/more")
+        assert client.TopicFilter("$SYS/#").matches("$SYS/broker/uptime")
+        assert not client.TopicFilter("+/broker/uptime").matches("$SYS/broker/uptime")
+        assert client.TopicFilter("$SYS/+/uptime").matches("$SYS/broker/uptime")
+
+
+class TestMQTTMatcher:
+    def test_iter_match_order(self):
+        matcher = MQTTMatcher()
+        for sub in ["#", "foo/#", "foo/+", "+/bar", "foo/bar", "foo/bar/#"]:
+            matcher[sub] = sub
+        assert list(matcher.iter_match("foo/bar")) == ["foo/bar", "foo/bar/#", "foo/+", "foo/#", "+/bar", "#"]
+        assert list(matcher.iter_match("$SYS/bar")) == []
+
+    def test_cache_invalidation(self):
+        matcher = MQTTMatcher(cache_size=2)
+        matcher["foo/+"] = 1
+        assert list(matcher.iter_match("foo/bar")) == [1]
+        matcher["foo/bar"] = 2
+        assert list(matcher.iter_match("foo/bar")) == [2, 1]
+        matcher["foo/bar"] = 3
+        assert list(matcher.iter_match("foo/bar")) == [3, 1]
+        del matcher["foo/+"]
+        assert list(matcher.iter_match("foo/bar")) == [3]
+
+        for topic in ["a", "b", "c", "foo/bar"]:
+            list(matcher.iter_match(topic))
+        assert len(matcher._cache) == 2
+
+    def test_path_compression(self):
+        matcher = MQTTMatcher()
+        matcher["fleet/site/device/+/alarm"] = 1
+        assert matcher._root._children["fleet"]._levels == ("fleet", "site", "device", "+", "alarm")
+
+        matcher["fleet/site/other/#"] = 2
+        fleet = matcher._root._children["fleet"]
+        assert fleet._levels == ("fleet", "site")
+        assert set(fleet._children) == {"device", "other"}
+        assert list(matcher.iter_match("fleet/site/device/1/alarm")) == [1]
+        assert list(matcher.iter_match("fleet/site/other")) == [2]
+        assert matcher["fleet/site/other/#"] == 2
+        with pytest.raises(KeyError):
+            matcher["fleet/site"]
+
+        del matcher["fleet/site/other/#"]
+        assert matcher._root._children["fleet"]._levels == ("fleet", "site", "device", "+", "alarm")
+        assert list(matcher.iter_match("fleet/site/device/1/alarm")) == [1]
+
+    def test_hash_not_last(self):
+        # Invalid filters, where '#' is only a wildcard as the last level.
+        matcher = MQTTMatcher()
+        matcher["a/#/x"] = 1
+        matcher["#/x"] = 2
+        for topic in ["a/b/c", "a/b/x", "a", "x"]:
+            assert list(matcher.iter_match(topic)) == []
+        assert matcher.match_many(["a/b/c", "a/b/x", "a", "x"]) == [(), (), (), ()]
+
+        matcher["a/#"] = 3
+        assert list(matcher.iter_match("a/b/x")) == [3]
+        assert matcher.match_many(["a/b/x", "b"]) == [(3,), ()]
+
+    @pytest.mark.parametrize("subs", [["a/b/c"], ["a/b/c", "a/b/d"]])
+    def test_delete_without_value(self, subs):
+        matcher = MQTTMatcher()
+        for sub in subs:
+            matcher[sub] = sub
+
+        # Deleting a prefix of the filters leaves them, whether or not
+        # it has a node of its own.
+        del matcher["a/b"]
+        del matcher["a"]
+        for sub in subs:
+            assert matcher[sub] == sub
+            assert list(matcher.iter_match(sub)) == [sub]
+
+        for key in ["a/x", "a/b/c/d", "x"]:
+            with pytest.raises(KeyError):
+                del matcher[key]
+
+    def test_match_many(self):
+        matcher = MQTTMatcher()
+        for sub in ["#", "+/+/status", "fleet/+/status", "fleet/a/#", "fleet/a/telemetry/temp", "$SYS/#"]:
+            matcher[sub] = sub
+        topics = [
+            "fleet/a/status", "fleet/b/status", "fleet/a/telemetry/temp", "fleet/a/status",
+            "$SYS/broker/load", "other", "fleet",
+        ]
+        assert matcher.match_many(topics) == [tuple(matcher.iter_match(topic)) for topic in topics]
+        assert matcher.match_many([]) == []
+
+    def test_copy(self):
+        matcher = MQTTMatcher()
+        matcher["fleet/site/device/+/alarm"] = 1
+        matcher["fleet/site/other/#"] = 2
+        assert list(matcher.iter_match("fleet/site/other/x")) == [2]
+
+        copy = matcher.copy()
+        copy["fleet/site/device/1/status"] = 3
+        del copy["fleet/site/other/#"]
+        matcher["fleet/site/device/+/alarm"] = 4
+
+        assert list(copy.iter_match("fleet/site/device/1/status")) == [3]
+        assert list(copy.iter_match("fleet/site/device/1/alarm")) == [1]
+        assert list(copy.iter_match("fleet/site/other/x")) == []
+        assert list(matcher.iter_match("fleet/site/device/1/status")) == []
+        assert list(matcher.iter_match("fleet/site/device/1/alarm")) == [4]
+        assert list(matcher.iter_match("fleet/site/other/x")) == [2]
+
+    def test_copy_owned_nodes(self):
+        matcher = MQTTMatcher()
+        matcher["fleet/a/status"] = 1
+        copy = matcher.copy()
+        copy["fleet/b/status"] = 2
+        root = copy._root
+        assert root is not matcher._root
+        # The nodes copied once are then changed in place.
+        copy["fleet/c/status"] = 3
+        del copy["fleet/a/status"]
+        assert copy._root is root
+        assert list(matcher.iter_match("fleet/a/status")) == [1]
+        assert list(matcher.iter_match("fleet/c/status")) == []
+        assert list(copy.iter_match("fleet/a/status")) == []
+        assert list(copy.iter_match("fleet/c/status")) == [3]
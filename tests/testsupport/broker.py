@@ -75,6 +75,12 @@ class FakeBroker:
 
         paho_test.expect_packet(self._conn, name, packet)
 
+    def expect_no_packet(self, delay=1):
+        if self._conn is None:
+            raise ValueError('Connection is not open')
+
+        paho_test.expect_no_packet(self._conn, delay)
+
 
 @pytest.fixture(params=["tcp"] + (["unix"] if hasattr(socket, 'AF_UNIX') else []))
 def fake_broker(request):